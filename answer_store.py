@@ -0,0 +1,102 @@
+"""Archivio delle risposte della sessione, sopravvive ai rerun di Streamlit.
+
+Ogni domanda diventa un record Answer con dati, SQL, riassunto, grafico (PNG)
+e tempi per fase. I rerun ridisegnano la risposta dal record e calcolano solo
+le fasi mancanti, ad esempio il grafico attivato dopo la risposta.
+"""
+import contextlib
+import time
+import uuid
+from dataclasses import dataclass, field
+
+import tracing
+
+MAX_ANSWERS = 20
+# Fasi il cui fallimento rende inutili le successive
+BLOCKING_STAGES = ('sql', 'data')
+
+
+@dataclass
+class Answer:
+    mode: str  # 'gsc' | 'bigquery'
+    question: str
+    id: str = field(default_factory=lambda: uuid.uuid4().hex[:12])
+    created_at: float = field(default_factory=time.time)
+    data: object = None  # DataFrame dei risultati
+    data_info: dict = field(default_factory=dict)  # sito, periodi, provenienza, righe...
+    sql: str | None = None
+    summary: str | None = None
+    chart_code: str | None = None
+    chart_png: bytes | None = None
+    timings: dict = field(default_factory=dict)  # fase -> secondi
+    errors: dict = field(default_factory=dict)  # fase -> messaggio
+    route: object = None  # RouteDecision della modalità automatica
+
+    def has(self, stage: str) -> bool:
+        """True se la fase è stata calcolata (con successo o con errore)"""
+        if stage in self.errors:
+            return True
+        if stage == 'data':
+            return self.data is not None
+        if stage == 'chart':
+            return self.chart_png is not None
+        return getattr(self, stage) is not None
+
+    def pending(self, stages: list[str]) -> list[str]:
+        """Fasi ancora da calcolare; senza SQL o dati le fasi successive non hanno senso"""
+        missing = []
+        for stage in stages:
+            if stage in self.errors and stage in BLOCKING_STAGES:
+                break
+            if not self.has(stage):
+                missing.append(stage)
+        return missing
+
+    def fail(self, stage: str, message: str):
+        self.errors[stage] = message
+
+
+@contextlib.contextmanager
+def timed(answer: Answer, stage: str):
+    """Misura una fase della risposta (anche come span di tracing)"""
+    start = time.perf_counter()
+    with tracing.span(f'answer.{stage}'):
+        try:
+            yield
+        finally:
+            answer.timings[stage] = answer.timings.get(stage, 0.0) + time.perf_counter() - start
+
+
+class ConversationStore:
+    """Risposte della sessione in session_state, dalla più vecchia alla più recente"""
+
+    def __init__(self, session_state, key: str = 'conversation', max_answers: int = MAX_ANSWERS):
+        self.session_state = session_state
+        self.key = key
+        self.max_answers = max_answers
+
+    @property
+    def answers(self) -> list[Answer]:
+        if self.session_state.get(self.key) is None:
+            self.session_state[self.key] = []
+        return self.session_state[self.key]
+
+    def add(self, answer: Answer) -> Answer:
+        answers = self.answers
+        answers.append(answer)
+        del answers[:-self.max_answers]
+        return answer
+
+    def latest(self, mode: str) -> Answer | None:
+        for answer in reversed(self.answers):
+            if answer.mode == mode:
+                return answer
+        return None
+
+    def history(self, mode: str) -> list[Answer]:
+        return [answer for answer in self.answers if answer.mode == mode]
+
+    def clear(self, mode: str | None = None):
+        self.session_state[self.key] = [
+            answer for answer in self.answers if mode is not None and answer.mode != mode
+        ]
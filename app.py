@@ -1,17 +1,20 @@
 import streamlit as st
-import os
 import time
-import atexit
 import requests
 import json
 from urllib.parse import urlencode, urlparse, parse_qs
 from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
 
-# Import delle modalità
-from gsc_direct import GSCDirectMode
-from bigquery_mode import BigQueryMode
+from rate_limiter import call_with_retry, user_key
+from clients import close_user_clients, get_bigquery_client
+from result_cache import result_cache
+from schema_cache import schema_cache
+import tracing
+import warmup
+
+# Le modalità (e googleapiclient, openai, BigQuery, matplotlib) vengono importate
+# solo dopo il login, così la schermata di accesso resta leggera
 
 # --- Helper per compatibilità query params ---
 def get_query_params() -> dict:
@@ -125,8 +128,13 @@ def test_google_credentials():
             scopes=['https://www.googleapis.com/auth/webmasters.readonly']
         )
         
+        from googleapiclient.discovery import build
+
         service = build('searchconsole', 'v1', credentials=credentials)
-        test_response = service.sites().list().execute()
+        test_response = call_with_retry(
+            lambda: service.sites().list().execute(),
+            'gsc', user=user_key(st.session_state)
+        )
         return True
         
     except Exception as e:
@@ -161,15 +169,43 @@ def check_authentication():
         return True
     return False
 
+def release_bigquery_session():
+    """Annulla il job BigQuery in corso e chiude il paginatore dei risultati"""
+    active = st.session_state.get('bq_active_job')
+    if active and st.session_state.get('gcp_credentials') is not None:
+        try:
+            client = get_bigquery_client(
+                active['project_id'], st.session_state.gcp_credentials, user_key(st.session_state)
+            )
+            client.cancel_job(active['job_id'], project=active['project_id'], location=active['location'])
+        except Exception:
+            pass
+    pager = st.session_state.get('bq_result_pager')
+    if pager is not None:
+        try:
+            pager.close()
+        except Exception:
+            pass
+
 def logout():
     """Effettua il logout dell'utente"""
     try:
+        # Job, paginatore e client BigQuery vanno chiusi prima di dimenticarne le credenziali
+        release_bigquery_session()
+        close_user_clients(user_key(st.session_state))
+        schema_cache.invalidate(user_key(st.session_state))
+        result_cache.invalidate(user_key(st.session_state))
+
         # Reset session state
-        for key in ['authenticated', 'user_email', 'access_token', 'refresh_token',
+        for key in ['authenticated', 'user_email', 'access_token', 'refresh_token', 'gcp_credentials',
                    'gsc_sites_data', 'selected_project_id', 'config_applied_successfully',
-                   'analysis_mode', 'gsc_config', 'gsc_data']:
+                   'analysis_mode', 'gsc_config', 'gsc_data', 'conversation',
+                   'table_schema_for_prompt', 'gcp_location']:
             if key in st.session_state:
                 del st.session_state[key]
+        # Stato BigQuery della sessione: schema, byte fatturati, job e risultati
+        for key in [key for key in st.session_state if key.startswith('bq_')]:
+            del st.session_state[key]
         st.rerun()
     except Exception as e:
         st.error(f"Errore durante il logout: {e}")
@@ -216,15 +252,23 @@ def get_gsc_sites():
             return []
         
         # Ottieni credenziali aggiornate
-        credentials = refresh_credentials()
+        with tracing.span('credentials.refresh'):
+            credentials = refresh_credentials()
         if not credentials:
             return []
         
         # Debug delle credenziali
         st.info(f"🔍 Debug: Token valido: {credentials.valid}, Scaduto: {credentials.expired}")
         
-        service = build('searchconsole', 'v1', credentials=credentials)
-        sites_response = service.sites().list().execute()
+        with tracing.span('gsc.build'):
+            from googleapiclient.discovery import build
+
+            service = build('searchconsole', 'v1', credentials=credentials)
+        with tracing.span('gsc.sites_list'):
+            sites_response = call_with_retry(
+                lambda: service.sites().list().execute(),
+                'gsc', user=user_key(st.session_state)
+            )
         sites = sites_response.get('siteEntry', [])
         
         st.success(f"✅ API GSC risposta OK: {len(sites)} siti trovati")
@@ -262,29 +306,58 @@ def init_session_state():
         'gsc_sites_data': [],
         'selected_site': "",
         'selected_project_id': "",
+        'gcp_credentials': None,
         'config_applied_successfully': False,
         'table_schema_for_prompt': "",
+        'bq_schema': None,
+        'bq_session_bytes_billed': 0,
+        'bq_result_pager': None,
+        'bq_active_job': None,
+        'conversation': None,
         'analysis_mode': "🔍 Google Search Console",
         'gsc_config': None,
         'gsc_data': None,
-        'enable_chart_generation': False
+        'enable_chart_generation': False,
+        'enable_tracing': tracing.is_enabled_by_env()
     }
     
     for key, default_value in defaults.items():
         if key not in st.session_state:
             st.session_state[key] = default_value
 
-# --- Cleanup File Temporanei ---
-def cleanup_temp_files():
-    """Pulisce i file temporanei delle credenziali"""
-    if hasattr(st.session_state, 'temp_credentials_file'):
-        try:
-            if os.path.exists(st.session_state.temp_credentials_file):
-                os.remove(st.session_state.temp_credentials_file)
-        except:
-            pass
-
-atexit.register(cleanup_temp_files)
+# --- Tracing (Debug) ---
+def render_trace_debug(trace):
+    """Salva e mostra la trace delle fasi se il rerun ha elaborato una domanda"""
+    if not isinstance(trace, tracing.Span) or not trace.find('question'):
+        return
+    try:
+        tracing.write_trace(trace)
+    except OSError as e:
+        st.warning(f"Impossibile salvare la trace: {e}")
+    with st.expander("🐞 Tempi per fase (Debug)", expanded=False):
+        st.write(f"**Totale:** {trace.duration * 1000:.0f} ms")
+        st.dataframe(trace.flatten())
+        st.caption(f"Trace salvate in `{tracing.TRACE_DIR}/traces.jsonl` e `{tracing.TRACE_DIR}/metrics.prom`")
+
+# --- Profilazione (Debug) ---
+def render_profiled(mode):
+    """Esegue un render() sotto profiler e mostra le funzioni più costose"""
+    import profiling
+
+    profile = profiling.RenderProfile(type(mode).__name__)
+    processed_question = profile.run(mode.render)
+    if not processed_question:
+        return
+    try:
+        paths = profile.save()
+    except OSError as e:
+        st.warning(f"Impossibile salvare il profilo: {e}")
+        paths = {}
+    with st.expander("⏱️ Profilo della domanda (Debug)", expanded=False):
+        st.write(f"**Durata render:** {profile.duration * 1000:.0f} ms")
+        st.dataframe(profile.top_functions())
+        if paths:
+            st.caption(f"Flame graph: `{paths['speedscope']}` (apri su speedscope.app) · pstats: `{paths['pstats']}`")
 
 # --- Privacy Policy ---
 PRIVACY_POLICY_TEXT = """
@@ -306,7 +379,9 @@ Questa applicazione utilizza l'autenticazione OAuth 2.0 di Google per accedere a
 
 **Sicurezza:**
 - I token vengono conservati solo durante la sessione
-- Nessun dato permanente viene salvato
+- Nessun dato permanente viene salvato, salvo le funzioni abilitate dall'amministratore:
+- Esempi domanda→SQL della modalità BigQuery (se abilitati): conservati sul server e riusati per tutti gli utenti
+- Copia locale dell'export BigQuery (se abilitata): file Parquet sul disco del server, letti solo da utenti con accesso ai dati su BigQuery
 - Comunicazioni crittografate HTTPS
 
 **I Tuoi Diritti:**
@@ -402,9 +477,9 @@ def main():
             st.subheader("⚙️ Modalità di Analisi")
             analysis_mode = st.radio(
                 "Scegli come analizzare i dati:",
-                ["🔍 Google Search Console", "📊 BigQuery"],
+                ["🔍 Google Search Console", "📊 BigQuery", "🧭 Automatica"],
                 key="analysis_mode_selector",
-                help="Google Search Console: Più semplice, dati in tempo reale\nBigQuery: Più potente, richiede export GSC → BQ"
+                help="Google Search Console: Più semplice, dati in tempo reale\nBigQuery: Più potente, richiede export GSC → BQ\nAutomatica: sceglie per ogni domanda la fonte più rapida o più completa"
             )
             
             st.session_state.analysis_mode = analysis_mode
@@ -418,6 +493,22 @@ def main():
             )
             st.session_state.enable_chart_generation = enable_chart_generation
 
+            enable_tracing = st.checkbox(
+                "🐞 Debug: tempi per fase",
+                value=st.session_state.get('enable_tracing', False),
+                key="enable_tracing_toggle",
+                help="Traccia le fasi di ogni domanda (fetch, LLM, grafico) e salva JSONL/OpenMetrics"
+            )
+            st.session_state.enable_tracing = enable_tracing
+
+            enable_profiling = st.checkbox(
+                "⏱️ Debug: profila la domanda",
+                value=False,
+                key="enable_profiling_toggle",
+                help="Profila il render della prossima domanda e salva flame graph (speedscope) e pstats"
+            )
+            st.session_state.enable_profiling = enable_profiling
+
     # Area principale
     if not st.session_state.get('authenticated', False):
         # Schermata di benvenuto per utenti non autenticati
@@ -438,16 +529,33 @@ def main():
     else:
         # Utente autenticato - mostra la modalità appropriata
         current_mode = st.session_state.get('analysis_mode', '🔍 Google Search Console')
+
+        # Pre-importa in background i moduli pesanti (una volta per processo)
+        warmup.start()
         
-        if current_mode == "🔍 Google Search Console":
-            # Carica modalità GSC Diretta
-            gsc_mode = GSCDirectMode(st.session_state, get_gsc_sites)
-            gsc_mode.render()
-            
-        else:
-            # Carica modalità BigQuery
-            bq_mode = BigQueryMode(st.session_state)
-            bq_mode.render()
+        with tracing.start_trace('rerun', st.session_state.get('enable_tracing', False), mode=current_mode) as trace:
+            if current_mode == "🔍 Google Search Console":
+                # Carica modalità GSC Diretta
+                with tracing.span('import.mode'):
+                    from gsc_direct import GSCDirectMode
+                mode = GSCDirectMode(st.session_state, get_gsc_sites)
+            elif current_mode == "📊 BigQuery":
+                # Carica modalità BigQuery
+                with tracing.span('import.mode'):
+                    from bigquery_mode import BigQueryMode
+                mode = BigQueryMode(st.session_state)
+            else:
+                # Modalità automatica: sceglie GSC Diretta o BigQuery per ogni domanda
+                with tracing.span('import.mode'):
+                    from auto_mode import AutoMode
+                mode = AutoMode(st.session_state, get_gsc_sites)
+
+            if st.session_state.get('enable_profiling', False):
+                render_profiled(mode)
+            else:
+                mode.render()
+
+        render_trace_debug(trace)
 
     # Footer
     st.markdown("---")
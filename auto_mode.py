@@ -0,0 +1,79 @@
+from ui import st
+
+import tracing
+from answer_store import Answer, ConversationStore
+from bigquery_mode import BigQueryMode
+from gsc_direct import GSCDirectMode
+from mode_router import RouteDecision, choose_mode, profile_question
+
+
+class AutoMode:
+    """Modalità automatica: per ogni domanda sceglie tra GSC Diretta e BigQuery"""
+
+    def __init__(self, session_state, get_gsc_sites_func):
+        self.session_state = session_state
+        self.modes = {
+            'gsc': GSCDirectMode(session_state, get_gsc_sites_func),
+            'bigquery': BigQueryMode(session_state),
+        }
+
+    def route(self, question: str) -> RouteDecision:
+        """Stima tempi, byte e completezza per entrambe le modalità e sceglie"""
+        with tracing.span('route') as sp:
+            profile = profile_question(question)
+            decision = choose_mode(
+                self.modes['gsc'].estimate_route(profile),
+                self.modes['bigquery'].estimate_route(question),
+            )
+            sp.set(mode=decision.mode)
+        return decision
+
+    def render(self):
+        """Renderizza l'interfaccia della modalità automatica"""
+
+        # Entrambe le configurazioni nella sidebar: BigQuery è facoltativa
+        with st.sidebar:
+            gsc_ok = self.modes['gsc'].render_sidebar_config()
+            st.markdown("---")
+            bq_ok = self.modes['bigquery'].render_sidebar_config()
+
+        if not (gsc_ok or bq_ok):
+            st.markdown("""
+            ## ⚙️ Configurazione Richiesta
+
+            Configura almeno Google Search Console nella sidebar. Applicando anche la
+            configurazione BigQuery, ogni domanda viene indirizzata alla fonte più rapida
+            o più completa.
+            """)
+            return
+
+        with st.form(key='auto_query_form'):
+            user_question_input = st.text_area(
+                "La tua domanda sui dati GSC:",
+                height=100,
+                placeholder="Es. Quali sono le top 10 query per clic negli ultimi 7 giorni?",
+                key="auto_user_question"
+            )
+            submit_button_main = st.form_submit_button(label="Analizza 🧭")
+
+        store = ConversationStore(self.session_state)
+        if submit_button_main and user_question_input:
+            with st.spinner("🤖💬 Scelgo la modalità più adatta alla domanda..."):
+                decision = self.route(user_question_input)
+            if decision.mode is None:
+                st.error(f"🤖💬 {decision.describe()}")
+                return
+            store.add(Answer(mode=decision.mode, question=user_question_input, route=decision))
+
+        routed = [answer for answer in store.answers if answer.route is not None]
+        if not routed:
+            return
+        answer = routed[-1]
+        self._render_route(answer.route)
+        return self.modes[answer.mode].show_answer(answer)
+
+    def _render_route(self, decision: RouteDecision):
+        st.info(f"🧭 {decision.describe()}")
+        with st.expander("Stime per modalità", expanded=False):
+            for estimate in decision.estimates.values():
+                st.caption(estimate.describe())
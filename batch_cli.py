@@ -0,0 +1,365 @@
+"""CLI headless: esegue set di domande su più proprietà senza Streamlit.
+
+Riutilizza la logica di fetch, analisi e grafici di GSCDirectMode e
+BigQueryMode. I siti vengono distribuiti su un pool di processi; i dati
+recuperati sono condivisi tra le domande dello stesso sito e, tramite una
+cache su disco, tra i processi e tra esecuzioni successive.
+
+Esempio:
+    python batch_cli.py weekly.yaml --workers 4 --output-dir reports
+
+File di job (YAML o JSON):
+    mode: gsc                      # oppure: bigquery
+    refresh_token: "..."           # oppure variabile GOOGLE_REFRESH_TOKEN
+    sites:
+      - https://www.example.com/
+    gsc:
+      date_range: Ultimi 28 giorni # oppure start_date / end_date, compare_type
+      dimensions: [query, page]
+      row_limit: 5000
+    questions:
+      - Quali sono le 10 query con più clic?
+    charts: true
+    outputs: [markdown, html, png]
+
+In modalità bigquery ogni voce di `sites` è un dizionario con
+project_id, dataset_id, tables (separate da virgola) e location.
+"""
+import argparse
+import html
+import json
+import logging
+import os
+import pickle
+import re
+import sys
+import time
+import tomllib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import ui
+from single_flight import fingerprint
+
+DEFAULT_OUTPUTS = ['markdown', 'html', 'png']
+SECRETS_PATH = os.path.join(".streamlit", "secrets.toml")
+
+logger = logging.getLogger("chatgsc.batch")
+
+
+def load_job(path: str) -> dict:
+    """Legge il file di job (YAML se l'estensione è .yaml/.yml, altrimenti JSON)"""
+    with open(path, encoding="utf-8") as f:
+        if path.endswith((".yaml", ".yml")):
+            import yaml
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+def load_secrets(job: dict) -> dict:
+    """Segreti da .streamlit/secrets.toml, sovrascritti da quelli del job"""
+    secrets = {}
+    if os.path.exists(SECRETS_PATH):
+        with open(SECRETS_PATH, "rb") as f:
+            secrets.update(tomllib.load(f))
+    secrets.update(job.get('secrets', {}))
+    return secrets
+
+
+def slugify(value: str) -> str:
+    return re.sub(r'[^a-z0-9]+', '-', value.lower()).strip('-') or "sito"
+
+
+class DiskCache:
+    """Cache di DataFrame su disco condivisa tra i processi del pool"""
+
+    def __init__(self, path: str | None):
+        self.path = path
+        if path:
+            os.makedirs(path, exist_ok=True)
+
+    def get_or_compute(self, key: str, func):
+        if not self.path:
+            return func()
+        file_path = os.path.join(self.path, key + ".pkl")
+        if os.path.exists(file_path):
+            with open(file_path, "rb") as f:
+                return pickle.load(f)
+        value = func()
+        if value is not None:
+            tmp_path = f"{file_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump(value, f)
+            os.replace(tmp_path, file_path)
+        return value
+
+
+def _init_worker(secrets: dict, log_level: int):
+    logging.basicConfig(level=log_level, format="%(processName)s %(levelname)s %(message)s")
+    ui.use_headless(secrets)
+    import matplotlib
+    matplotlib.use("Agg")
+
+
+def _session(job: dict) -> ui.HeadlessSessionState:
+    state = ui.HeadlessSessionState(
+        authenticated=True,
+        access_token=None,
+        refresh_token=job.get('refresh_token') or os.getenv("GOOGLE_REFRESH_TOKEN"),
+        enable_chart_generation=job.get('charts', True),
+    )
+    ui.st.session_state = state
+    return state
+
+
+def _save_chart(mode_generate, df, chart_path: str) -> str | None:
+    """Genera ed esegue il codice del grafico, salvando il PNG"""
+    import matplotlib.pyplot as plt
+    from charts import execute_chart_code
+
+    chart_code = mode_generate()
+    if not chart_code:
+        return None
+    fig = execute_chart_code(chart_code, df)
+    if fig is None:
+        return None
+    fig.savefig(chart_path, dpi=120, bbox_inches="tight")
+    plt.close(fig)
+    return os.path.basename(chart_path)
+
+
+def _run_gsc_site(job: dict, site: str, site_dir: str, cache: DiskCache) -> list[dict]:
+    from gsc_direct import GSCDirectMode
+
+    session = _session(job)
+    mode = GSCDirectMode(session, lambda: [])
+    cfg = job.get('gsc', {})
+    dimensions = cfg.get('dimensions', ['query'])
+    row_limit = cfg.get('row_limit', 1000)
+
+    if cfg.get('compare_type'):
+        (start, end), (prev_start, prev_end) = mode._get_compare_ranges(cfg['compare_type'])
+    else:
+        prev_start = prev_end = None
+        if cfg.get('start_date') and cfg.get('end_date'):
+            start, end = cfg['start_date'], cfg['end_date']
+        else:
+            start_ts, end_ts = mode._get_fixed_range(cfg.get('date_range', "Ultimi 28 giorni"))
+            start, end = start_ts.strftime('%Y-%m-%d'), end_ts.strftime('%Y-%m-%d')
+
+    def fetch():
+        if prev_start:
+            return mode.fetch_comparison_data(site, start, end, prev_start, prev_end, dimensions, row_limit)
+        return mode.fetch_gsc_data(site, start, end, dimensions, row_limit)
+
+    # Un solo fetch per sito, condiviso da tutte le domande
+    key = fingerprint('gsc', session.refresh_token, site, start, end, prev_start, prev_end, dimensions, row_limit)
+    df = cache.get_or_compute(key, fetch)
+
+    answers = []
+    for i, question in enumerate(job['questions']):
+        answer = {'question': question, 'sql': None, 'summary': None, 'chart': None, 'rows': 0}
+        if df is None or df.empty:
+            answer['summary'] = "Nessun dato disponibile per il sito e il periodo indicati."
+        else:
+            answer['rows'] = len(df)
+            answer['summary'] = mode.generate_dataframe_analysis(question, df)
+            if job.get('charts', True):
+                answer['chart'] = _save_chart(
+                    lambda: mode.generate_chart_code_with_llm(question, df),
+                    df, os.path.join(site_dir, f"chart_{i + 1}.png")
+                )
+        answers.append(answer)
+    return answers
+
+
+def _run_bigquery_site(job: dict, site: dict, site_dir: str, cache: DiskCache) -> list[dict]:
+    from bigquery_mode import BigQueryMode
+    from sql_analysis import is_volatile, normalize_sql
+
+    session = _session(job)
+    mode = BigQueryMode(session)
+    project_id = site['project_id']
+    location = site.get('location', 'EU')
+    if not mode.setup_gcp_credentials_from_oauth():
+        raise RuntimeError("Impossibile configurare le credenziali GCP")
+    schema = mode.get_table_schema_for_prompt(project_id, site['dataset_id'], site['tables'])
+    if not schema:
+        raise RuntimeError("Schema delle tabelle non disponibile")
+    session.selected_project_id = project_id
+    session.gcp_location = location
+    session.table_schema_for_prompt = schema
+
+    answers = []
+    for i, question in enumerate(job['questions']):
+        answer = {'question': question, 'sql': None, 'summary': None, 'chart': None, 'rows': 0}
+        # Stessi esempi, dry-run e budget di byte dell'app
+        sql, sql_details = mode.prepare_sql(question)
+        answer['sql'] = sql
+        df = None
+        if sql:
+            # Come la cache risultati dell'app: SQL normalizzata e, con CURRENT_DATE() & co., il giorno
+            day = time.strftime('%Y-%m-%d') if is_volatile(sql) else None
+            key = fingerprint('bigquery', session.refresh_token, project_id, normalize_sql(sql), day)
+            df = cache.get_or_compute(key, lambda: mode.execute_bigquery_query(project_id, sql))
+        if df is None:
+            answer['summary'] = "Non è stato possibile generare o eseguire la query."
+        elif df.empty:
+            answer['summary'] = "La query non ha restituito risultati."
+        else:
+            if not sql_details.get('example') and not sql_details.get('template'):
+                mode.remember_sql_example(question, sql)
+            answer['rows'] = len(df)
+            answer['summary'] = mode.summarize_results_with_llm(
+                project_id, location, mode.OPENAI_MODEL, df, question
+            )
+            if job.get('charts', True):
+                answer['chart'] = _save_chart(
+                    lambda: mode.generate_chart_code_with_llm(
+                        project_id, location, mode.OPENAI_MODEL, question, sql, df
+                    ),
+                    df, os.path.join(site_dir, f"chart_{i + 1}.png")
+                )
+        answers.append(answer)
+    return answers
+
+
+def render_markdown(title: str, answers: list[dict]) -> str:
+    parts = [f"# {title}", ""]
+    for answer in answers:
+        parts += [f"## {answer['question']}", ""]
+        if answer['sql']:
+            parts += ["```sql", answer['sql'], "```", ""]
+        parts += [answer['summary'] or "_Nessuna risposta._", ""]
+        if answer['chart']:
+            parts += [f"![Grafico]({answer['chart']})", ""]
+    return "\n".join(parts)
+
+
+def _inline_html(text: str) -> str:
+    return re.sub(r"\*\*(.+?)\*\*", r"<strong>\1</strong>", html.escape(text))
+
+
+def render_html(title: str, answers: list[dict]) -> str:
+    body = [f"<h1>{html.escape(title)}</h1>"]
+    for answer in answers:
+        body.append(f"<h2>{html.escape(answer['question'])}</h2>")
+        if answer['sql']:
+            body.append(f"<pre><code>{html.escape(answer['sql'])}</code></pre>")
+        in_list = False
+        for line in (answer['summary'] or "Nessuna risposta.").splitlines():
+            stripped = line.strip()
+            if stripped.startswith(("- ", "* ")):
+                if not in_list:
+                    body.append("<ul>")
+                    in_list = True
+                body.append(f"<li>{_inline_html(stripped[2:])}</li>")
+                continue
+            if in_list:
+                body.append("</ul>")
+                in_list = False
+            if stripped:
+                body.append(f"<p>{_inline_html(stripped)}</p>")
+        if in_list:
+            body.append("</ul>")
+        if answer['chart']:
+            body.append(f'<img src="{html.escape(answer["chart"])}" alt="Grafico" style="max-width:100%">')
+    return (
+        "<!DOCTYPE html>\n<html lang=\"it\"><head><meta charset=\"utf-8\">"
+        f"<title>{html.escape(title)}</title></head><body>\n" + "\n".join(body) + "\n</body></html>\n"
+    )
+
+
+def run_site(job: dict, site, output_dir: str, cache_dir: str | None) -> dict:
+    """Esegue tutte le domande del job per un sito e scrive i report"""
+    start = time.perf_counter()
+    label = site if isinstance(site, str) else f"{site['project_id']}.{site['dataset_id']}"
+    site_dir = os.path.join(output_dir, slugify(label))
+    os.makedirs(site_dir, exist_ok=True)
+    cache = DiskCache(cache_dir)
+    outputs = job.get('outputs', DEFAULT_OUTPUTS)
+    if 'png' not in outputs:
+        job = {**job, 'charts': False}
+
+    try:
+        if job.get('mode', 'gsc') == 'bigquery':
+            answers = _run_bigquery_site(job, site, site_dir, cache)
+        else:
+            answers = _run_gsc_site(job, site, site_dir, cache)
+        error = None
+    except Exception as e:
+        answers, error = [], str(e)
+
+    title = f"ChatGSC – {label}"
+    if 'markdown' in outputs:
+        with open(os.path.join(site_dir, "report.md"), "w", encoding="utf-8") as f:
+            f.write(render_markdown(title, answers))
+    if 'html' in outputs:
+        with open(os.path.join(site_dir, "report.html"), "w", encoding="utf-8") as f:
+            f.write(render_html(title, answers))
+
+    return {
+        'site': label,
+        'dir': site_dir,
+        'questions': len(answers),
+        'error': error,
+        'elapsed_s': time.perf_counter() - start,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Esecuzione batch di domande ChatGSC su più siti")
+    parser.add_argument("job", help="File di job YAML o JSON")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2, help="Processi in parallelo")
+    parser.add_argument("--output-dir", default="reports")
+    parser.add_argument("--cache-dir", default=os.path.join(".cache", "chatgsc"), help="Cache su disco condivisa ('' per disattivarla)")
+    parser.add_argument("--verbose", action="store_true")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    log_level = logging.INFO if args.verbose else logging.WARNING
+    logging.basicConfig(level=log_level, format="%(levelname)s %(message)s")
+
+    job = load_job(args.job)
+    if not job.get('sites') or not job.get('questions'):
+        print("Il job deve contenere 'sites' e 'questions'.", file=sys.stderr)
+        return 2
+    secrets = load_secrets(job)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    start = time.perf_counter()
+    results = []
+    with ProcessPoolExecutor(
+        max_workers=max(1, min(args.workers, len(job['sites']))),
+        initializer=_init_worker,
+        initargs=(secrets, log_level),
+    ) as pool:
+        futures = [
+            pool.submit(run_site, job, site, args.output_dir, args.cache_dir or None)
+            for site in job['sites']
+        ]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            status = f"ERRORE: {result['error']}" if result['error'] else f"{result['questions']} domande"
+            print(f"[{len(results)}/{len(futures)}] {result['site']}: {status} ({result['elapsed_s']:.1f}s)")
+    elapsed = time.perf_counter() - start
+
+    answered = sum(r['questions'] for r in results)
+    with open(os.path.join(args.output_dir, "index.md"), "w", encoding="utf-8") as f:
+        f.write("# Report ChatGSC\n\n")
+        for r in sorted(results, key=lambda r: r['site']):
+            link = os.path.relpath(os.path.join(r['dir'], "report.md"), args.output_dir)
+            suffix = f" – errore: {r['error']}" if r['error'] else ""
+            f.write(f"- [{r['site']}]({link}){suffix}\n")
+
+    print(
+        f"\n{answered} domande su {len(results)} siti in {elapsed:.1f}s "
+        f"({answered / elapsed if elapsed else 0:.2f} domande/s, {len(results) / elapsed if elapsed else 0:.2f} siti/s)"
+    )
+    return 1 if any(r['error'] for r in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,202 @@
+"""Load test di sessioni Streamlit concorrenti contro gli stand-in locali.
+
+Ogni sessione simulata esegue `app.py` tramite `streamlit.testing.v1.AppTest`
+con login già completato, poi clicca le domande preimpostate in modalità GSC
+e/o BigQuery. Per ogni livello di concorrenza misura latenze per domanda,
+RSS del processo, numero di thread e throughput.
+
+Esempio:
+    python -m benchmarks.load_test --sessions 1,5,10,20 --questions 3 --llm-latency-ms 300
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import matplotlib
+
+matplotlib.use("Agg")
+
+from benchmarks import stubs
+from benchmarks.run_benchmarks import percentile
+
+APP_PATH = os.path.join(ROOT, "app.py")
+GSC_MODE = "🔍 Google Search Console"
+BQ_MODE = "📊 BigQuery"
+
+
+def process_rss_bytes() -> int:
+    """RSS corrente del processo (psutil se disponibile, altrimenti /proc)"""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/status", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class ResourceMonitor:
+    """Campiona periodicamente RSS e numero di thread, tenendo i massimi"""
+
+    def __init__(self, interval: float = 0.1):
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_threads = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while True:
+            self.peak_rss = max(self.peak_rss, process_rss_bytes())
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+            if self.stop_event.wait(self.interval):
+                return
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop_event.set()
+        self.thread.join()
+        return False
+
+
+def new_session(timeout: float):
+    """AppTest con login OAuth già completato"""
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+    for key, value in stubs.STUB_SECRETS.items():
+        at.secrets[key] = value
+    session = stubs.authenticated_session()
+    for key, value in session.items():
+        at.session_state[key] = value
+    at.run()
+    return at
+
+
+def switch_to_bigquery(at):
+    at.radio(key="analysis_mode_selector").set_value(BQ_MODE).run()
+    at.text_input(key="bq_project_id").input("bench-project")
+    at.text_input(key="bq_dataset").input("searchconsole")
+    at.button(key="apply_config_bq").click().run()
+
+
+def run_session(index: int, modes: list[str], questions: int, timeout: float, latencies: list, errors: list):
+    """Una sessione utente: login, poi domande preimpostate nelle modalità richieste"""
+    try:
+        at = new_session(timeout)
+        for mode in modes:
+            if mode == BQ_MODE:
+                switch_to_bigquery(at)
+                prefix = "bq_preset_q_"
+            else:
+                at.radio(key="analysis_mode_selector").set_value(GSC_MODE).run()
+                prefix = "gsc_preset_q_"
+            for q in range(questions):
+                start = time.perf_counter()
+                at.button(key=f"{prefix}{q}").click().run()
+                latencies.append((mode, time.perf_counter() - start))
+            if at.exception:
+                errors.append(f"sessione {index}: {at.exception[0].message}")
+    except Exception as e:
+        errors.append(f"sessione {index}: {e}")
+
+
+def run_level(sessions: int, modes: list[str], questions: int, timeout: float) -> dict:
+    latencies, errors = [], []
+    threads = [
+        threading.Thread(target=run_session, args=(i, modes, questions, timeout, latencies, errors))
+        for i in range(sessions)
+    ]
+    with ResourceMonitor() as monitor:
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+
+    ordered = sorted(seconds for _, seconds in latencies)
+    return {
+        'sessions': sessions,
+        'questions': len(latencies),
+        'errors': len(errors),
+        'error_samples': errors[:3],
+        'elapsed_s': elapsed,
+        'throughput_qps': len(latencies) / elapsed if elapsed > 0 else 0.0,
+        'p50_ms': percentile(ordered, 50) * 1000,
+        'p95_ms': percentile(ordered, 95) * 1000,
+        'p99_ms': percentile(ordered, 99) * 1000,
+        'peak_rss_mb': monitor.peak_rss / (1024 * 1024),
+        'peak_threads': monitor.peak_threads,
+    }
+
+
+def format_table(results: list[dict]) -> str:
+    header = f"{'sessioni':>9}{'domande':>9}{'errori':>8}{'q/s':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'RSS MB':>9}{'thread':>8}"
+    lines = [header, "-" * len(header)]
+    for r in results:
+        lines.append(
+            f"{r['sessions']:>9}{r['questions']:>9}{r['errors']:>8}{r['throughput_qps']:>8.2f}"
+            f"{r['p50_ms']:>10.1f}{r['p95_ms']:>10.1f}{r['p99_ms']:>10.1f}"
+            f"{r['peak_rss_mb']:>9.1f}{r['peak_threads']:>8}"
+        )
+    return "\n".join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load test di sessioni concorrenti di ChatGSC")
+    parser.add_argument("--sessions", default="1,5,10,20", help="Livelli di concorrenza separati da virgola")
+    parser.add_argument("--modes", default="gsc,bq", help="Modalità da esercitare: gsc, bq")
+    parser.add_argument("--questions", type=int, default=3, help="Domande preimpostate per modalità")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Timeout per singolo run dello script")
+    parser.add_argument("--gsc-latency-ms", type=float, default=150.0)
+    parser.add_argument("--bq-latency-ms", type=float, default=800.0)
+    parser.add_argument("--llm-latency-ms", type=float, default=1500.0)
+    parser.add_argument("--json", dest="json_path", help="Salva i risultati in JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> list[dict]:
+    args = parse_args(argv)
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+    stubs.install(
+        gsc_latency=args.gsc_latency_ms / 1000,
+        bq_latency=args.bq_latency_ms / 1000,
+        llm_latency=args.llm_latency_ms / 1000,
+    )
+    mode_names = {'gsc': GSC_MODE, 'bq': BQ_MODE}
+    modes = [mode_names[m.strip()] for m in args.modes.split(",") if m.strip()]
+
+    results = []
+    for level in [int(n) for n in args.sessions.split(",") if n.strip()]:
+        results.append(run_level(level, modes, args.questions, args.timeout))
+        print(f"Livello {level} sessioni completato in {results[-1]['elapsed_s']:.1f}s", file=sys.stderr)
+    print(format_table(results))
+    for r in results:
+        for error in r['error_samples']:
+            print(f"  {error}", file=sys.stderr)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+"""Benchmark offline di ChatGSC con stand-in locali per GSC, BigQuery e OpenAI.
+
+Esempio:
+    python -m benchmarks.run_benchmarks --sizes 100,1000,10000 --iterations 20
+    python -m benchmarks.run_benchmarks --scenarios gsc_fetch,chart_exec --json bench.json
+"""
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import matplotlib
+
+matplotlib.use("Agg")
+
+from benchmarks import stubs
+
+SITE_URL = "https://www.example0.com/"
+PROJECT_ID = "bench-project"
+DATASET_ID = "searchconsole"
+TABLES = "searchdata_url_impression,searchdata_site_impression"
+QUESTION = "Quali sono le 10 query con più clic?"
+# Domanda rapida eseguita sulla copia locale (scenario local_query)
+LOCAL_QUESTION = "Quali sono le top 10 query per clic negli ultimi 7 giorni?"
+
+
+class BenchContext:
+    """Modalità dell'app costruite sugli stand-in, condivise tra gli scenari"""
+
+    def __init__(self):
+        from gsc_direct import GSCDirectMode
+        from bigquery_mode import BigQueryMode
+
+        self.session_state = stubs.authenticated_session()
+        self.gsc_mode = GSCDirectMode(self.session_state, lambda: [])
+        self.bq_mode = BigQueryMode(self.session_state)
+        self.frames = {}
+        self.mirrors = {}
+
+    def frame(self, size: int):
+        if size not in self.frames:
+            self.frames[size] = stubs.synthetic_dataframe(size)
+        return self.frames[size]
+
+    def mirror(self, size: int):
+        """Copia locale dell'export sintetico con size righe per giorno (sincronizzata una volta)"""
+        if size not in self.mirrors:
+            from local_mirror import LocalMirror
+
+            self.bq_mode.get_table_schema_for_prompt(PROJECT_ID, DATASET_ID, TABLES)
+            schema = self.session_state.bq_schema
+            directory = tempfile.TemporaryDirectory(prefix="chatgsc-mirror-")
+            mirror = LocalMirror(directory.name)
+            report = mirror.sync(stubs.StubBigQueryClient(PROJECT_ID, rows=size), schema)
+            assert not report.errors, report.errors
+            self.mirrors[size] = (directory, mirror, schema)
+        return self.mirrors[size][1:]
+
+
+def scenario_gsc_fetch(ctx: BenchContext, size: int):
+    df = ctx.gsc_mode.fetch_gsc_data(SITE_URL, "2025-01-01", "2025-01-28", ['query', 'page'], size)
+    assert df is not None and len(df) == size
+
+
+def scenario_gsc_comparison(ctx: BenchContext, size: int):
+    df = ctx.gsc_mode.fetch_comparison_data(
+        SITE_URL, "2025-01-01", "2025-01-28", "2024-12-04", "2024-12-31", ['query'], size
+    )
+    assert df is not None and len(df) == 2 * size
+
+
+def scenario_bq_schema(ctx: BenchContext, size: int):
+    schema = ctx.bq_mode.get_table_schema_for_prompt(PROJECT_ID, DATASET_ID, TABLES)
+    assert schema
+
+
+def scenario_prompt_build(ctx: BenchContext, size: int):
+    prompt = ctx.gsc_mode._build_analysis_prompt(QUESTION, ctx.frame(size))
+    assert prompt
+
+
+def scenario_bq_summary(ctx: BenchContext, size: int):
+    summary = ctx.bq_mode.summarize_results_with_llm(PROJECT_ID, "EU", "stub", ctx.frame(size), QUESTION)
+    assert summary
+
+
+def scenario_chart_exec(ctx: BenchContext, size: int):
+    import matplotlib.pyplot as plt
+    from charts import execute_chart_code
+
+    fig = execute_chart_code(stubs.STUB_CHART, ctx.frame(size))
+    assert fig is not None
+    plt.close(fig)
+
+
+def scenario_local_query(ctx: BenchContext, size: int):
+    from sql_templates import TEMPLATES_BY_QUESTION
+
+    mirror, schema = ctx.mirror(size)
+    sql = TEMPLATES_BY_QUESTION[LOCAL_QUESTION].render(schema)
+    query, reason = mirror.prepare(sql, schema)
+    assert query is not None, reason
+    df = mirror.run(query)
+    assert not df.empty
+
+
+# Moduli di cui misurare l'import a freddo (processo Python nuovo ad ogni iterazione)
+IMPORT_MODULES = [
+    'rate_limiter',
+    'tracing',
+    'clients',
+    'warmup',
+    'pandas',
+    'googleapiclient.discovery',
+    'openai',
+    'google.cloud.bigquery',
+    'matplotlib.pyplot',
+    'gsc_direct',
+    'bigquery_mode',
+]
+
+
+def scenario_cold_import(ctx: BenchContext, module: str):
+    # Il tempo misurato è quello dell'import, escluso l'avvio dell'interprete
+    code = (
+        "import time; t = time.perf_counter(); "
+        f"import {module}; "
+        "print(time.perf_counter() - t)"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True
+    )
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+# nome -> (funzione, varianti): 'sizes' = dimensioni dei dati, None = nessuna, lista = varianti fisse
+SCENARIOS = {
+    'gsc_fetch': (scenario_gsc_fetch, 'sizes'),
+    'gsc_comparison': (scenario_gsc_comparison, 'sizes'),
+    'bq_schema': (scenario_bq_schema, None),
+    'prompt_build': (scenario_prompt_build, 'sizes'),
+    'bq_summary': (scenario_bq_summary, 'sizes'),
+    'chart_exec': (scenario_chart_exec, 'sizes'),
+    'local_query': (scenario_local_query, 'sizes'),
+    'cold_import': (scenario_cold_import, IMPORT_MODULES),
+}
+
+
+def percentile(sorted_values: list[float], pct: float) -> float:
+    """Percentile con interpolazione lineare su valori già ordinati"""
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * pct / 100
+    lower = int(k)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (k - lower)
+
+
+def summarize(samples: list[float]) -> dict:
+    """Throughput e latenze percentili (ms) di una serie di campioni in secondi"""
+    ordered = sorted(samples)
+    total = sum(samples)
+    return {
+        'iterations': len(samples),
+        'throughput_ops': len(samples) / total if total > 0 else float('inf'),
+        'p50_ms': percentile(ordered, 50) * 1000,
+        'p95_ms': percentile(ordered, 95) * 1000,
+        'p99_ms': percentile(ordered, 99) * 1000,
+        'max_ms': ordered[-1] * 1000 if ordered else 0.0,
+    }
+
+
+def run_scenario(func, ctx: BenchContext, size, iterations: int, warmup: int) -> dict:
+    for _ in range(warmup):
+        func(ctx, size)
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        measured = func(ctx, size)
+        elapsed = time.perf_counter() - start
+        # Uno scenario può restituire la propria misura (es. import in un sottoprocesso)
+        samples.append(measured if isinstance(measured, float) else elapsed)
+    return summarize(samples)
+
+
+def format_table(results: list[dict]) -> str:
+    header = f"{'scenario':<16}{'size':>26}{'iter':>6}{'ops/s':>11}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+    lines = [header, "-" * len(header)]
+    for r in results:
+        size = str(r['size']) if r['size'] is not None else "-"
+        lines.append(
+            f"{r['scenario']:<16}{size:>26}{r['iterations']:>6}{r['throughput_ops']:>11.1f}"
+            f"{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}{r['p99_ms']:>10.2f}"
+        )
+    return "\n".join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark offline di ChatGSC")
+    from local_mirror import is_available
+
+    # local_query richiede duckdb e pyarrow: di default solo se installati
+    default_scenarios = [name for name in SCENARIOS if name != 'local_query' or is_available()]
+    parser.add_argument("--scenarios", default=",".join(default_scenarios), help="Scenari separati da virgola (cold_import: tempi di import)")
+    parser.add_argument("--sizes", default="100,1000,10000", help="Numero di righe per gli scenari sui dati")
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--gsc-latency-ms", type=float, default=0.0)
+    parser.add_argument("--bq-latency-ms", type=float, default=0.0)
+    parser.add_argument("--llm-latency-ms", type=float, default=0.0)
+    parser.add_argument("--gsc-fixture", help="Risposta searchanalytics registrata (JSON) da riprodurre")
+    parser.add_argument("--llm-fixture", help="Risposte LLM registrate (JSON) da riprodurre")
+    parser.add_argument("--json", dest="json_path", help="Salva i risultati in JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> list[dict]:
+    args = parse_args(argv)
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+
+    stubs.install(
+        gsc_latency=args.gsc_latency_ms / 1000,
+        bq_latency=args.bq_latency_ms / 1000,
+        llm_latency=args.llm_latency_ms / 1000,
+        gsc_fixture=args.gsc_fixture,
+        llm_fixture=args.llm_fixture,
+    )
+    ctx = BenchContext()
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+
+    results = []
+    for name in [s.strip() for s in args.scenarios.split(",") if s.strip()]:
+        if name not in SCENARIOS:
+            raise SystemExit(f"Scenario sconosciuto: {name}")
+        func, variants = SCENARIOS[name]
+        if variants == 'sizes':
+            variants = sizes
+        for size in (variants or [None]):
+            stats = run_scenario(func, ctx, size, args.iterations, args.warmup)
+            results.append({'scenario': name, 'size': size, **stats})
+
+    print(format_table(results))
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,511 @@
+"""Stand-in locali per Search Console, BigQuery e OpenAI.
+
+Replicano la forma delle risposte delle librerie client usate dall'app
+(googleapiclient, google-cloud-bigquery, openai 1.x) con latenza e dimensione
+del payload configurabili, oppure riproducono fixture JSON registrate.
+"""
+import datetime
+import json
+import random
+import time
+from types import SimpleNamespace
+
+import pandas as pd
+
+# Schema delle tabelle dell'export bulk di Search Console
+GSC_EXPORT_SCHEMAS = {
+    'searchdata_site_impression': [
+        ('data_date', 'DATE', "Giorno a cui si riferiscono i dati (partizione)"),
+        ('site_url', 'STRING', "URL della proprietà"),
+        ('query', 'STRING', "Query di ricerca"),
+        ('is_anonymized_query', 'BOOLEAN', "Query anonimizzata per privacy"),
+        ('country', 'STRING', "Paese (ISO 3166-1 alpha-3)"),
+        ('search_type', 'STRING', "Tipo di ricerca: web, image, video, news, discover, googleNews"),
+        ('device', 'STRING', "Dispositivo: DESKTOP, MOBILE, TABLET"),
+        ('impressions', 'INTEGER', "Impressioni"),
+        ('clicks', 'INTEGER', "Clic"),
+        ('sum_top_position', 'INTEGER', "Somma delle posizioni migliori (0-based)"),
+    ],
+    'searchdata_url_impression': [
+        ('data_date', 'DATE', "Giorno a cui si riferiscono i dati (partizione)"),
+        ('site_url', 'STRING', "URL della proprietà"),
+        ('url', 'STRING', "URL canonico della pagina"),
+        ('query', 'STRING', "Query di ricerca"),
+        ('is_anonymized_query', 'BOOLEAN', "Query anonimizzata per privacy"),
+        ('is_anonymized_discover', 'BOOLEAN', "Dato Discover anonimizzato"),
+        ('country', 'STRING', "Paese (ISO 3166-1 alpha-3)"),
+        ('search_type', 'STRING', "Tipo di ricerca: web, image, video, news, discover, googleNews"),
+        ('device', 'STRING', "Dispositivo: DESKTOP, MOBILE, TABLET"),
+        ('is_amp_top_stories', 'BOOLEAN', "Risultato AMP top stories"),
+        ('is_amp_blue_link', 'BOOLEAN', "Risultato AMP blue link"),
+        ('is_job_listing', 'BOOLEAN', "Risultato offerte di lavoro"),
+        ('is_job_details', 'BOOLEAN', "Dettaglio offerta di lavoro"),
+        ('is_tpf_qa', 'BOOLEAN', "Q&A"),
+        ('is_tpf_faq', 'BOOLEAN', "FAQ"),
+        ('is_tpf_howto', 'BOOLEAN', "How-to"),
+        ('is_weblite', 'BOOLEAN', "Web Light"),
+        ('is_action', 'BOOLEAN', "Azione"),
+        ('is_events_listing', 'BOOLEAN', "Elenco eventi"),
+        ('is_events_details', 'BOOLEAN', "Dettaglio evento"),
+        ('is_search_appearance_android_app', 'BOOLEAN', "App Android"),
+        ('is_amp_story', 'BOOLEAN', "Web story AMP"),
+        ('is_amp_image_result', 'BOOLEAN', "Immagine AMP"),
+        ('is_video', 'BOOLEAN', "Risultato video"),
+        ('is_organic_shopping', 'BOOLEAN', "Shopping organico"),
+        ('is_review_snippet', 'BOOLEAN', "Snippet recensioni"),
+        ('is_special_announcement', 'BOOLEAN', "Annuncio speciale"),
+        ('is_recipe_feature', 'BOOLEAN', "Ricetta (feature)"),
+        ('is_recipe_rich_snippet', 'BOOLEAN', "Ricetta (rich snippet)"),
+        ('is_subscribed_content', 'BOOLEAN', "Contenuto in abbonamento"),
+        ('is_page_experience', 'BOOLEAN', "Page experience"),
+        ('is_practice_problems', 'BOOLEAN', "Esercizi"),
+        ('is_math_solvers', 'BOOLEAN', "Math solver"),
+        ('is_translated_result', 'BOOLEAN', "Risultato tradotto"),
+        ('is_edu_q_and_a', 'BOOLEAN', "Q&A educativo"),
+        ('impressions', 'INTEGER', "Impressioni"),
+        ('clicks', 'INTEGER', "Clic"),
+        ('sum_position', 'INTEGER', "Somma delle posizioni (0-based)"),
+    ],
+}
+
+DEVICES = ['DESKTOP', 'MOBILE', 'TABLET']
+COUNTRIES = ['ita', 'usa', 'deu', 'fra', 'esp', 'gbr']
+APPEARANCES = ['WEBLITE', 'AMP_BLUE_LINK', 'VIDEO', 'REVIEW_SNIPPET']
+
+
+def _sleep(latency: float):
+    if latency > 0:
+        time.sleep(latency)
+
+
+def load_fixture(path: str):
+    """Carica una risposta registrata (JSON) da riprodurre"""
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def synthetic_dimension_value(dimension: str, i: int, rng: random.Random) -> str:
+    if dimension == 'query':
+        return f"query di esempio {i}"
+    if dimension == 'page':
+        return f"https://www.example.com/pagina-{i}"
+    if dimension == 'country':
+        return rng.choice(COUNTRIES)
+    if dimension == 'device':
+        return rng.choice(DEVICES)
+    if dimension == 'searchAppearance':
+        return rng.choice(APPEARANCES)
+    if dimension == 'date':
+        return (datetime.date.today() - datetime.timedelta(days=i % 480)).isoformat()
+    return f"{dimension}-{i}"
+
+
+def synthetic_gsc_rows(dimensions: list[str], rows: int, seed: int = 0) -> list[dict]:
+    """Righe nel formato della risposta searchanalytics.query"""
+    rng = random.Random(seed)
+    result = []
+    for i in range(rows):
+        impressions = rng.randint(1, 5000)
+        clicks = rng.randint(0, impressions)
+        result.append({
+            'keys': [synthetic_dimension_value(d, i, rng) for d in dimensions],
+            'clicks': clicks,
+            'impressions': impressions,
+            'ctr': clicks / impressions,
+            'position': round(rng.uniform(1, 60), 2),
+        })
+    return result
+
+
+def synthetic_dataframe(rows: int, seed: int = 0) -> pd.DataFrame:
+    """DataFrame GSC (query, page, metriche) come quelli prodotti dalle modalità"""
+    data = synthetic_gsc_rows(['query', 'page'], rows, seed)
+    return pd.DataFrame([
+        {
+            'query': r['keys'][0], 'page': r['keys'][1], 'clicks': r['clicks'],
+            'impressions': r['impressions'], 'ctr': r['ctr'], 'position': r['position'],
+        }
+        for r in data
+    ])
+
+
+# Giorni di ritardo dell'export bulk rispetto a oggi
+EXPORT_LAG_DAYS = 2
+
+
+def synthetic_export_rows(table_id: str, day: datetime.date, rows: int, seed: int = 0) -> list[dict]:
+    """Righe di un giorno dell'export bulk, con le colonne di GSC_EXPORT_SCHEMAS"""
+    rng = random.Random(hash((table_id, day.toordinal(), seed)) & 0xffffffff)
+    columns = GSC_EXPORT_SCHEMAS.get(table_id, GSC_EXPORT_SCHEMAS['searchdata_site_impression'])
+    result = []
+    for i in range(rows):
+        impressions = rng.randint(1, 500)
+        row = {}
+        for name, field_type, _ in columns:
+            if name == 'data_date':
+                row[name] = day
+            elif name == 'site_url':
+                row[name] = "sc-domain:example.com"
+            elif name == 'query':
+                row[name] = None if rng.random() < 0.1 else f"query di esempio {rng.randint(0, max(1, rows // 4))}"
+            elif name == 'url':
+                row[name] = f"https://www.example.com/pagina-{rng.randint(0, max(1, rows // 8))}"
+            elif name == 'country':
+                row[name] = rng.choice(COUNTRIES)
+            elif name == 'device':
+                row[name] = rng.choice(DEVICES)
+            elif name == 'search_type':
+                row[name] = rng.choice(['WEB', 'WEB', 'WEB', 'IMAGE', 'VIDEO', 'NEWS'])
+            elif name == 'impressions':
+                row[name] = impressions
+            elif name == 'clicks':
+                row[name] = rng.randint(0, impressions // 5)
+            elif name in ('sum_top_position', 'sum_position'):
+                row[name] = impressions * rng.randint(0, 40)
+            elif name == 'is_anonymized_query':
+                row[name] = row.get('query') is None
+            elif field_type == 'BOOLEAN':
+                row[name] = rng.random() < 0.02
+            else:
+                row[name] = None
+        result.append(row)
+    return result
+
+
+def synthetic_export_table(table_id: str, day: datetime.date, rows: int, seed: int = 0):
+    """Giorno dell'export come tabella Arrow (tipi come dalla Storage Read API)"""
+    import pyarrow as pa
+
+    types = {'DATE': pa.date32(), 'STRING': pa.string(), 'BOOLEAN': pa.bool_(), 'INTEGER': pa.int64()}
+    columns = GSC_EXPORT_SCHEMAS.get(table_id, GSC_EXPORT_SCHEMAS['searchdata_site_impression'])
+    schema = pa.schema([(name, types[field_type]) for name, field_type, _ in columns])
+    return pa.Table.from_pylist(synthetic_export_rows(table_id, day, rows, seed), schema=schema)
+
+
+class StubRowIterator:
+    """Equivalente di RowIterator di list_rows (una partizione dell'export)"""
+
+    def __init__(self, table_id: str, day: datetime.date, rows: int):
+        self.table_id = table_id
+        self.day = day
+        self.total_rows = rows
+
+    def to_arrow(self, bqstorage_client=None, **kwargs):
+        return synthetic_export_table(self.table_id, self.day, self.total_rows)
+
+    def to_dataframe(self, *args, **kwargs) -> pd.DataFrame:
+        return self.to_arrow().to_pandas()
+
+
+class _StubRequest:
+    """Equivalente di googleapiclient.http.HttpRequest: esegue con .execute()"""
+
+    def __init__(self, func):
+        self.func = func
+
+    def execute(self, num_retries: int = 0):
+        return self.func()
+
+
+class StubGSCService:
+    """Servizio 'searchconsole' v1 con searchanalytics().query() e sites().list()"""
+
+    def __init__(self, latency: float = 0.0, max_rows: int | None = None, fixture: str | None = None, sites: int = 5):
+        self.latency = latency
+        self.max_rows = max_rows
+        self.fixture = load_fixture(fixture) if fixture else None
+        self.site_count = sites
+
+    def searchanalytics(self):
+        return self
+
+    def sites(self):
+        return self
+
+    def query(self, siteUrl: str, body: dict):
+        return _StubRequest(lambda: self._search(siteUrl, body))
+
+    def list(self):
+        return _StubRequest(self._sites)
+
+    def _search(self, site_url: str, body: dict) -> dict:
+        _sleep(self.latency)
+        if self.fixture is not None:
+            return self.fixture
+        rows = body.get('rowLimit', 1000)
+        if self.max_rows is not None:
+            rows = min(rows, self.max_rows)
+        seed = hash((site_url, body.get('startDate'), tuple(body.get('dimensions', [])))) & 0xffff
+        return {'rows': synthetic_gsc_rows(body.get('dimensions', ['query']), rows, seed)}
+
+    def _sites(self) -> dict:
+        _sleep(self.latency)
+        return {'siteEntry': [
+            {'siteUrl': f"https://www.example{i}.com/", 'permissionLevel': 'siteOwner'}
+            for i in range(self.site_count)
+        ]}
+
+
+class StubSchemaField(SimpleNamespace):
+    """Equivalente minimale di bigquery.SchemaField"""
+
+
+class StubTable(SimpleNamespace):
+    """Equivalente minimale di bigquery.Table"""
+
+
+class StubTableRef(SimpleNamespace):
+    """Riferimento a tabella (project, dataset_id, table_id)"""
+
+
+class StubDatasetRef:
+    def __init__(self, project: str, dataset_id: str):
+        self.project = project
+        self.dataset_id = dataset_id
+
+    def table(self, table_id: str) -> StubTableRef:
+        return StubTableRef(project=self.project, dataset_id=self.dataset_id, table_id=table_id)
+
+
+class StubQueryJob:
+    """Job di query con risultato sintetico"""
+
+    def __init__(self, client, sql: str, job_config=None):
+        self.client = client
+        self.sql = sql
+        self.job_config = job_config
+        self.job_id = f"stub_job_{random.getrandbits(48):012x}"
+        self.state = 'DONE'
+        self.error_result = None
+        self.cache_hit = False
+        self.total_bytes_processed = client.rows * 64
+        self.total_bytes_billed = self.total_bytes_processed
+        self.destination = None
+        self.location = 'EU'
+        self.query_plan = []
+        self.created = self.started = datetime.datetime.now(datetime.timezone.utc)
+        self.client.jobs[self.job_id] = self
+
+    def done(self, *args, **kwargs) -> bool:
+        return True
+
+    def result(self, *args, **kwargs):
+        _sleep(self.client.latency)
+        return self
+
+    def to_dataframe(self, *args, **kwargs) -> pd.DataFrame:
+        self.result()
+        return synthetic_dataframe(self.client.rows, seed=len(self.sql))
+
+    @property
+    def total_rows(self) -> int:
+        return self.client.rows
+
+    @property
+    def schema(self) -> list:
+        return [SimpleNamespace(name=name) for name in synthetic_dataframe(1).columns]
+
+    def to_arrow_iterable(self, bqstorage_client=None, **kwargs):
+        """Record batch Arrow come dalla Storage Read API (batch da 1024 righe)"""
+        import pyarrow as pa
+
+        table = pa.Table.from_pandas(self.to_dataframe(), preserve_index=False)
+        yield from table.to_batches(max_chunksize=1024)
+
+
+class StubBigQueryClient:
+    """Stand-in di google.cloud.bigquery.Client (get_table, query, list_partitions, list_rows)"""
+
+    def __init__(self, project: str = None, credentials=None, latency: float = 0.0, rows: int = 1000,
+                 export_days: int = 30, **kwargs):
+        self.project = project
+        self.credentials = credentials
+        self.latency = latency
+        self.rows = rows  # righe dei risultati e di ogni giorno dell'export
+        self.export_days = export_days
+        self.jobs = {}
+
+    def dataset(self, dataset_id: str, project: str = None) -> StubDatasetRef:
+        return StubDatasetRef(project or self.project, dataset_id)
+
+    def get_table(self, table_ref) -> StubTable:
+        _sleep(self.latency)
+        if isinstance(table_ref, str):
+            project, dataset_id, table_id = table_ref.split('.')
+        else:
+            project, dataset_id, table_id = table_ref.project, table_ref.dataset_id, table_ref.table_id
+        columns = GSC_EXPORT_SCHEMAS.get(table_id, GSC_EXPORT_SCHEMAS['searchdata_site_impression'])
+        return StubTable(
+            project=project,
+            dataset_id=dataset_id,
+            table_id=table_id,
+            schema=[StubSchemaField(name=n, field_type=t, description=d, mode='NULLABLE') for n, t, d in columns],
+            num_rows=self.rows,
+            num_bytes=self.rows * 64,
+            etag=f"stub-{table_id}",
+            modified=datetime.datetime(2025, 1, 1, tzinfo=datetime.timezone.utc),
+            time_partitioning=SimpleNamespace(field='data_date', type_='DAY'),
+        )
+
+    def query(self, sql: str, job_config=None, **kwargs) -> StubQueryJob:
+        return StubQueryJob(self, sql, job_config)
+
+    def get_job(self, job_id: str, **kwargs) -> StubQueryJob:
+        return self.jobs[job_id]
+
+    def list_partitions(self, table) -> list[str]:
+        """Ultimi export_days giorni dell'export, con il ritardo tipico di EXPORT_LAG_DAYS"""
+        _sleep(self.latency)
+        latest = datetime.date.today() - datetime.timedelta(days=EXPORT_LAG_DAYS)
+        return [f"{latest - datetime.timedelta(days=i):%Y%m%d}" for i in range(self.export_days)]
+
+    def list_rows(self, table, selected_fields=None, start_index: int = 0, max_results: int | None = None, **kwargs):
+        """Righe di una partizione ('progetto.dataset.tabella$AAAAMMGG')"""
+        _sleep(self.latency)
+        name, _, decorator = str(table).partition('$')
+        day = datetime.datetime.strptime(decorator, '%Y%m%d').date() if decorator else datetime.date.today()
+        return StubRowIterator(name.split('.')[-1], day, self.rows)
+
+    def cancel_job(self, job_id: str, **kwargs) -> StubQueryJob:
+        job = self.jobs[job_id]
+        job.state = 'DONE'
+        return job
+
+    def close(self):
+        pass
+
+
+class _StubCompletions:
+    def __init__(self, owner):
+        self.owner = owner
+
+    def create(self, model: str = None, messages: list = None, **kwargs):
+        _sleep(self.owner.latency)
+        prompt = messages[-1]['content'] if messages else ""
+        content = self.owner.reply_for(prompt)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+            usage=SimpleNamespace(
+                prompt_tokens=len(prompt) // 4,
+                completion_tokens=len(content) // 4,
+                total_tokens=(len(prompt) + len(content)) // 4,
+            ),
+        )
+
+
+STUB_SQL = (
+    "SELECT query, SUM(clicks) AS clicks, SUM(impressions) AS impressions\n"
+    "FROM `{table}`\n"
+    "WHERE data_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 7 DAY)\n"
+    "GROUP BY query ORDER BY clicks DESC LIMIT 10"
+)
+
+STUB_CHART = """
+top_data = df.nlargest(10, 'clicks')
+fig, ax = plt.subplots(figsize=(10, 6))
+ax.barh(range(len(top_data)), top_data['clicks'])
+ax.set_title('Top 10 per clic')
+"""
+
+
+class StubOpenAI:
+    """Stand-in di openai.OpenAI con chat.completions.create"""
+
+    def __init__(self, api_key: str = None, latency: float = 0.0, fixture: str | None = None, **kwargs):
+        self.latency = latency
+        self.replies = load_fixture(fixture) if fixture else []
+        self.chat = SimpleNamespace(completions=_StubCompletions(self))
+
+    def reply_for(self, prompt: str) -> str:
+        # Le fixture sono una lista di {"match": "...", "content": "..."}
+        for reply in self.replies:
+            if reply.get('match', '') in prompt:
+                return reply['content']
+        if prompt.rstrip().endswith("SQL:"):
+            return STUB_SQL.format(table="project.dataset.searchdata_site_impression")
+        if "Matplotlib" in prompt:
+            return STUB_CHART
+        return "Nel periodo analizzato le **prime 10 query** generano la maggior parte dei clic."
+
+    def close(self):
+        pass
+
+
+class StubSessionState(dict):
+    """Session state con accesso sia per chiave che per attributo, come st.session_state"""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError as e:
+            raise AttributeError(name) from e
+
+    def __setattr__(self, name, value):
+        self[name] = value
+
+    def __delattr__(self, name):
+        del self[name]
+
+
+def authenticated_session(**extra) -> StubSessionState:
+    from google.auth.credentials import AnonymousCredentials
+
+    state = StubSessionState(
+        authenticated=True,
+        user_email="bench@example.com",
+        access_token="stub-access-token",
+        refresh_token="stub-refresh-token",
+        gcp_credentials=AnonymousCredentials(),
+        credentials_verified=True,
+        enable_chart_generation=False,
+        enable_tracing=False,
+    )
+    state.update(extra)
+    return state
+
+
+STUB_SECRETS = {
+    'openai_api_key': 'stub-openai-key',
+    'google_oauth_client_id': 'stub-client-id',
+    'google_oauth_client_secret': 'stub-client-secret',
+    'app_url': 'http://localhost:8501',
+}
+
+_originals = []
+
+
+def _patch(target, name: str, value):
+    _originals.append((target, name, getattr(target, name, None)))
+    setattr(target, name, value)
+
+
+def install(gsc_latency: float = 0.0, bq_latency: float = 0.0, llm_latency: float = 0.0,
+            bq_rows: int = 1000, gsc_max_rows: int | None = None,
+            gsc_fixture: str | None = None, llm_fixture: str | None = None):
+    """Sostituisce i client reali con gli stand-in locali nei moduli dell'app"""
+    import openai
+    import streamlit
+    from google.cloud import bigquery
+    from googleapiclient import discovery
+
+    import gsc_direct
+
+    def stub_build(*args, **kwargs):
+        return StubGSCService(gsc_latency, gsc_max_rows, gsc_fixture)
+
+    _patch(streamlit, 'secrets', dict(STUB_SECRETS))
+    _patch(discovery, 'build', stub_build)
+    _patch(gsc_direct, 'build', stub_build)
+    _patch(bigquery, 'Client', lambda *a, **k: StubBigQueryClient(*a, latency=bq_latency, rows=bq_rows, **k))
+    try:
+        from google.cloud import bigquery_storage
+        _patch(bigquery_storage, 'BigQueryReadClient', lambda *a, **k: SimpleNamespace(close=lambda: None))
+    except ImportError:
+        pass
+    _patch(openai, 'OpenAI', lambda *a, **k: StubOpenAI(*a, latency=llm_latency, fixture=llm_fixture, **k))
+
+
+def uninstall():
+    while _originals:
+        target, name, value = _originals.pop()
+        setattr(target, name, value)
@@ -1,14 +1,48 @@
-import streamlit as st
+from ui import st
 import pandas as pd
-import matplotlib.pyplot as plt
-import os
-import tempfile
-import json
-from google.cloud import bigquery
-import openai
+import time
 from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
 
+from rate_limiter import call_with_retry, user_key
+from single_flight import fingerprint, single_flight
+import tracing
+from answer_store import Answer, ConversationStore, timed
+from charts import execute_chart_code, figure_to_png
+from example_store import ExampleStore, format_examples, get_example_store
+from followups import CONTEXT_ANSWERS, apply_plan, contextual_question, plan_followup
+from mode_router import INSTANT_SECONDS, RouteEstimate, typical_seconds
+from clients import create_chat_completion, get_bigquery_client, get_bigquery_storage_client, get_openai_client
+import local_mirror
+from local_mirror import DEFAULT_MAX_AGE_HOURS, DEFAULT_MIRROR_DAYS, LocalMirror, get_local_mirror
+from schema_pruning import PrunedSchema, prune_schema
+from schema_cache import DatasetSchema, schema_cache
+import query_budget
+from result_cache import result_cache
+from result_pager import PAGED_RESULT_ROWS, SAMPLE_ROWS, ResultPager
+from sql_templates import PRESET_TEMPLATES, template_for_question
+from sql_analysis import (
+    DEFAULT_PARTITION_DAYS, MAX_REPAIR_ATTEMPTS, enforce_partition_filters, is_volatile,
+    normalize_sql, referenced_tables, validate_sql,
+)
+
+# Limiti al download dei risultati (configurabili con bq_max_result_rows / bq_max_result_mb)
+MAX_RESULT_ROWS = 100_000
+MAX_RESULT_MB = 256
+# Età massima della data di modifica delle tabelle usata nella chiave della cache risultati
+TABLE_VERSION_MAX_AGE_SECONDS = 60
+# Intervallo di polling dei job BigQuery (cresce fino al massimo)
+JOB_POLL_SECONDS = 0.5
+JOB_POLL_MAX_SECONDS = 2.0
+
+RESULT_SOURCE_LABELS = {
+    'cache': "⚡ Risultato dalla cache locale",
+    'bigquery_cache': "♻️ Risultato dalla cache di BigQuery (nessun byte fatturato)",
+    'bigquery': "🆕 Query eseguita su BigQuery",
+    'followup': "↪️ Derivato dal risultato precedente (nessuna query eseguita)",
+    'local': "🦆 Risultato dalla copia locale dell'export (DuckDB, nessun byte fatturato)",
+}
+
 class BigQueryMode:
     """Classe per gestire la modalità BigQuery Avanzata"""
     
@@ -16,13 +50,29 @@ class BigQueryMode:
         self.session_state = session_state
         self.OPENAI_MODEL = "o4-mini"
         self.openai_api_key = st.secrets.get("openai_api_key", None)
-        if self.openai_api_key:
-            self.openai_client = openai.OpenAI(api_key=self.openai_api_key)
-        else:
-            self.openai_client = None
-    
+        # Client OpenAI condiviso tra i rerun (pool HTTP keep-alive)
+        self.openai_client = get_openai_client(self.openai_api_key)
+
+    def _bigquery_client(self, project_id: str):
+        """Client BigQuery riusato tra i rerun per utente e progetto"""
+        return get_bigquery_client(
+            project_id, self.session_state.get('gcp_credentials'), user_key(self.session_state)
+        )
+
+    def _bigquery_storage_client(self):
+        """Client Storage Read API, o None se non disponibile (si ripiega su REST)"""
+        try:
+            return get_bigquery_storage_client(
+                self.session_state.get('gcp_credentials'), user_key(self.session_state)
+            )
+        except Exception:
+            return None
+
+    def _create_chat_completion(self, **kwargs):
+        return create_chat_completion(self.openai_client, user_key(self.session_state), **kwargs)
+
     def setup_gcp_credentials_from_oauth(self):
-        """Configura le credenziali GCP usando il token OAuth"""
+        """Crea le credenziali GCP della sessione dal token OAuth (nessun file né variabile d'ambiente)"""
         if not self.session_state.get('authenticated', False):
             return False
 
@@ -43,33 +93,20 @@ class BigQueryMode:
 
             # Aggiorna i token se necessario e salva l'oggetto credenziali
             if credentials.expired:
-                credentials.refresh(Request())
+                with tracing.span('credentials.refresh'):
+                    credentials.refresh(Request())
+            # Solo in memoria, per sessione: i client le ricevono esplicitamente
             self.session_state.gcp_credentials = credentials
 
-            # Salva le credenziali temporaneamente
-            temp_file = tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.json')
-            creds_info = {
-                'type': 'authorized_user',
-                'client_id': st.secrets.get("google_oauth_client_id"),
-                'client_secret': st.secrets.get("google_oauth_client_secret"),
-                'refresh_token': self.session_state.refresh_token,
-            }
-            
-            json.dump(creds_info, temp_file)
-            temp_file.close()
-            
-            os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = temp_file.name
-            self.session_state.temp_credentials_file = temp_file.name
-
             return True
             
         except Exception as e:
             st.error(f"Errore nella configurazione delle credenziali GCP: {e}")
             return False
 
-    def get_table_schema_for_prompt(self, project_id: str, dataset_id: str, table_names_str: str) -> str | None:
-        """Recupera lo schema delle tabelle BigQuery per il prompt"""
-        if not os.getenv("GOOGLE_APPLICATION_CREDENTIALS"): 
+    def get_table_schema(self, project_id: str, dataset_id: str, table_names_str: str) -> DatasetSchema | None:
+        """Recupera lo schema strutturato delle tabelle BigQuery (in parallelo, con cache)"""
+        if self.session_state.get('gcp_credentials') is None:
             st.error("🤖💬 Le credenziali GCP non sono state configurate.")
             return None
         if not project_id or not dataset_id or not table_names_str:
@@ -82,44 +119,35 @@ class BigQueryMode:
             return None
         
         try:
-            client = bigquery.Client(project=project_id, credentials=self.session_state.get('gcp_credentials'))
+            client = self._bigquery_client(project_id)
         except Exception as e:
             st.error(f"🤖💬 Impossibile inizializzare il client BigQuery: {e}. Verifica le credenziali e i permessi.")
             return None
-            
-        schema_prompt_parts = []
-        all_tables_failed = True
 
-        for table_name in table_names:
-            full_table_id = f"{project_id}.{dataset_id}.{table_name}"
-            try:
-                table_ref = client.dataset(dataset_id, project=project_id).table(table_name)
-                table = client.get_table(table_ref)
-                columns_desc = []
-                for schema_field in table.schema:
-                    description = f" (Descrizione: {schema_field.description})" if schema_field.description else ""
-                    columns_desc.append(f"  - {schema_field.name} ({schema_field.field_type}){description}")
-                
-                schema_prompt_parts.append(
-                    f"Tabella: `{full_table_id}`\nColonne:\n" + "\n".join(columns_desc)
-                )
-                all_tables_failed = False 
-            except Exception as e:
-                st.warning(f"Impossibile recuperare lo schema per la tabella {full_table_id}: {e}")
-                schema_prompt_parts.append(f"# Errore nel recupero schema per tabella: {full_table_id}")
+        schema = schema_cache.get(client, user_key(self.session_state), project_id, dataset_id, table_names)
+        for table_name, error in schema.errors.items():
+            st.warning(f"Impossibile recuperare lo schema per la tabella {project_id}.{dataset_id}.{table_name}: {error}")
 
-        if all_tables_failed and table_names: 
+        if not schema.tables: 
             st.error("Nessuno schema di tabella è stato recuperato con successo. Controlla i nomi delle tabelle, i permessi e la configurazione del progetto.")
             return None
-            
-        final_schema_prompt = "\n\n".join(schema_prompt_parts)
-        return final_schema_prompt
 
-    def generate_sql_from_question(self, project_id: str, location: str, model_name: str, question: str, table_schema_prompt: str, few_shot_examples_str: str) -> str | None:
-        """Genera query SQL da domanda in linguaggio naturale"""
-        if not os.getenv("GOOGLE_APPLICATION_CREDENTIALS"): 
-            st.error("🤖💬 Le credenziali GCP non sono state configurate.")
-            return None
+        # Riusato da validazione e pruning senza ulteriori chiamate di rete
+        self.session_state.bq_schema = schema
+        return schema
+
+    def get_table_schema_for_prompt(self, project_id: str, dataset_id: str, table_names_str: str) -> str | None:
+        """Recupera lo schema delle tabelle BigQuery per il prompt"""
+        schema = self.get_table_schema(project_id, dataset_id, table_names_str)
+        return schema.to_prompt() if schema else None
+
+    def generate_sql_from_question(self, project_id: str, location: str, model_name: str, question: str, table_schema_prompt: str, few_shot_examples_str: str, previous_sql: str | None = None, feedback: str | None = None, conversation: list[tuple[str, str]] | None = None) -> str | None:
+        """Genera query SQL da domanda in linguaggio naturale.
+
+        Con previous_sql e feedback chiede al modello di correggere una query rifiutata
+        (es. oltre il budget di byte). conversation, coppie (domanda, SQL) precedenti,
+        permette di rifinire l'ultima query per le domande di follow-up.
+        """
         if not all([project_id, location, model_name, question, table_schema_prompt]):
             st.error("🤖💬 Mancano alcuni parametri per la generazione SQL.")
             return None
@@ -139,6 +167,21 @@ class BigQueryMode:
             if few_shot_examples_str and few_shot_examples_str.strip(): 
                 prompt_parts.append("\nEcco alcuni esempi:")
                 prompt_parts.append(few_shot_examples_str)
+            if conversation:
+                prompt_parts.append("\nDomande precedenti della conversazione, con la SQL eseguita:")
+                for previous_question, sql in conversation:
+                    prompt_parts.extend([f"- Domanda: \"{previous_question}\"", f"  SQL: {sql}"])
+                prompt_parts.append(
+                    "Se la nuova domanda è un follow-up (es. 'e solo da mobile?'), modifica l'ultima query "
+                    "invece di scriverne una nuova."
+                )
+            if previous_sql and feedback:
+                prompt_parts.extend([
+                    "\nQuesta query generata in precedenza è stata rifiutata:",
+                    previous_sql,
+                    f"Motivo: {feedback}",
+                    "Riscrivila correggendo il problema e mantenendo la risposta alla domanda.",
+                ])
             prompt_parts.extend([
                 f"\nDomanda dell'utente: \"{question}\"",
                 "SQL:"
@@ -147,7 +190,7 @@ class BigQueryMode:
             if not self.openai_client:
                 st.error("Chiave OpenAI mancante.")
                 return None
-            response = self.openai_client.chat.completions.create(
+            response = self._create_chat_completion(
                 model=self.OPENAI_MODEL,
                 messages=[{"role": "user", "content": full_prompt}],
                 temperature=1,
@@ -167,35 +210,452 @@ class BigQueryMode:
             st.error(f"🤖💬 Errore durante la chiamata a OpenAI: {e}")
             return None
 
-    def execute_bigquery_query(self, project_id: str, sql_query: str) -> pd.DataFrame | None:
-        """Esegue query su BigQuery"""
-        if not os.getenv("GOOGLE_APPLICATION_CREDENTIALS"):
-            st.error("Le credenziali GCP non sono state configurate.")
+    def _read_results(self, rows, on_progress=None, max_rows: int | None = None) -> pd.DataFrame:
+        """Legge i risultati come record batch Arrow (Storage Read API, stream paralleli).
+
+        I batch sono convertiti in pandas uno alla volta e la lettura si ferma ai
+        limiti di righe e byte; il DataFrame troncato ha attrs['truncated'] = True.
+        on_progress(frames, righe, byte) è chiamata dopo ogni batch.
+        """
+        max_rows = max_rows or int(st.secrets.get('bq_max_result_rows', MAX_RESULT_ROWS))
+        max_bytes = int(float(st.secrets.get('bq_max_result_mb', MAX_RESULT_MB)) * 1024 * 1024)
+        bqstorage_client = self._bigquery_storage_client()
+
+        frames = []
+        rows_read = bytes_read = 0
+        with tracing.span('bq.read', storage_api=bqstorage_client is not None) as sp:
+            for batch in rows.to_arrow_iterable(bqstorage_client=bqstorage_client):
+                if batch.num_rows > max_rows - rows_read:
+                    batch = batch.slice(0, max_rows - rows_read)
+                frames.append(batch.to_pandas())
+                rows_read += batch.num_rows
+                bytes_read += batch.nbytes
+                if on_progress is not None:
+                    on_progress(frames, rows_read, bytes_read)
+                if rows_read >= max_rows or bytes_read >= max_bytes:
+                    break
+            sp.set(rows=rows_read, arrow_bytes=bytes_read, batches=len(frames))
+
+        if frames:
+            results_df = pd.concat(frames, ignore_index=True)
+        else:
+            results_df = pd.DataFrame(columns=[field.name for field in rows.schema])
+        total_rows = getattr(rows, 'total_rows', None)
+        results_df.attrs['truncated'] = total_rows is not None and rows_read < total_rows
+        results_df.attrs['total_rows'] = total_rows
+        return results_df
+
+    def _result_cache_key(self, client, project_id: str, sql_query: str) -> str | None:
+        """Chiave della cache risultati: SQL normalizzata + versione delle tabelle lette.
+
+        None se la query legge tabelle fuori dallo schema configurato (non memorizzabile).
+        """
+        schema = self.session_state.get('bq_schema')
+        table_names = referenced_tables(sql_query)
+        if schema is None or not table_names:
+            return None
+        tables = [schema.table(name) for name in table_names]
+        if any(t is None or (t.project_id, t.dataset_id) != (schema.project_id, schema.dataset_id) for t in tables):
+            return None
+        # Data di modifica recente: una nuova partizione dell'export cambia la chiave
+        current = schema_cache.get(
+            client, user_key(self.session_state), schema.project_id, schema.dataset_id,
+            [t.table_id for t in tables], max_age=TABLE_VERSION_MAX_AGE_SECONDS
+        )
+        if current.errors:
+            return None
+        versions = sorted((t.full_id, t.etag, str(t.modified)) for t in current.tables.values())
+        # CURRENT_DATE() & co. cambiano risultato ogni giorno
+        day = time.strftime('%Y-%m-%d') if is_volatile(sql_query) else None
+        return fingerprint('bq_result', project_id, normalize_sql(sql_query), versions, day)
+
+    def _local_mirror(self) -> LocalMirror | None:
+        """Copia locale dell'export (local_mirror_path nei secrets), se configurata e utilizzabile"""
+        root = st.secrets.get('local_mirror_path')
+        if not root or not local_mirror.is_available():
+            return None
+        return get_local_mirror(
+            root,
+            days=int(st.secrets.get('local_mirror_days', DEFAULT_MIRROR_DAYS)),
+            max_age_hours=float(st.secrets.get('local_mirror_max_age_hours', DEFAULT_MAX_AGE_HOURS)),
+        )
+
+    def _local_query(self, sql_query: str):
+        """Query DuckDB equivalente se la copia locale copre i giorni letti, altrimenti None"""
+        mirror = self._local_mirror()
+        if mirror is None:
+            return None
+        schema = self.session_state.get('bq_schema')
+        with tracing.span('mirror.prepare') as sp:
+            query, reason = mirror.prepare(sql_query, schema)
+            if query is not None:
+                # Le righe in locale sono di chi le ha sincronizzate: serve il permesso di lettura
+                user = user_key(self.session_state)
+                denied = [
+                    table_id for table_id in query.files
+                    if not mirror.can_read(
+                        user, schema.table(table_id).full_id, lambda table_id=table_id: self._can_read_data(table_id)
+                    )
+                ]
+                if denied:
+                    query, reason = None, f"nessun accesso ai dati di {', '.join(denied)}"
+            sp.set(local=query is not None, reason=reason)
+        return query
+
+    def _can_read_data(self, table_id: str) -> bool:
+        """Lettura di una riga della tabella (tabledata.list, non fatturata): False se negata"""
+        from google.api_core.exceptions import Forbidden, NotFound
+
+        table = self.session_state.bq_schema.table(table_id)
+        client = self._bigquery_client(table.project_id)
+        try:
+            call_with_retry(
+                lambda: list(client.list_rows(table.full_id, max_results=1)), 'bigquery', user=user_key(self.session_state)
+            )
+        except (Forbidden, NotFound):
+            return False
+        return True
+
+    def run_local_query(self, sql_query: str) -> pd.DataFrame | None:
+        """Esegue la query sulla copia locale; None se va eseguita su BigQuery"""
+        query = self._local_query(sql_query)
+        if query is None:
+            return None
+        mirror = self._local_mirror()
+        try:
+            results_df = mirror.run(query)
+        except Exception as e:
+            mirror.stats['fallback'] += 1
+            st.caption(f"🦆 Copia locale non utilizzabile ({e}): eseguo la query su BigQuery.")
+            return None
+        mirror.stats['local'] += 1
+        results_df.attrs['source'] = 'local'
+        self._set_result_pager(None)
+        return results_df
+
+    def _has_cached_result(self, project_id: str, sql_query: str) -> bool:
+        try:
+            cache_key = self._result_cache_key(self._bigquery_client(project_id), project_id, sql_query)
+        except Exception:
+            return False
+        return cache_key is not None and result_cache.contains(user_key(self.session_state), cache_key)
+
+    def _submit_or_reattach(self, client, project_id: str, sql_query: str, max_bytes_billed: int):
+        """Riaggancia il job della sessione per questa SQL, oppure ne avvia uno nuovo.
+
+        L'ID del job resta in session_state finché il risultato non è stato letto:
+        un rerun di Streamlit durante l'attesa riprende lo stesso job invece di
+        inviarne un altro.
+        """
+        active = self.session_state.get('bq_active_job')
+        if active and active['project_id'] == project_id and active['sql'] == sql_query:
+            try:
+                with tracing.span('bq.reattach', job_id=active['job_id']):
+                    job = client.get_job(active['job_id'], project=project_id, location=active['location'])
+                # Un job terminato con errore non va riagganciato: se ne invia uno nuovo
+                if not (job.state == 'DONE' and job.error_result):
+                    return job
+            except Exception:
+                pass
+            self.session_state.bq_active_job = None
+        elif active:
+            # Nuova domanda: il job precedente non serve più
+            self.cancel_active_job()
+
+        from google.cloud import bigquery
+
+        # BigQuery rifiuta la query se fatturerebbe più del limite
+        job_config = bigquery.QueryJobConfig(maximum_bytes_billed=max_bytes_billed)
+        with tracing.span('bq.submit'):
+            job = client.query(sql_query, job_config=job_config)
+        self.session_state.bq_active_job = {
+            'job_id': job.job_id,
+            'location': job.location,
+            'project_id': project_id,
+            'sql': sql_query,
+            'submitted_at': time.time(),
+        }
+        return job
+
+    @staticmethod
+    def job_progress(job) -> dict:
+        """Stato del job dal piano di esecuzione: fase corrente, avanzamento, byte"""
+        plan = list(getattr(job, 'query_plan', None) or [])
+        completed = sum(1 for stage in plan if stage.status == 'COMPLETE')
+        running = next((stage.name for stage in plan if stage.status == 'RUNNING'), None)
+        started = getattr(job, 'started', None) or getattr(job, 'created', None)
+        return {
+            'job_id': job.job_id,
+            'state': job.state,
+            'stage': running or (plan[-1].name if plan else None),
+            'fraction': completed / len(plan) if plan else 0.0,
+            'bytes_processed': job.total_bytes_processed,
+            'elapsed_s': time.time() - started.timestamp() if started else None,
+        }
+
+    def _wait_for_job(self, job, on_job_progress=None):
+        """Attende il job con polling, notificando l'avanzamento ad ogni giro"""
+        delay = JOB_POLL_SECONDS
+        with tracing.span('bq.wait', job_id=job.job_id):
+            while not job.done():
+                if on_job_progress is not None:
+                    on_job_progress(self.job_progress(job))
+                time.sleep(delay)
+                delay = min(delay * 1.5, JOB_POLL_MAX_SECONDS)
+
+    def cancel_active_job(self, answer: Answer | None = None):
+        """Annulla il job in corso della sessione (usata anche come callback del pulsante)"""
+        active = self.session_state.get('bq_active_job')
+        self.session_state.bq_active_job = None
+        if answer is not None and not answer.has('data'):
+            # La risposta non deve ripartire al rerun successivo
+            answer.fail('data', "⛔ Query annullata.")
+        if not active:
+            return
+        try:
+            client = self._bigquery_client(active['project_id'])
+            client.cancel_job(active['job_id'], project=active['project_id'], location=active['location'])
+        except Exception as e:
+            st.warning(f"🤖💬 Impossibile annullare il job {active['job_id']}: {e}")
+
+    def execute_bigquery_query(self, project_id: str, sql_query: str, on_progress=None, on_job_progress=None) -> pd.DataFrame | None:
+        """Esegue query su BigQuery.
+
+        on_job_progress riceve lo stato del job durante l'esecuzione, on_progress
+        l'avanzamento del download dei risultati.
+        """
+        if self.session_state.get('gcp_credentials') is None:
+            st.error("🤖💬 Le credenziali GCP non sono state configurate.")
             return None
         if not project_id or not sql_query:
             st.error("🤖💬 ID Progetto e query SQL sono necessari per l'esecuzione su BigQuery.")
             return None
+        local_df = self.run_local_query(sql_query)
+        if local_df is not None:
+            return local_df
         try:
-            client = bigquery.Client(project=project_id, credentials=self.session_state.get('gcp_credentials'))
-            query_job = client.query(sql_query)
-            results_df = query_job.to_dataframe() 
-            return results_df
+            client = self._bigquery_client(project_id)
+            user = user_key(self.session_state)
+            cache_key = self._result_cache_key(client, project_id, sql_query)
+            if cache_key is not None:
+                with tracing.span('bq.result_cache') as sp:
+                    cached_df = result_cache.get(user, cache_key)
+                    sp.set(hit=cached_df is not None)
+                if cached_df is not None:
+                    cached_df.attrs['source'] = 'cache'
+                    self._set_result_pager(None)
+                    return cached_df
+            max_bytes_billed = self._max_bytes_billed()
+
+            def run_query():
+                job = self._submit_or_reattach(client, project_id, sql_query, max_bytes_billed)
+                try:
+                    self._wait_for_job(job, on_job_progress)
+                    rows = job.result()
+                except Exception:
+                    # Il tentativo successivo di call_with_retry deve inviare un job nuovo
+                    self.session_state.bq_active_job = None
+                    raise
+                total_rows = rows.total_rows or 0
+                if total_rows > PAGED_RESULT_ROWS and job.destination is not None:
+                    # Risultato grande: si scarica solo un campione, il resto si sfoglia a pagine
+                    pager = ResultPager(client, job.destination, rows.schema, total_rows, user)
+                    sample_df = self._read_results(rows, on_progress, max_rows=SAMPLE_ROWS)
+                    sample_df.attrs['paged'] = True
+                    results_df = sample_df
+                else:
+                    pager = None
+                    results_df = self._read_results(rows, on_progress)
+                results_df.attrs['source'] = 'bigquery_cache' if job.cache_hit else 'bigquery'
+                return results_df, job.total_bytes_billed, pager
+
+            with tracing.span('bq.query') as sp:
+                (results_df, bytes_billed, pager), shared = single_flight.do(
+                    fingerprint('bigquery', user, project_id, normalize_sql(sql_query)),
+                    lambda: call_with_retry(run_query, 'bigquery', user=user)
+                )
+                self.session_state.bq_active_job = None
+                if not shared:
+                    query_budget.record_billed(self.session_state, bytes_billed)
+                # Il paginatore non si condivide: ogni sessione lo chiude quando cambia risultato
+                self._set_result_pager(None if shared else pager)
+                sp.set(
+                    rows=len(results_df),
+                    bytes=int(results_df.memory_usage(index=False).sum()),
+                    bytes_billed=bytes_billed,
+                    shared=shared
+                )
+            # I risultati paginati restano nella tabella di destinazione, non in cache
+            if cache_key is not None and pager is None and not shared:
+                result_cache.put(user, cache_key, results_df)
+            # Il DataFrame condiviso appartiene a un'altra sessione: lavoriamo su una copia
+            return results_df.copy() if shared else results_df
         except Exception as e:
+            # Un rerun di Streamlit non passa di qui: il job resta riagganciabile
+            self.session_state.bq_active_job = None
             st.error(f"🤖💬 Errore durante l'esecuzione della query BigQuery: {e}")
             return None
 
+    def _max_bytes_billed(self) -> int:
+        """Byte fatturabili ammessi per la prossima query (limite per query e residuo di sessione)"""
+        per_query, remaining, _ = query_budget.limits(self.session_state, st.secrets)
+        return max(1, min(per_query, remaining))
+
+    def dry_run_bytes(self, project_id: str, sql_query: str) -> int:
+        """Byte che la query elaborerebbe (dry-run, nessun costo)"""
+        client = self._bigquery_client(project_id)
+        user = user_key(self.session_state)
+
+        def dry_run():
+            from google.cloud import bigquery
+
+            job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+            return client.query(sql_query, job_config=job_config).total_bytes_processed
+
+        with tracing.span('bq.dry_run') as sp:
+            bytes_processed = call_with_retry(dry_run, 'bigquery', user=user)
+            sp.set(bytes_processed=bytes_processed)
+        return bytes_processed
+
+    def estimate_query_cost(self, project_id: str, sql_query: str) -> query_budget.CostEstimate | None:
+        """Dry-run della query: byte elaborati e costo stimato, confrontati con i limiti"""
+        try:
+            bytes_processed = self.dry_run_bytes(project_id, sql_query)
+            return query_budget.estimate(bytes_processed, self.session_state, st.secrets)
+        except Exception as e:
+            st.error(f"🤖💬 La query non ha superato il dry-run di BigQuery: {e}")
+            return None
+
+    def prune_partitions(self, sql_query: str) -> str:
+        """Garantisce un filtro su data_date per ogni scansione di tabella partizionata"""
+        default_days = int(st.secrets.get('bq_default_partition_days', DEFAULT_PARTITION_DAYS))
+        with tracing.span('sql.partitions') as sp:
+            report = enforce_partition_filters(sql_query, self.session_state.get('bq_schema'), default_days)
+            sp.set(scans=len(report.scans), rewritten=report.rewritten)
+        if report.rewritten:
+            st.info(f"🤖💬 Alla query mancava un filtro sulla data: l'ho limitata agli ultimi {default_days} giorni.")
+        if report.unpruned:
+            tables = ", ".join(f"`{scan.table.split('.')[-1]}`" for scan in report.unpruned)
+            st.warning(
+                f"🤖💬 Il filtro sulla data di {tables} non permette di escludere partizioni: "
+                "la query legge tutto lo storico. Usa confronti o BETWEEN su data_date per ridurre i byte."
+            )
+        st.caption(report.describe())
+        return report.sql
+
+    def _regenerate_sql(self, question: str, previous_sql: str, feedback: str) -> str | None:
+        """Rimanda al modello una query rifiutata insieme al motivo"""
+        return self.generate_sql_from_question(
+            self.session_state.selected_project_id,
+            self.session_state.get('gcp_location', 'europe-west1'),
+            self.OPENAI_MODEL,
+            question,
+            self.session_state.table_schema_for_prompt,
+            "",
+            previous_sql=previous_sql,
+            feedback=feedback,
+        )
+
+    def repair_sql(self, question: str, sql_query: str) -> str | None:
+        """Valida la SQL sullo schema in cache e la fa correggere al modello se non valida"""
+        schema = self.session_state.get('bq_schema')
+        for attempt in range(MAX_REPAIR_ATTEMPTS + 1):
+            with tracing.span('sql.validate', attempt=attempt) as sp:
+                errors = validate_sql(sql_query, schema)
+                sp.set(errors=len(errors))
+            if not errors:
+                return sql_query
+            if attempt == MAX_REPAIR_ATTEMPTS:
+                break
+            st.warning(f"🤖💬 La query generata non è valida ({errors[0]}). Chiedo al modello di correggerla...")
+            with st.spinner("🤖💬 Sto correggendo la query SQL..."):
+                sql_query = self._regenerate_sql(
+                    question, sql_query, "errori di validazione: " + "; ".join(errors)
+                )
+            if not sql_query:
+                return None
+        st.error(f"🤖💬 Non è stato possibile ottenere una query valida: {'; '.join(errors)}")
+        with st.expander("Ultima query generata (non eseguita)"):
+            st.code(sql_query, language='sql')
+        return None
+
+    def guard_sql(self, question: str, sql_query: str) -> str | None:
+        """Verifica la SQL generata prima dell'esecuzione.
+
+        Valida la query sullo schema in cache (con correzione automatica), aggiunge
+        i filtri di partizione mancanti, esegue il dry-run e, se la query supera il
+        budget, la rimanda al modello per restringerla (al massimo
+        MAX_NARROWING_ATTEMPTS volte) prima di bloccarla.
+        """
+        project_id = self.session_state.selected_project_id
+        for attempt in range(query_budget.MAX_NARROWING_ATTEMPTS + 1):
+            sql_query = self.repair_sql(question, sql_query)
+            if not sql_query:
+                return None
+            sql_query = self.prune_partitions(sql_query)
+            if self._has_cached_result(project_id, sql_query):
+                # Il risultato è già in cache: nessun byte verrà elaborato
+                return sql_query
+            if self._local_query(sql_query) is not None:
+                st.caption("🦆 Query eseguibile sulla copia locale: nessun dry-run necessario.")
+                return sql_query
+            estimate = self.estimate_query_cost(project_id, sql_query)
+            if estimate is None:
+                return None
+            st.caption(estimate.describe())
+            if not estimate.over_budget:
+                return sql_query
+            if attempt == query_budget.MAX_NARROWING_ATTEMPTS:
+                break
+            st.warning(f"🤖💬 Query bloccata: {estimate.reason()}. Chiedo al modello di restringerla...")
+            with st.spinner("🤖💬 Sto restringendo la query SQL..."):
+                narrowed = self._regenerate_sql(
+                    question, sql_query,
+                    estimate.reason() + ". Riduci il periodo con un filtro su data_date e seleziona solo le colonne necessarie."
+                )
+            if not narrowed:
+                return None
+            sql_query = narrowed
+        st.error(f"🤖💬 Query non eseguita: {estimate.reason()}. Restringi il periodo della domanda o aumenta il limite nella sidebar.")
+        return None
+
+    def _set_result_pager(self, pager: ResultPager | None):
+        """Sostituisce il paginatore del risultato corrente, chiudendo il precedente"""
+        previous = self.session_state.get('bq_result_pager')
+        if previous is not None and previous is not pager:
+            previous.close()
+        self.session_state.bq_result_pager = pager
+        self.session_state.bq_result_page = 1
+
+    def _render_result_pages(self, pager: ResultPager):
+        """Sfoglia il risultato completo pagina per pagina (eseguita come st.fragment)"""
+        page_number = st.number_input(
+            f"Pagina (1-{pager.page_count})",
+            min_value=1,
+            max_value=pager.page_count,
+            step=1,
+            key="bq_result_page"
+        )
+        with st.spinner("Caricamento pagina..."):
+            with tracing.span('bq.page', page=page_number):
+                page_df = pager.page(page_number - 1)
+        first_row = (page_number - 1) * pager.page_size + 1
+        st.caption(
+            f"Righe {first_row}-{first_row + len(page_df) - 1} di {pager.total_rows} "
+            f"· pagine in cache: {pager.cached_pages()}"
+        )
+        st.dataframe(page_df)
+
     def summarize_results_with_llm(self, project_id: str, location: str, model_name: str, results_df: pd.DataFrame, original_question: str) -> str | None:
         """Genera riassunto dei risultati con LLM"""
-        if not os.getenv("GOOGLE_APPLICATION_CREDENTIALS"):
-            st.error("🤖💬 Le credenziali GCP non sono state configurate.")
-            return None
         if results_df.empty:
             return "Non ci sono dati da riassumere." 
         if not all([project_id, location, model_name]):
             st.error("🤖💬 Mancano alcuni parametri per la generazione del riassunto.")
             return None
         try:
-            results_sample_text = results_df.head(20).to_string(index=False)
+            with tracing.span('prompt.build', kind='summary', rows=len(results_df)):
+                results_sample_text = results_df.head(20).to_string(index=False)
             if len(results_df) > 20:
                 results_sample_text += f"\n... e altre {len(results_df)-20} righe."
             
@@ -212,7 +672,7 @@ Metti in grassetto (usando **testo**) le metriche e i dati più importanti.
             if not self.openai_client:
                 st.error("Chiave OpenAI mancante.")
                 return None
-            response = self.openai_client.chat.completions.create(
+            response = self._create_chat_completion(
                 model=self.OPENAI_MODEL,
                 messages=[{"role": "user", "content": prompt}],
                 temperature=1,
@@ -228,9 +688,6 @@ Metti in grassetto (usando **testo**) le metriche e i dati più importanti.
 
     def generate_chart_code_with_llm(self, project_id: str, location: str, model_name: str, original_question: str, sql_query: str, query_results_df: pd.DataFrame) -> str | None:
         """Genera codice Python Matplotlib per visualizzare i dati"""
-        if not os.getenv("GOOGLE_APPLICATION_CREDENTIALS"):
-            st.error("🤖💬 Credenziali GCP non configurate.")
-            return None
         if query_results_df.empty:
             st.info("🤖💬 Nessun dato disponibile per generare un grafico.")
             return None
@@ -272,7 +729,7 @@ Restituisci SOLO il codice Python.
             if not self.openai_client:
                 st.error("Chiave OpenAI mancante.")
                 return None
-            response = self.openai_client.chat.completions.create(
+            response = self._create_chat_completion(
                 model=self.OPENAI_MODEL,
                 messages=[{"role": "user", "content": chart_prompt}],
                 temperature=1,
@@ -357,8 +814,29 @@ Restituisci SOLO il codice Python.
             else:
                 st.error("❌ Compila tutti i campi richiesti")
         
-        if self.session_state.get('config_applied_successfully', False) and self.session_state.get('analysis_mode') == "📊 BigQuery":
+        if self.is_configured():
             st.success("🟢 Configurazione BigQuery attiva")
+
+            # Limiti di byte fatturati (maximum_bytes_billed)
+            st.number_input(
+                "💰 Limite per query (GB)",
+                min_value=0.1,
+                value=float(st.secrets.get('bq_max_gb_per_query', query_budget.DEFAULT_MAX_GB_PER_QUERY)),
+                help="Le query che elaborerebbero più byte vengono ristrette o bloccate",
+                key="bq_max_gb_per_query"
+            )
+            st.number_input(
+                "💰 Budget di sessione (GB)",
+                min_value=0.1,
+                value=float(st.secrets.get('bq_max_gb_per_session', query_budget.DEFAULT_MAX_GB_PER_SESSION)),
+                key="bq_max_gb_per_session"
+            )
+            st.caption(f"Fatturati in questa sessione: {query_budget.format_bytes(self.session_state.get('bq_session_bytes_billed', 0))}")
+
+            mirror = self._local_mirror()
+            if mirror is not None and self.session_state.get('bq_schema') is not None:
+                with st.expander("🦆 Copia Locale", expanded=False):
+                    self._render_local_mirror(mirror)
             
             # Mostra schema in expander per debug
             if self.session_state.get('table_schema_for_prompt'):
@@ -369,6 +847,42 @@ Restituisci SOLO il codice Python.
         
         return False
 
+    def _render_local_mirror(self, mirror: LocalMirror):
+        """Copertura della copia locale per tabella e sincronizzazione manuale"""
+        schema = self.session_state.bq_schema
+        for table_id in schema.requested:
+            table = schema.tables.get(table_id)
+            if table is None:
+                continue
+            days = mirror.local_days(table)
+            metadata = mirror.metadata(table)
+            if days:
+                synced = time.strftime('%d/%m %H:%M', time.localtime(metadata.get('synced_at', 0)))
+                st.caption(f"**{table_id}**: {len(days)} giorni, {min(days)} → {max(days)} (sincronizzata {synced})")
+            else:
+                st.caption(f"**{table_id}**: nessun giorno in locale")
+        st.caption(f"Query locali: {mirror.stats['local']} · ripiegate su BigQuery: {mirror.stats['fallback']}")
+
+        if st.button("🔄 Sincronizza copia locale", key="bq_sync_local_mirror"):
+            progress = st.progress(0.0)
+
+            def on_progress(table_id: str, done: int, total: int):
+                progress.progress(done / total if total else 1.0, text=f"{table_id}: {done}/{total} giorni")
+
+            try:
+                report = mirror.sync(
+                    self._bigquery_client(schema.project_id), schema, user_key(self.session_state),
+                    self._bigquery_storage_client(), on_progress=on_progress
+                )
+            except Exception as e:
+                st.error(f"🤖💬 Errore durante la sincronizzazione della copia locale: {e}")
+                return
+            finally:
+                progress.empty()
+            st.success(report.describe())
+            for name, error in report.errors.items():
+                st.error(f"🤖💬 {name}: {error}")
+
     def render(self):
         """Renderizza l'interfaccia principale della modalità BigQuery"""
         
@@ -413,16 +927,8 @@ Restituisci SOLO il codice Python.
 
         # Domande preimpostate per BigQuery
         st.write("Oppure prova una di queste domande rapide:")
-        preset_questions_data = [
-            ("Perf. Totale (7gg)", "Qual è stata la mia performance totale (clic, impressioni, CTR medio, posizione media) negli ultimi 7 giorni?"),
-            ("Perf. Totale (28gg)", "Qual è stata la mia performance totale (clic, impressioni, CTR medio, posizione media) negli ultimi 28 giorni?"),
-            ("Query Top (7gg)", "Quali sono le top 10 query per clic negli ultimi 7 giorni?"),
-            ("Pagine Top (7gg)", "Quali sono le top 10 pagine per impressioni negli ultimi 7 giorni?"),
-            ("Clic MoM", "Confronta i clic totali del mese scorso con quelli di due mesi fa."),
-            ("Query in Calo", "Quali query hanno avuto il maggior calo di clic negli ultimi 28 giorni?"),
-            ("Pagine Nuove", "Quali pagine hanno ricevuto impressioni negli ultimi 7 giorni ma non nei 7 precedenti?"),
-            ("CTR Migliore", "Quali query hanno il CTR più alto negli ultimi 30 giorni (min 100 impressioni)?")
-        ]
+        # Le domande rapide usano SQL predefinite (sql_templates.py), senza generazione
+        preset_questions_data = [(t.label, t.question) for t in PRESET_TEMPLATES]
 
         cols = st.columns(4)
         for i, (label, question_text) in enumerate(preset_questions_data):
@@ -431,103 +937,420 @@ Restituisci SOLO il codice Python.
                 user_question_input = question_text
                 submit_button_main = True
 
-        # Processamento domanda
+        # Ogni domanda diventa una risposta nell'archivio di sessione: i rerun la
+        # ridisegnano e calcolano solo le fasi mancanti. Una risposta con SQL ma
+        # senza dati (rerun durante la query) si riaggancia al job in corso.
+        store = ConversationStore(self.session_state)
         if submit_button_main and user_question_input:
-            if not self.session_state.get('config_applied_successfully', False):
-                st.error("🤖💬 Per favore, completa e applica la configurazione BigQuery nella sidebar.")
+            store.add(Answer(mode='bigquery', question=user_question_input))
+
+        answer = store.latest('bigquery')
+        if answer is None:
+            return
+        return self.show_answer(answer)
+
+    def show_answer(self, answer: Answer) -> bool:
+        """Calcola le fasi mancanti e disegna la risposta; True se è stato elaborato qualcosa"""
+        pending = answer.pending(self._answer_stages(answer))
+        if not pending:
+            self._render_answer(answer)
+            return False
+        with tracing.span('question', question=answer.question, stages=",".join(pending)):
+            self._process_question(answer)
+            self._render_answer(answer)
+        return True
+
+    def is_configured(self) -> bool:
+        """True se la configurazione BigQuery è stata applicata e lo schema è caricato"""
+        return bool(
+            self.session_state.get('config_applied_successfully', False)
+            and self.session_state.get('table_schema_for_prompt')
+            and self.session_state.get('bq_schema') is not None
+        )
+
+    def known_sql(self, question: str) -> str | None:
+        """SQL ottenibile senza il modello: domanda rapida o esempio validato con la stessa domanda"""
+        template = template_for_question(question)
+        sql_query = template.render(self.session_state.get('bq_schema')) if template is not None else None
+        if sql_query:
+            return sql_query
+        store, dataset = self._example_store(), self._example_dataset()
+        example = store.reusable(dataset, question, record=False) if store and dataset else None
+        return example.sql if example is not None else None
+
+    def estimate_route(self, question: str) -> RouteEstimate:
+        """Tempo e byte stimati per rispondere con BigQuery.
+
+        Con una SQL nota (domanda rapida o esempio) si controllano copia locale,
+        cache dei risultati e dry-run; altrimenti il limite superiore è la
+        dimensione della tabella più grande e il tempo include la generazione.
+        """
+        estimate = RouteEstimate('bigquery')
+        if not self.is_configured():
+            estimate.available = False
+            estimate.notes.append("configurazione BigQuery non applicata")
+            return estimate
+        project_id = self.session_state.selected_project_id
+        schema = self.session_state.bq_schema
+        history = ConversationStore(self.session_state).history('bigquery')
+        data_seconds = typical_seconds(history, 'bigquery', 'data')
+        sql_query = self.known_sql(question)
+        if sql_query is None:
+            estimate.seconds = typical_seconds(history, 'bigquery', 'sql') + data_seconds
+            sizes = [t.num_bytes for t in schema.tables.values() if t.num_bytes]
+            if sizes:
+                estimate.bytes_processed = max(sizes)
+                estimate.bytes_upper_bound = True
+            estimate.notes.append("SQL da generare")
+            return estimate
+
+        default_days = int(st.secrets.get('bq_default_partition_days', DEFAULT_PARTITION_DAYS))
+        sql_query = enforce_partition_filters(sql_query, schema, default_days).sql
+        if self._local_query(sql_query) is not None:
+            estimate.seconds, estimate.bytes_processed = INSTANT_SECONDS, 0
+            estimate.notes.append("copia locale")
+        elif self._has_cached_result(project_id, sql_query):
+            estimate.seconds, estimate.bytes_processed = INSTANT_SECONDS, 0
+            estimate.notes.append("risultato in cache")
+        else:
+            try:
+                estimate.bytes_processed = self.dry_run_bytes(project_id, sql_query)
+            except Exception as e:
+                estimate.available = False
+                estimate.notes.append(f"dry-run non riuscito: {e}")
+                return estimate
+            cost = query_budget.estimate(estimate.bytes_processed, self.session_state, st.secrets)
+            if cost.over_budget:
+                estimate.available = False
+                estimate.notes.append(cost.reason())
+            estimate.seconds = data_seconds
+            estimate.notes.append(f"~${cost.cost_usd:.4f}")
+        return estimate
+
+    def _answer_stages(self, answer: Answer) -> list[str]:
+        if answer.data is not None and answer.data.empty:
+            return ['sql', 'data']
+        stages = ['sql', 'data', 'summary']
+        if self.session_state.get('enable_chart_generation', False):
+            stages.append('chart')
+        return stages
+
+    def _process_question(self, answer: Answer):
+        """Calcola le fasi mancanti della risposta: SQL, risultati, riassunto e grafico"""
+        if not self.session_state.get('config_applied_successfully', False):
+            st.error("🤖💬 Per favore, completa e applica la configurazione BigQuery nella sidebar.")
+            return
+        elif not self.session_state.get('table_schema_for_prompt'): 
+            st.error("🤖💬 Lo schema delle tabelle non è disponibile. Verifica la configurazione BigQuery.")
+            return
+
+        project_id = self.session_state.selected_project_id
+        location = self.session_state.get('gcp_location', 'europe-west1')
+        question = answer.question
+
+        # Un follow-up è risposto dal risultato precedente se possibile, altrimenti
+        # la SQL precedente è passata al modello da rifinire
+        conversation = None
+        if not answer.has('sql'):
+            history = self._followup_history(answer)
+            plan = self._plan_followup(answer, history) if history else None
+            if plan is not None and plan.action == 'transform':
+                previous = history[-1]
+                try:
+                    with timed(answer, 'data'):
+                        derived = apply_plan(previous.data, plan)
+                except ValueError:
+                    derived = None
+                if derived is not None:
+                    answer.sql = previous.sql
+                    answer.data = derived
+                    answer.data_info = {
+                        'source': 'followup',
+                        'paged': False,
+                        'truncated': False,
+                        'total_rows': len(derived),
+                        'followup_of': previous.question,
+                        'followup': plan.describe(),
+                    }
+            if history and (plan is None or plan.action != 'new'):
+                conversation = [(previous.question, previous.sql) for previous in history[-CONTEXT_ANSWERS:]]
+
+        # Genera SQL (o riusa quella di un esempio validato) e la verifica
+        if not answer.has('sql'):
+            with timed(answer, 'sql'):
+                sql_query, sql_details = self.prepare_sql(question, conversation)
+            if not sql_query:
+                answer.fail('sql', "Non è stato possibile generare una query SQL eseguibile per la tua domanda.")
+                return
+            answer.sql = sql_query
+            answer.data_info.update(sql_details)
+            if conversation:
+                answer.data_info['followup_of'] = conversation[-1][0]
+        elif not answer.has('data'):
+            st.info(f"🤖💬 Riprendo la query in corso per: \"{question}\"")
+
+        # Esegui query
+        if not answer.has('data'):
+            # Avanzamento del job, con annullamento (callback eseguita prima del rerun)
+            job_status = st.empty()
+            job_bar = st.empty()
+            cancel_slot = st.empty()
+            cancel_slot.button("⛔ Annulla query", key="bq_cancel_job", on_click=self.cancel_active_job, args=(answer,))
+
+            def show_job_progress(info):
+                job_bar.progress(info['fraction'])
+                elapsed = f" · {info['elapsed_s']:.0f}s" if info['elapsed_s'] is not None else ""
+                stage = f" · fase {info['stage']}" if info['stage'] else ""
+                job_status.caption(f"⏳ Job {info['job_id']}: {info['state']}{stage}{elapsed}")
+
+            # Anteprima del primo batch mentre arrivano gli altri
+            live_status = st.empty()
+            live_table = st.empty()
+
+            def show_progress(frames, rows_read, bytes_read):
+                if len(frames) == 1:
+                    live_table.dataframe(frames[0].head(200))
+                live_status.caption(f"⏳ Ricevute {rows_read} righe ({query_budget.format_bytes(bytes_read)})...")
+
+            with timed(answer, 'data'):
+                query_results = self.execute_bigquery_query(
+                    project_id, answer.sql,
+                    on_progress=show_progress, on_job_progress=show_job_progress
+                )
+            for placeholder in (live_status, live_table, job_status, job_bar, cancel_slot):
+                placeholder.empty()
+            if query_results is None:
+                answer.fail('data', "🤖💬 Errore nell'esecuzione della query BigQuery.")
                 return
-            elif not self.session_state.get('table_schema_for_prompt'): 
-                st.error("🤖💬 Lo schema delle tabelle non è disponibile. Verifica la configurazione BigQuery.")
+            answer.data = query_results
+            answer.data_info.update({
+                'source': query_results.attrs.get('source'),
+                'paged': bool(query_results.attrs.get('paged')),
+                'truncated': bool(query_results.attrs.get('truncated')),
+                'total_rows': query_results.attrs.get('total_rows'),
+            })
+            if query_results.empty:
                 return
-            
-            # Reset risultati precedenti
-            self.session_state.sql_query = ""
-            self.session_state.query_results = None
-            self.session_state.results_summary = ""
-            
-            # Genera SQL
-            with st.spinner(f"🤖💬 Sto generando la query SQL per: \"{user_question_input}\""):
+            if not any(answer.data_info.get(k) for k in ('followup_of', 'example', 'template')):
+                self.remember_sql_example(answer.question, answer.sql)
+
+        question = contextual_question(answer.question, answer.data_info.get('followup_of'))
+
+        # Genera riassunto
+        if not answer.has('summary'):
+            with timed(answer, 'summary'), st.spinner("🤖💬 Sto generando un riassunto dei risultati..."):
+                results_summary = self.summarize_results_with_llm(
+                    project_id, location, self.OPENAI_MODEL, answer.data, question
+                )
+            if results_summary and results_summary != "Non ci sono dati da riassumere.":
+                answer.summary = results_summary
+            else:
+                answer.fail('summary', "🤖💬 Non è stato possibile generare un riassunto, ma la query ha prodotto risultati.")
+
+        # Grafico (anche attivato dopo la risposta)
+        if self.session_state.get('enable_chart_generation', False) and not answer.has('chart'):
+            with timed(answer, 'chart'), st.spinner("🤖💬 Sto generando il codice per il grafico..."):
+                answer.chart_code = self.generate_chart_code_with_llm(
+                    project_id, location, self.OPENAI_MODEL, question, answer.sql, answer.data
+                )
+                if not answer.chart_code:
+                    answer.fail('chart', "🤖💬 Non è stato possibile generare il codice per il grafico.")
+                    return
+                try:
+                    fig_generated = execute_chart_code(answer.chart_code, answer.data)
+                    if fig_generated is not None:
+                        answer.chart_png = figure_to_png(fig_generated)
+                    else:
+                        answer.fail('chart', "🤖💬 L'AI ha generato codice, ma non è stato possibile creare un grafico.")
+                except Exception as e:
+                    answer.fail('chart', f"🤖💬 Errore durante l'esecuzione del codice del grafico: {e}")
+
+    def _example_store(self) -> ExampleStore | None:
+        """Archivio degli esempi (sql_examples_path nei secrets), disattivato di default"""
+        path = st.secrets.get('sql_examples_path')
+        return get_example_store(path) if path else None
+
+    def _example_dataset(self) -> str | None:
+        schema = self.session_state.get('bq_schema')
+        return f"{schema.project_id}.{schema.dataset_id}" if schema else None
+
+    def schema_prompt_for_question(self, text: str) -> tuple[str, PrunedSchema | None]:
+        """Schema per il prompt ridotto alle tabelle e colonne pertinenti (bq_schema_pruning nei secrets)"""
+        full_prompt = self.session_state.table_schema_for_prompt
+        schema = self.session_state.get('bq_schema')
+        if schema is None or not st.secrets.get('bq_schema_pruning', True):
+            return full_prompt, None
+        pruned = prune_schema(schema, text, full_prompt)
+        return pruned.prompt, pruned if pruned.pruned else None
+
+    def prepare_sql(self, question: str, conversation: list[tuple[str, str]] | None = None) -> tuple[str | None, dict]:
+        """SQL verificata per la domanda, con i dettagli su modello, esempio riusato e schema ridotto.
+
+        Le domande rapide usano la SQL predefinita. Una domanda con gli stessi token di un esempio validato ne riusa la SQL senza
+        chiamare il modello; altrimenti gli esempi più simili entrano nel prompt,
+        insieme allo schema ridotto alla domanda. I follow-up dipendono dal
+        contesto e non riusano esempi.
+        """
+        details = {}
+        template = template_for_question(question) if not conversation else None
+        if template is not None:
+            sql_query = template.render(self.session_state.get('bq_schema'))
+            if sql_query:
+                details['template'] = template.label
+                return self.guard_sql(question, sql_query), details
+
+        store = self._example_store()
+        dataset = self._example_dataset() if store is not None else None
+        if dataset and not conversation:
+            example = store.reusable(dataset, question)
+            if example is not None:
+                st.info(f"🤖💬 Riuso la query di una domanda già risolta: \"{example.question}\"")
+                sql_query = self.guard_sql(question, example.sql)
+                if sql_query:
+                    details['example'] = example.question
+                    return sql_query, details
+
+        examples = store.similar(dataset, question) if dataset else []
+        # Lo schema segue anche le domande precedenti del follow-up
+        pruning_text = " ".join([q for q, _ in conversation or []] + [question])
+        schema_prompt, pruned = self.schema_prompt_for_question(pruning_text)
+        if pruned is not None:
+            details['schema'] = pruned.describe()
+            details['schema_tokens_saved'] = pruned.saved_tokens
+        with st.spinner(f"🤖💬 Sto generando la query SQL per: \"{question}\""):
+            sql_query = self.generate_sql_from_question(
+                self.session_state.selected_project_id,
+                self.session_state.get('gcp_location', 'europe-west1'),
+                self.OPENAI_MODEL,
+                question,
+                schema_prompt,
+                format_examples(examples),
+                conversation=conversation
+            )
+            if not sql_query and pruned is not None:
+                # Forse serviva una colonna esclusa: nuovo tentativo con lo schema completo
+                del details['schema']
+                del details['schema_tokens_saved']
                 sql_query = self.generate_sql_from_question(
-                    self.session_state.selected_project_id, 
-                    self.session_state.get('gcp_location', 'europe-west1'), 
+                    self.session_state.selected_project_id,
+                    self.session_state.get('gcp_location', 'europe-west1'),
                     self.OPENAI_MODEL,
-                    user_question_input,
-                    self.session_state.table_schema_for_prompt, 
-                    ""
+                    question,
+                    self.session_state.table_schema_for_prompt,
+                    format_examples(examples),
+                    conversation=conversation
                 )
+        if not sql_query:
+            return None, details
+        if conversation:
+            # Le correzioni devono conoscere la domanda a cui si riferisce il follow-up
+            question = contextual_question(question, conversation[-1][0])
+        return self.guard_sql(question, sql_query), details
 
-            if sql_query:
-                with st.expander("🔍 Dettagli Tecnici", expanded=False):
-                    st.subheader("Query SQL Generata:")
-                    st.code(sql_query, language='sql')
-                
-                    # Esegui query
-                    query_results = self.execute_bigquery_query(self.session_state.selected_project_id, sql_query)
-
-                    if query_results is not None:
-                        st.subheader("Risultati Grezzi (Prime 200 righe):")
-                        if query_results.empty:
-                            st.info("La query non ha restituito risultati.")
-                        else:
-                            st.dataframe(query_results.head(200))
-                
-                if query_results is not None and not query_results.empty:
-                    # Genera riassunto
-                    with st.spinner("🤖💬 Sto generando un riassunto dei risultati..."):
-                        results_summary = self.summarize_results_with_llm(
-                            self.session_state.selected_project_id, 
-                            self.session_state.get('gcp_location', 'europe-west1'), 
-                            self.OPENAI_MODEL,
-                            query_results, 
-                            user_question_input
-                        )
-                    
-                    if results_summary and results_summary != "Non ci sono dati da riassumere.":
-                        with st.chat_message("ai", avatar="🤖"):
-                            st.markdown(results_summary) 
-                    else: 
-                        st.warning("🤖💬 Non è stato possibile generare un riassunto, ma la query ha prodotto risultati.")
-
-                    # Sezione generazione grafico
-                    if self.session_state.get('enable_chart_generation', False):
-                        st.markdown("---")
-                        st.subheader("📊 Visualizzazione Grafica (Beta)")
-                        with st.spinner("🤖💬 Sto generando il codice per il grafico..."):
-                            chart_code = self.generate_chart_code_with_llm(
-                                self.session_state.selected_project_id, 
-                                self.session_state.get('gcp_location', 'europe-west1'), 
-                                self.OPENAI_MODEL,
-                                user_question_input, 
-                                sql_query, 
-                                query_results
-                            )
-                            
-                            if chart_code:
-                                try:
-                                    exec_scope = {
-                                        "plt": plt, 
-                                        "pd": pd, 
-                                        "df": query_results.copy(),
-                                        "fig": None
-                                    }
-                                    exec(chart_code, exec_scope)
-                                    fig_generated = exec_scope.get("fig")
-
-                                    if fig_generated is not None:
-                                        st.pyplot(fig_generated)
-                                    else:
-                                        st.warning("🤖💬 L'AI ha generato codice, ma non è stato possibile creare un grafico.")
-                                        with st.expander("Codice grafico generato (Debug)"):
-                                            st.code(chart_code, language="python")
-                                except Exception as e:
-                                    st.error(f"🤖💬 Errore durante l'esecuzione del codice del grafico: {e}")
-                                    with st.expander("Codice grafico generato (con errore)"):
-                                        st.code(chart_code, language="python")
-                            else:
-                                st.warning("🤖💬 Non è stato possibile generare il codice per il grafico.")
-                elif query_results is not None:
-                    st.info("🤖💬 La query non ha restituito risultati.")
+    def remember_sql_example(self, question: str, sql_query: str):
+        """Registra una coppia domanda→SQL la cui query ha prodotto risultati"""
+        store, dataset = self._example_store(), self._example_dataset()
+        if store is not None and dataset:
+            store.add(dataset, question, sql_query)
+
+    def _followup_history(self, answer: Answer) -> list[Answer]:
+        """Risposte BigQuery precedenti con SQL e risultati, contesto dei follow-up"""
+        return [
+            previous for previous in ConversationStore(self.session_state).history('bigquery')
+            if previous is not answer and previous.sql and previous.data is not None
+        ]
+
+    def _plan_followup(self, answer: Answer, history: list[Answer]):
+        """Piano per il follow-up: trasformare il risultato precedente, rifinire la SQL o ripartire"""
+        previous = history[-1]
+        actions = ['refine', 'new']
+        # Solo un risultato completo può essere filtrato o riaggregato in locale
+        if not previous.data.empty and not previous.data_info.get('paged') and not previous.data_info.get('truncated'):
+            actions.insert(0, 'transform')
+        with st.spinner("🤖💬 Verifico se posso rispondere dal risultato precedente..."):
+            return plan_followup(
+                self._create_chat_completion, self.OPENAI_MODEL, answer.question, history, actions
+            )
+
+    def _render_answer(self, answer: Answer):
+        """Disegna la risposta dal record, senza chiamate a BigQuery o all'LLM"""
+        if 'sql' in answer.errors:
+            st.error(answer.errors['sql'])
+            return
+        if answer.sql is None:
+            return
+
+        query_results = answer.data
+        info = answer.data_info
+        if info.get('followup_of'):
+            how = f"dal risultato precedente ({info['followup']})" if info.get('source') == 'followup' else "rifinendo la query precedente"
+            st.caption(f"↪️ Follow-up di \"{info['followup_of']}\", risposto {how}")
+        elif info.get('template'):
+            st.caption(f"📐 SQL predefinita della domanda rapida \"{info['template']}\"")
+        elif info.get('example'):
+            st.caption(f"📚 SQL riusata dalla domanda già risolta \"{info['example']}\"")
+        with st.expander("🔍 Dettagli Tecnici", expanded=False):
+            st.write(f"**Domanda:** {answer.question}")
+            st.subheader("Query SQL Generata:")
+            st.code(answer.sql, language='sql')
+            if info.get('schema'):
+                st.caption(f"✂️ {info['schema']}")
+
+            if query_results is not None:
+                st.caption(RESULT_SOURCE_LABELS.get(info.get('source'), ""))
+                pager = self.session_state.get('bq_result_pager')
+                if info.get('paged') and pager is not None:
+                    st.subheader(f"Risultati Grezzi ({pager.total_rows} righe):")
+                    # Solo il paginatore viene rieseguito al cambio pagina
+                    st.fragment(self._render_result_pages)(pager)
                 else:
-                    st.error("🤖💬 Errore nell'esecuzione della query BigQuery.")
+                    st.subheader("Risultati Grezzi (Prime 200 righe):")
+                    if query_results.empty:
+                        st.info("La query non ha restituito risultati.")
+                    else:
+                        with tracing.span('render.dataframe'):
+                            st.dataframe(query_results.head(200))
+
+        if 'data' in answer.errors:
+            st.error(answer.errors['data'])
+            return
+        if query_results is None:
+            return
+        if query_results.empty:
+            st.info("🤖💬 La query non ha restituito risultati.")
+            return
+
+        if info.get('paged'):
+            st.info(
+                f"🤖💬 Riassunto e grafico usano un campione di {len(query_results)} righe "
+                f"su {info.get('total_rows')}; il risultato completo si sfoglia nei Dettagli Tecnici."
+            )
+        elif info.get('truncated'):
+            st.warning(
+                f"🤖💬 Risultato troncato a {len(query_results)} righe "
+                f"su {info.get('total_rows')} (limite di download)."
+            )
+
+        if answer.summary:
+            with st.chat_message("ai", avatar="🤖"):
+                st.markdown(answer.summary) 
+        elif answer.errors.get('summary'):
+            st.warning(answer.errors['summary'])
+
+        # Sezione grafico
+        if answer.chart_png is not None or (
+            self.session_state.get('enable_chart_generation', False) and answer.errors.get('chart')
+        ):
+            st.markdown("---")
+            st.subheader("📊 Visualizzazione Grafica (Beta)")
+            if answer.chart_png is not None:
+                with tracing.span('chart.render'):
+                    st.image(answer.chart_png)
             else:
-                st.error("Non è stato possibile generare una query SQL per la tua domanda.")
+                st.warning(answer.errors['chart'])
+                if answer.chart_code:
+                    with st.expander("Codice grafico generato (Debug)"):
+                        st.code(answer.chart_code, language="python")
+
+        if answer.timings:
+            st.caption("⏱️ " + " · ".join(f"{stage} {seconds:.1f}s" for stage, seconds in answer.timings.items()))
@@ -0,0 +1,32 @@
+import pandas as pd
+
+import tracing
+
+
+def execute_chart_code(chart_code: str, df: pd.DataFrame):
+    """Esegue il codice Matplotlib generato e ritorna la figura in 'fig' (o None)"""
+    # Import differito: matplotlib serve solo quando si crea un grafico
+    import matplotlib.pyplot as plt
+
+    exec_scope = {
+        "plt": plt,
+        "pd": pd,
+        "df": df.copy(),
+        "fig": None
+    }
+    with tracing.span('chart.exec', rows=len(df)):
+        exec(chart_code, exec_scope)
+    return exec_scope.get("fig")
+
+
+def figure_to_png(fig, dpi: int = 110) -> bytes:
+    """PNG della figura (che viene chiusa), da conservare tra i rerun"""
+    import io
+
+    import matplotlib.pyplot as plt
+
+    buffer = io.BytesIO()
+    with tracing.span('chart.png'):
+        fig.savefig(buffer, format="png", dpi=dpi, bbox_inches="tight")
+    plt.close(fig)
+    return buffer.getvalue()
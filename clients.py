@@ -0,0 +1,182 @@
+import atexit
+import threading
+import time
+from collections import OrderedDict
+
+import tracing
+from single_flight import SingleFlight, fingerprint, single_flight
+
+# Dimensioni dei pool HTTP keep-alive condivisi tra i rerun
+POOL_CONNECTIONS = 10
+POOL_MAXSIZE = 32
+MAX_CLIENTS = 64
+IDLE_TTL_SECONDS = 30 * 60
+
+
+class ClientCache:
+    """Cache process-wide di client con pool HTTP, LRU e chiusura su eviction"""
+
+    def __init__(self, max_entries: int = MAX_CLIENTS, idle_ttl: float = IDLE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.idle_ttl = idle_ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # Una sola creazione in corso per chiave, fuori dal lock globale
+        self.building = SingleFlight()
+
+    def _lookup(self, key: tuple, expired: list):
+        """Client valido per key (da chiamare con il lock); quelli scaduti finiscono in expired"""
+        now = time.monotonic()
+        entry = self.entries.get(key)
+        if entry is not None and now - entry[1] <= self.idle_ttl:
+            self.entries[key] = (entry[0], now)
+            self.entries.move_to_end(key)
+            return entry[0]
+        if entry is not None:
+            expired.append(self.entries.pop(key)[0])
+        return None
+
+    def get(self, key: tuple, factory):
+        """Ritorna il client per key, creandolo con factory() se assente o scaduto"""
+        expired = []
+        with self.lock:
+            client = self._lookup(key, expired)
+        if client is None:
+            client, _ = self.building.do(key, lambda: self._build(key, factory, expired))
+        for old in expired:
+            _close(old)
+        return client
+
+    def _build(self, key: tuple, factory, expired: list):
+        with self.lock:
+            # Creato da un'altra sessione tra il lookup e l'inizio della creazione
+            client = self._lookup(key, expired)
+        if client is not None:
+            return client
+        # Rete e autenticazione senza il lock: le altre chiavi non attendono
+        client = factory()
+        with self.lock:
+            self.entries[key] = (client, time.monotonic())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                expired.append(self.entries.popitem(last=False)[1][0])
+        return client
+
+    def close_where(self, predicate):
+        """Chiude e rimuove i client le cui chiavi soddisfano predicate"""
+        with self.lock:
+            keys = [key for key in self.entries if predicate(key)]
+            closing = [self.entries.pop(key)[0] for key in keys]
+        for client in closing:
+            _close(client)
+
+    def close_all(self):
+        self.close_where(lambda key: True)
+
+
+def _close(client):
+    try:
+        # I client gRPC (es. BigQuery Storage) chiudono il canale tramite il transport
+        close = getattr(client, 'close', None) or client.transport.close
+        close()
+    except Exception:
+        pass
+
+
+_cache = ClientCache()
+
+
+def get_openai_client(api_key: str | None):
+    """Client OpenAI condiviso per API key, con connessioni keep-alive"""
+    if not api_key:
+        return None
+
+    def factory():
+        import httpx
+        import openai
+
+        http_client = httpx.Client(
+            limits=httpx.Limits(
+                max_connections=POOL_MAXSIZE,
+                max_keepalive_connections=POOL_MAXSIZE,
+                keepalive_expiry=60,
+            ),
+            timeout=httpx.Timeout(120.0, connect=10.0),
+        )
+        return openai.OpenAI(api_key=api_key, http_client=http_client)
+
+    return _cache.get(('openai', api_key), factory)
+
+
+def create_chat_completion(client, user: str, **kwargs):
+    """Chiamata OpenAI coalizzata con eventuali richieste identiche in volo dello stesso utente"""
+    key = fingerprint('openai', user, kwargs)
+    with tracing.span('llm.completion', model=kwargs.get('model')):
+        response, shared = single_flight.do(key, lambda: client.chat.completions.create(**kwargs))
+        usage = getattr(response, 'usage', None)
+        if usage is not None:
+            tracing.set_attrs(
+                prompt_tokens=usage.prompt_tokens,
+                completion_tokens=usage.completion_tokens,
+                shared=shared
+            )
+    return response
+
+
+def _require_credentials(credentials):
+    # Mai le credenziali predefinite del processo (ADC): ogni sessione usa le proprie
+    if credentials is None:
+        raise ValueError("Credenziali GCP della sessione non configurate")
+
+
+def credentials_identity(credentials) -> str:
+    """Identità stabile delle credenziali: service account e chiave, o refresh token.
+
+    Un nuovo oggetto per le stesse credenziali (es. a ogni "Applica") riusa i client
+    in cache; l'hash evita di tenere il refresh token nelle chiavi.
+    """
+    signer = getattr(credentials, 'signer', None)
+    return fingerprint(
+        type(credentials).__name__,
+        getattr(credentials, 'service_account_email', None),
+        getattr(signer, 'key_id', None),
+        getattr(credentials, 'refresh_token', None),
+        getattr(credentials, 'client_id', None),
+    )
+
+
+def get_bigquery_client(project_id: str, credentials, user: str):
+    """Client BigQuery condiviso per (utente, progetto, credenziali) con pool di sessioni HTTP"""
+    _require_credentials(credentials)
+
+    def factory():
+        from google.auth.transport.requests import AuthorizedSession
+        from google.cloud import bigquery
+        from requests.adapters import HTTPAdapter
+
+        session = AuthorizedSession(credentials)
+        adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+        session.mount("https://", adapter)
+        return bigquery.Client(project=project_id, credentials=credentials, _http=session)
+
+    return _cache.get(('bigquery', user, project_id, credentials_identity(credentials)), factory)
+
+
+def get_bigquery_storage_client(credentials, user: str):
+    """Client della BigQuery Storage Read API condiviso per utente e credenziali (canale gRPC riusato)"""
+    _require_credentials(credentials)
+
+    def factory():
+        from google.cloud import bigquery_storage
+
+        return bigquery_storage.BigQueryReadClient(credentials=credentials)
+
+    return _cache.get(('bigquery_storage', user, 'read', credentials_identity(credentials)), factory)
+
+
+def close_user_clients(user: str):
+    """Chiude i client legati all'utente (es. al logout)"""
+    _cache.close_where(lambda key: len(key) > 2 and key[1] == user)
+
+
+atexit.register(_cache.close_all)
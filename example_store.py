@@ -0,0 +1,178 @@
+"""Archivio locale di esempi domanda→SQL validati dall'esecuzione.
+
+Le coppie sono salvate in un file JSONL, per dataset BigQuery, solo quando la
+query ha prodotto risultati. Il file contiene domande e SQL degli utenti: la
+modalità BigQuery lo usa solo se configurato (`sql_examples_path` nei secrets). Un indice BM25 sulle domande recupera gli esempi
+più simili da inserire nel prompt; una domanda con gli stessi token di una già
+vista (a meno di parole vuote, maiuscole e accenti) riusa direttamente la sua
+SQL, senza chiamare il modello.
+"""
+import json
+import math
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter
+from dataclasses import asdict, dataclass
+
+import tracing
+
+MAX_EXAMPLES = 500  # per dataset, i più vecchi vengono scartati
+TOP_K = 3
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+STOPWORDS = frozenset("""
+a ad al alla alle allo ai agli all c che chi con cosa come da dal dalla dalle dai degli dei del della
+delle dello di e è ed gli ha hanno i il in la le lo mi mio nel nella nelle nei negli o per più quale
+quali quanto quanti quante qual sono su sul sulla sui tra fra un una uno mie miei mia the of and for
+to in on by what which is are my me show
+""".split())
+
+
+def tokenize(text: str) -> list[str]:
+    """Token normalizzati (minuscolo, senza accenti), senza parole vuote"""
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return [t for t in re.findall(r"[a-z0-9_]+", text) if t not in STOPWORDS]
+
+
+@dataclass
+class SqlExample:
+    dataset: str  # project.dataset
+    question: str
+    sql: str
+    created_at: float = 0.0
+    uses: int = 0
+
+    @property
+    def tokens(self) -> list[str]:
+        return tokenize(self.question)
+
+
+class ExampleStore:
+    """Esempi per dataset con indice BM25 in memoria, persistiti in JSONL"""
+
+    def __init__(self, path: str | None = None, max_examples: int = MAX_EXAMPLES):
+        self.path = path
+        self.max_examples = max_examples
+        self.examples: dict[str, list[SqlExample]] = {}
+        self.indexes = {}  # dataset -> (token per esempio, document frequency, lunghezza media)
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.stats = {'reused': 0, 'retrieved': 0, 'added': 0}
+
+    def _load(self):
+        if self.loaded:
+            return
+        self.loaded = True
+        if not self.path or not os.path.exists(self.path):
+            return
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    example = SqlExample(**json.loads(line))
+                except (json.JSONDecodeError, TypeError):
+                    continue
+                self._insert(example)
+
+    def _insert(self, example: SqlExample):
+        examples = self.examples.setdefault(example.dataset, [])
+        # Stessa domanda: vale la SQL più recente
+        examples[:] = [e for e in examples if tokenize(e.question) != example.tokens]
+        examples.append(example)
+        del examples[:-self.max_examples]
+        self.indexes.pop(example.dataset, None)
+
+    def _index(self, dataset: str):
+        index = self.indexes.get(dataset)
+        if index is None:
+            docs = [e.tokens for e in self.examples.get(dataset, [])]
+            df = Counter(token for doc in docs for token in set(doc))
+            avg_len = sum(len(doc) for doc in docs) / len(docs) if docs else 0.0
+            index = self.indexes[dataset] = (docs, df, avg_len)
+        return index
+
+    def _bm25(self, dataset: str, query: list[str]) -> list[float]:
+        docs, df, avg_len = self._index(dataset)
+        n = len(docs)
+        scores = []
+        for doc in docs:
+            counts = Counter(doc)
+            score = 0.0
+            for token in set(query):
+                if token not in counts:
+                    continue
+                idf = math.log(1 + (n - df[token] + 0.5) / (df[token] + 0.5))
+                tf = counts[token]
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * len(doc) / (avg_len or 1))
+                score += idf * tf * (BM25_K1 + 1) / (tf + norm)
+            scores.append(score)
+        return scores
+
+    def similar(self, dataset: str, question: str, k: int = TOP_K) -> list[SqlExample]:
+        """I k esempi del dataset più simili alla domanda (BM25)"""
+        query = tokenize(question)
+        with self.lock:
+            self._load()
+            examples = list(self.examples.get(dataset, []))
+            if not examples or not query:
+                return []
+            scores = self._bm25(dataset, query)
+        ranked = sorted(zip(scores, examples), key=lambda pair: pair[0], reverse=True)
+        result = [example for score, example in ranked[:k] if score > 0]
+        if result:
+            self.stats['retrieved'] += 1
+        return result
+
+    def reusable(self, dataset: str, question: str, record: bool = True) -> SqlExample | None:
+        """Esempio con gli stessi token della domanda, la cui SQL può essere riusata.
+
+        Basta un token in più o in meno (es. "da mobile", "top 20") per cambiare la
+        query: in quel caso l'esempio serve solo come riferimento nel prompt.
+        record=False cerca senza contare l'uso (es. per stimare i costi prima di rispondere).
+        """
+        query = set(tokenize(question))
+        if not query:
+            return None
+        with tracing.span('examples.lookup', dataset=dataset) as sp:
+            with self.lock:
+                self._load()
+                matches = [e for e in self.examples.get(dataset, []) if set(e.tokens) == query]
+                example = matches[-1] if matches else None
+                if example is not None and record:
+                    example.uses += 1
+                    self.stats['reused'] += 1
+            sp.set(hit=example is not None)
+        return example
+
+    def add(self, dataset: str, question: str, sql: str):
+        """Registra una coppia la cui query ha prodotto risultati"""
+        example = SqlExample(dataset=dataset, question=question.strip(), sql=sql.strip(), created_at=time.time())
+        with self.lock:
+            self._load()
+            self._insert(example)
+            self.stats['added'] += 1
+            if self.path:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(asdict(example), ensure_ascii=False) + "\n")
+
+
+def format_examples(examples: list[SqlExample]) -> str:
+    """Esempi nel formato atteso da generate_sql_from_question"""
+    return "\n\n".join(f"Domanda: \"{e.question}\"\nSQL:\n{e.sql}" for e in examples)
+
+
+_stores: dict[str, ExampleStore] = {}
+_stores_lock = threading.Lock()
+
+
+def get_example_store(path: str) -> ExampleStore:
+    """Archivio condiviso dal processo per il file indicato"""
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            store = _stores[path] = ExampleStore(path)
+        return store
@@ -0,0 +1,244 @@
+"""Domande di follow-up risposte dai dati già presenti in sessione.
+
+Un follow-up ("e solo da mobile?", "ora mostrami le pagine") viene tradotto
+dall'LLM in un piano JSON: trasformare i dati della risposta precedente
+(filtri e riaggregazione in pandas), rifinire la SQL precedente (BigQuery) o
+tornare alla fonte. Il piano è solo dati: nessun codice generato viene eseguito.
+"""
+import json
+import operator
+import re
+from dataclasses import dataclass, field
+
+import pandas as pd
+
+import tracing
+
+# Risposte precedenti mostrate all'LLM come contesto
+CONTEXT_ANSWERS = 3
+# Valori distinti mostrati per le colonne testuali (es. device, country)
+MAX_DISTINCT_VALUES = 20
+# Dimensioni richiedibili alla Search Console
+GSC_DIMENSIONS = ('query', 'page', 'country', 'device', 'searchAppearance', 'date')
+
+FILTER_OPS = ('==', '!=', 'in', 'not_in', 'contains', 'not_contains', '>', '>=', '<', '<=')
+COMPARISONS = {
+    '==': operator.eq, '!=': operator.ne,
+    '>': operator.gt, '>=': operator.ge,
+    '<': operator.lt, '<=': operator.le,
+}
+ACTION_LABELS = {
+    'transform': "filtrare o riaggregare i dati della risposta precedente",
+    'fetch': "recuperare nuovi dati dalla fonte (indica in 'dimensions' le dimensioni necessarie)",
+    'refine': "modificare la query SQL precedente",
+    'new': "scrivere una query nuova, la domanda non dipende dalle precedenti",
+}
+
+
+@dataclass
+class FollowUpPlan:
+    action: str  # 'transform' | 'fetch' | 'refine' | 'new'
+    filters: list[dict] = field(default_factory=list)  # {"column", "op", "value"}
+    group_by: list[str] = field(default_factory=list)
+    sort_by: str | None = None
+    ascending: bool = False
+    limit: int | None = None
+    dimensions: list[str] = field(default_factory=list)
+    reason: str = ""
+
+    @property
+    def columns(self) -> list[str]:
+        """Colonne usate dal piano"""
+        columns = [f['column'] for f in self.filters] + self.group_by
+        return columns + [self.sort_by] if self.sort_by else columns
+
+    @property
+    def is_identity(self) -> bool:
+        return not (self.filters or self.group_by or self.sort_by or self.limit)
+
+    def describe(self) -> str:
+        parts = []
+        for f in self.filters:
+            parts.append(f"filtro {f['column']} {f['op']} {f['value']}")
+        if self.group_by:
+            parts.append(f"raggruppato per {', '.join(self.group_by)}")
+        if self.sort_by:
+            parts.append(f"ordinato per {self.sort_by} {'crescente' if self.ascending else 'decrescente'}")
+        if self.limit:
+            parts.append(f"prime {self.limit} righe")
+        return "; ".join(parts) or "stessi dati"
+
+
+def contextual_question(question: str, previous_question: str | None) -> str:
+    """Domanda completa del contesto, per riassunto e grafico"""
+    if not previous_question:
+        return question
+    return f"{question} (follow-up della domanda precedente: \"{previous_question}\")"
+
+
+def _is_text(series: pd.Series) -> bool:
+    # Con pandas 3 le colonne di testo sono StringDtype, non più object
+    return pd.api.types.is_string_dtype(series) or pd.api.types.is_object_dtype(series)
+
+
+def _describe_columns(df: pd.DataFrame) -> list[str]:
+    lines = []
+    for column in df.columns:
+        line = f"  - {column} ({df[column].dtype})"
+        if _is_text(df[column]):
+            values = df[column].dropna().unique()
+            if len(values) <= MAX_DISTINCT_VALUES:
+                line += f" valori: {', '.join(map(str, values))}"
+        lines.append(line)
+    return lines
+
+
+def build_plan_prompt(question: str, history: list, actions: list[str]) -> str:
+    """Prompt per classificare il follow-up; history va dalla risposta più vecchia alla più recente"""
+    previous = history[-1]
+    parts = [
+        "Sei un assistente che analizza dati di Google Search Console in una conversazione.",
+        "Decidi come rispondere alla nuova domanda dell'utente riusando, se possibile, i dati già disponibili.",
+        "\nConversazione precedente:",
+    ]
+    for answer in history[-CONTEXT_ANSWERS:]:
+        parts.append(f"- Domanda: \"{answer.question}\"")
+        if answer.sql:
+            parts.append(f"  SQL: {answer.sql}")
+    parts.extend([
+        f"\nDati della risposta precedente ({len(previous.data)} righe), colonne:",
+        *_describe_columns(previous.data),
+        f"\nNuova domanda: \"{question}\"",
+        "\nAzioni possibili:",
+        *[f"- {action}: {ACTION_LABELS[action]}" for action in actions],
+        "\nRispondi SOLO con un oggetto JSON con le chiavi:",
+        '{"action": ..., "filters": [{"column": ..., "op": ..., "value": ...}], "group_by": [...],',
+        ' "sort_by": ..., "ascending": false, "limit": null, "dimensions": [...], "reason": "..."}',
+        f"Operatori dei filtri: {', '.join(FILTER_OPS)}. Usa solo colonne esistenti.",
+        "group_by riaggrega le metriche (somma di clic e impressioni, CTR ricalcolato, posizione media pesata).",
+        "Se i dati non contengono le colonne necessarie, non usare 'transform'.",
+    ])
+    return "\n".join(parts)
+
+
+def parse_plan(text: str, actions: list[str]) -> FollowUpPlan | None:
+    """Piano dalla risposta del modello, o None se non valido"""
+    match = re.search(r"\{.*\}", text or "", re.DOTALL)
+    if not match:
+        return None
+    try:
+        raw = json.loads(match.group(0))
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(raw, dict) or raw.get('action') not in actions:
+        return None
+    filters = [
+        f for f in raw.get('filters') or []
+        if isinstance(f, dict) and f.get('column') and f.get('op') in FILTER_OPS and 'value' in f
+    ]
+    limit = raw.get('limit')
+    return FollowUpPlan(
+        action=raw['action'],
+        filters=filters,
+        group_by=[str(c) for c in raw.get('group_by') or []],
+        sort_by=raw.get('sort_by') or None,
+        ascending=bool(raw.get('ascending', False)),
+        limit=int(limit) if isinstance(limit, (int, float)) and limit > 0 else None,
+        dimensions=[d for d in raw.get('dimensions') or [] if d in GSC_DIMENSIONS],
+        reason=str(raw.get('reason') or ""),
+    )
+
+
+def plan_followup(create_completion, model: str, question: str, history: list,
+                  actions: list[str]) -> FollowUpPlan | None:
+    """Chiede all'LLM un piano per il follow-up; None se la chiamata fallisce"""
+    prompt = build_plan_prompt(question, history, actions)
+    with tracing.span('followup.plan', chars=len(prompt)) as sp:
+        try:
+            response = create_completion(
+                model=model,
+                messages=[{"role": "user", "content": prompt}],
+                temperature=1,
+                max_completion_tokens=512,
+            )
+            plan = parse_plan(response.choices[0].message.content, actions)
+        except Exception:
+            return None
+        sp.set(action=plan.action if plan else None)
+    return plan
+
+
+def _filter_mask(series: pd.Series, op: str, value) -> pd.Series:
+    if op in ('in', 'not_in'):
+        values = value if isinstance(value, list) else [value]
+        if _is_text(series):
+            mask = series.astype(str).str.lower().isin([str(v).lower() for v in values])
+        else:
+            mask = series.isin(values)
+        return ~mask if op == 'not_in' else mask
+    if op in ('contains', 'not_contains'):
+        mask = series.astype(str).str.contains(str(value), case=False, regex=False, na=False)
+        return ~mask if op == 'not_contains' else mask
+    if _is_text(series) and op in ('==', '!='):
+        mask = series.astype(str).str.lower() == str(value).lower()
+        return ~mask if op == '!=' else mask
+    value = pd.to_numeric(value) if pd.api.types.is_numeric_dtype(series) else value
+    return COMPARISONS[op](series, value)
+
+
+def reaggregate(df: pd.DataFrame, group_by: list[str]) -> pd.DataFrame:
+    """Riaggrega le metriche GSC per le colonne indicate.
+
+    Clic e impressioni si sommano, il CTR è ricalcolato e la posizione è una media
+    pesata sulle impressioni; le altre colonne numeriche si sommano.
+    """
+    numeric = [c for c in df.columns if c not in group_by and pd.api.types.is_numeric_dtype(df[c])]
+    weighted = 'position' in numeric and 'impressions' in numeric
+    work = df.copy()
+    if weighted:
+        work['_position_weight'] = work['position'] * work['impressions']
+    sums = [c for c in numeric if c not in ('ctr', 'position')]
+    if weighted:
+        sums.append('_position_weight')
+    grouped = work.groupby(group_by, dropna=False, as_index=False)
+    result = grouped[sums].sum() if sums else grouped.size().drop(columns='size')
+    if 'position' in numeric:
+        if weighted:
+            result['position'] = (result.pop('_position_weight') / result['impressions'].where(result['impressions'] > 0)).fillna(0.0)
+        else:
+            result['position'] = grouped['position'].mean()['position']
+    if 'ctr' in numeric:
+        if 'clicks' in result.columns and 'impressions' in result.columns:
+            result['ctr'] = (result['clicks'] / result['impressions'].where(result['impressions'] > 0)).fillna(0.0)
+        else:
+            result['ctr'] = grouped['ctr'].mean()['ctr']
+    return result[[c for c in df.columns if c in result.columns]]
+
+
+def apply_plan(df: pd.DataFrame, plan: FollowUpPlan) -> pd.DataFrame:
+    """Applica filtri, riaggregazione, ordinamento e limite; ValueError se il piano non è applicabile"""
+    with tracing.span('followup.apply', rows=len(df)) as sp:
+        missing = [c for c in plan.columns if c not in df.columns and c != plan.sort_by]
+        if missing:
+            raise ValueError(f"colonne non presenti nei dati: {', '.join(missing)}")
+
+        result = df
+        for f in plan.filters:
+            try:
+                result = result[_filter_mask(result[f['column']], f['op'], f['value'])]
+            except (TypeError, ValueError) as e:
+                raise ValueError(f"filtro non applicabile su {f['column']}: {e}") from e
+        if plan.group_by:
+            group_by = list(plan.group_by)
+            # Nei confronti tra periodi i due periodi restano separati
+            if 'period' in result.columns and 'period' not in group_by:
+                group_by.append('period')
+            result = reaggregate(result, group_by)
+        if plan.sort_by:
+            if plan.sort_by not in result.columns:
+                raise ValueError(f"colonna di ordinamento non presente: {plan.sort_by}")
+            result = result.sort_values(plan.sort_by, ascending=plan.ascending)
+        if plan.limit:
+            result = result.head(plan.limit)
+        sp.set(result_rows=len(result))
+    return result.reset_index(drop=True)
@@ -1,9 +1,16 @@
-import streamlit as st
+from ui import st
 import pandas as pd
-import matplotlib.pyplot as plt
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
-import openai
+
+from rate_limiter import call_with_retry, limiter, user_key
+from single_flight import fingerprint, single_flight
+import tracing
+from answer_store import Answer, ConversationStore, timed
+from charts import execute_chart_code, figure_to_png
+from clients import create_chat_completion, get_openai_client
+from followups import FollowUpPlan, GSC_DIMENSIONS, apply_plan, contextual_question, plan_followup
+from mode_router import GSC_MAX_DAYS, GSC_MAX_DIMENSIONS, QuestionProfile, RouteEstimate, typical_seconds
 
 class GSCDirectMode:
     """Classe per gestire la modalità Google Search Console Diretta"""
@@ -14,11 +21,11 @@ class GSCDirectMode:
 
         self.OPENAI_MODEL = "o4-mini"
         self.openai_api_key = st.secrets.get("openai_api_key", None)
-        if self.openai_api_key:
-            # Create an OpenAI client using the new 1.x interface
-            self.openai_client = openai.OpenAI(api_key=self.openai_api_key)
-        else:
-            self.openai_client = None
+        # Client OpenAI condiviso tra i rerun (pool HTTP keep-alive)
+        self.openai_client = get_openai_client(self.openai_api_key)
+
+    def _create_chat_completion(self, **kwargs):
+        return create_chat_completion(self.openai_client, user_key(self.session_state), **kwargs)
 
     def _get_fixed_range(self, option: str) -> tuple[pd.Timestamp, pd.Timestamp]:
         """Restituisce la coppia (start, end) per un intervallo predefinito."""
@@ -130,12 +137,14 @@ class GSCDirectMode:
         
         try:
             # Ottieni credenziali aggiornate
-            credentials = self.refresh_credentials()
+            with tracing.span('credentials.refresh'):
+                credentials = self.refresh_credentials()
             if not credentials:
                 return None
             
             # Costruisci il servizio GSC
-            service = build('searchconsole', 'v1', credentials=credentials)
+            with tracing.span('gsc.build'):
+                service = build('searchconsole', 'v1', credentials=credentials)
             
             # Prepara la richiesta
             request = {
@@ -147,28 +156,40 @@ class GSCDirectMode:
             }
             
             # Esegui la query
-            response = service.searchanalytics().query(siteUrl=site_url, body=request).execute()
+            # Richieste identiche concorrenti condividono la stessa chiamata
+            user = user_key(self.session_state)
+            with tracing.span('gsc.fetch', dimensions=",".join(dimensions), row_limit=row_limit):
+                response, shared = single_flight.do(
+                    fingerprint('gsc', user, site_url, request),
+                    lambda: call_with_retry(
+                        lambda: service.searchanalytics().query(siteUrl=site_url, body=request).execute(),
+                        'gsc', user=user, site=site_url
+                    )
+                )
+                tracing.set_attrs(rows=len(response.get('rows', [])), shared=shared)
             
             # Converti in DataFrame
             if 'rows' in response:
-                data = []
-                for row in response['rows']:
-                    row_data = {}
+                with tracing.span('gsc.to_dataframe', rows=len(response['rows'])) as sp:
+                    data = []
+                    for row in response['rows']:
+                        row_data = {}
                     
-                    # Aggiungi le dimensioni
-                    if 'keys' in row:
-                        for i, dimension in enumerate(dimensions):
-                            row_data[dimension] = row['keys'][i] if i < len(row['keys']) else None
+                        # Aggiungi le dimensioni
+                        if 'keys' in row:
+                            for i, dimension in enumerate(dimensions):
+                                row_data[dimension] = row['keys'][i] if i < len(row['keys']) else None
                     
-                    # Aggiungi le metriche
-                    row_data['clicks'] = row.get('clicks', 0)
-                    row_data['impressions'] = row.get('impressions', 0)
-                    row_data['ctr'] = row.get('ctr', 0.0)
-                    row_data['position'] = row.get('position', 0.0)
+                        # Aggiungi le metriche
+                        row_data['clicks'] = row.get('clicks', 0)
+                        row_data['impressions'] = row.get('impressions', 0)
+                        row_data['ctr'] = row.get('ctr', 0.0)
+                        row_data['position'] = row.get('position', 0.0)
                     
-                    data.append(row_data)
+                        data.append(row_data)
                 
-                df = pd.DataFrame(data)
+                    df = pd.DataFrame(data)
+                    sp.set(bytes=int(df.memory_usage(index=False).sum()))
                 return df
             else:
                 st.info("🤖💬 Nessun dato trovato per il periodo specificato")
@@ -185,20 +206,10 @@ class GSCDirectMode:
                 st.error(f"🤖💬 Errore nel recupero dati GSC: {e}")
             return None
 
-    def generate_dataframe_analysis(self, question: str, df: pd.DataFrame, project_id: str = None) -> str | None:
-        """Genera analisi AI su DataFrame invece che SQL"""
-        if df.empty:
-            return "Non ci sono dati da analizzare."
-        
-
-        # Se la chiave OpenAI non è disponibile, restituiamo un'analisi di base
-        if not self.openai_api_key:
-
-            return self._generate_basic_analysis(question, df)
-
-        try:
-            
-            # Prepara informazioni sul DataFrame
+    def _build_analysis_prompt(self, question: str, df: pd.DataFrame) -> str:
+        """Costruisce il prompt di analisi con campione, tipi e dati completi in JSON"""
+        # Prepara informazioni sul DataFrame
+        with tracing.span('prompt.build', kind='analysis', rows=len(df)) as sp:
             df_info = {
                 'columns': list(df.columns),
                 'shape': df.shape,
@@ -206,7 +217,7 @@ class GSCDirectMode:
                 'data_types': df.dtypes.to_dict(),
                 'data_json': df.to_json(orient='records')
             }
-            
+        
             prompt_parts = [
                 "Sei un esperto analista di dati di Google Search Console. Ti viene fornito un DataFrame con dati GSC e una domanda dell'utente.",
                 f"Domanda dell'utente: \"{question}\"",
@@ -221,9 +232,26 @@ class GSCDirectMode:
                 "Metti in grassetto (usando **testo**) le metriche e i dati più importanti.",
                 "Se necessario, calcola aggregazioni, trend o confronti basati sui dati forniti."
             ]
-            
+        
             full_prompt = "\n".join(prompt_parts)
-            response = self.openai_client.chat.completions.create(
+            sp.set(chars=len(full_prompt))
+        return full_prompt
+
+    def generate_dataframe_analysis(self, question: str, df: pd.DataFrame, project_id: str = None) -> str | None:
+        """Genera analisi AI su DataFrame invece che SQL"""
+        if df.empty:
+            return "Non ci sono dati da analizzare."
+        
+
+        # Se la chiave OpenAI non è disponibile, restituiamo un'analisi di base
+        if not self.openai_api_key:
+
+            return self._generate_basic_analysis(question, df)
+
+        try:
+            
+            full_prompt = self._build_analysis_prompt(question, df)
+            response = self._create_chat_completion(
                 model=self.OPENAI_MODEL,
                 messages=[{"role": "user", "content": full_prompt}],
                 temperature=1,
@@ -295,16 +323,17 @@ class GSCDirectMode:
 
         try:
 
-            if len(df) > 10:
-                data_sample = df.sample(min(10, len(df))).to_string(index=False)
-            else:
-                data_sample = df.to_string(index=False)
+            with tracing.span('prompt.build', kind='chart', rows=len(df)):
+                if len(df) > 10:
+                    data_sample = df.sample(min(10, len(df))).to_string(index=False)
+                else:
+                    data_sample = df.to_string(index=False)
             
-            column_details = []
-            for col in df.columns:
-                col_type = str(df[col].dtype)
-                column_details.append(f"- Colonna '{col}' (tipo: {col_type})")
-            column_info = "\n".join(column_details)
+                column_details = []
+                for col in df.columns:
+                    col_type = str(df[col].dtype)
+                    column_details.append(f"- Colonna '{col}' (tipo: {col_type})")
+                column_info = "\n".join(column_details)
 
             chart_prompt = f"""
 Genera codice Python usando Matplotlib per visualizzare questi dati:
@@ -328,7 +357,7 @@ Il codice deve:
 
 Restituisci SOLO il codice Python.
 """
-            response = self.openai_client.chat.completions.create(
+            response = self._create_chat_completion(
                 model=self.OPENAI_MODEL,
                 messages=[{"role": "user", "content": chart_prompt}],
                 temperature=1,
@@ -565,98 +594,264 @@ else:
                 user_question_input = question_text
                 submit_button_main = True
 
-        # Processamento domanda
+        # Ogni domanda diventa una risposta nell'archivio di sessione: i rerun la
+        # ridisegnano e calcolano solo le fasi mancanti (es. il grafico attivato dopo)
+        store = ConversationStore(self.session_state)
         if submit_button_main and user_question_input:
-            if not self.session_state.get('gsc_config'):
-                st.error("🤖💬 Per favore, completa la configurazione GSC nella sidebar.")
+            store.add(Answer(mode='gsc', question=user_question_input))
+
+        answer = store.latest('gsc')
+        if answer is None:
+            return
+        return self.show_answer(answer)
+
+    def show_answer(self, answer: Answer) -> bool:
+        """Calcola le fasi mancanti e disegna la risposta; True se è stato elaborato qualcosa"""
+        pending = answer.pending(self._answer_stages(answer))
+        if not pending:
+            self._render_answer(answer)
+            return False
+        with tracing.span('question', question=answer.question, stages=",".join(pending)):
+            self._process_question(answer)
+            self._render_answer(answer)
+        return True
+
+    def estimate_route(self, profile: QuestionProfile) -> RouteEstimate:
+        """Tempo e completezza stimati per rispondere con l'API di Search Console"""
+        config = self.session_state.get('gsc_config')
+        estimate = RouteEstimate('gsc')
+        if not config:
+            estimate.available = False
+            estimate.notes.append("configurazione GSC mancante")
+            return estimate
+        requests = 2 if config.get('compare_mode') else 1
+        wait = limiter.expected_wait('gsc', user_key(self.session_state), config['site_url'])
+        history = ConversationStore(self.session_state).history('gsc')
+        estimate.seconds = requests * wait + typical_seconds(history, 'gsc', 'data')
+        if wait > 0:
+            estimate.notes.append(f"quota API: attesa stimata {requests * wait:.1f} s")
+
+        configured_days = (pd.Timestamp(config['end_date']) - pd.Timestamp(config['start_date'])).days + 1
+        if profile.period_days and profile.period_days > GSC_MAX_DAYS:
+            estimate.available = False
+            estimate.notes.append(f"periodo di {profile.period_days} giorni oltre i 16 mesi dell'API")
+        elif profile.period_days and profile.period_days > configured_days:
+            estimate.complete = False
+            estimate.notes.append(f"periodo di {profile.period_days} giorni oltre i {configured_days} configurati")
+        missing = [d for d in profile.dimensions if d not in config['dimensions']]
+        if missing:
+            estimate.complete = False
+            estimate.notes.append(f"dimensioni non configurate: {', '.join(missing)}")
+        if len(set(config['dimensions']) | set(profile.dimensions)) > GSC_MAX_DIMENSIONS:
+            estimate.complete = False
+            estimate.notes.append(f"troppe dimensioni per il limite di {config['row_limit']} righe")
+        if profile.needs_all_rows:
+            estimate.complete = False
+            estimate.notes.append("l'API restituisce solo le righe principali e omette le query anonimizzate")
+        if profile.search_type:
+            estimate.complete = False
+            estimate.notes.append("la modalità GSC Diretta legge solo la ricerca web")
+        fetched = [a for a in history if a.data is not None and a.data_info.get('site_url') == config['site_url']]
+        if fetched and len(fetched[-1].data) >= config['row_limit'] * requests:
+            estimate.complete = False
+            estimate.notes.append(f"l'ultima risposta ha raggiunto il limite di {config['row_limit']} righe")
+        return estimate
+
+    def _answer_stages(self, answer: Answer) -> list[str]:
+        if answer.data is not None and answer.data.empty:
+            return ['data']
+        stages = ['data', 'summary']
+        if self.session_state.get('enable_chart_generation', False):
+            stages.append('chart')
+        return stages
+
+    def _process_question(self, answer: Answer):
+        """Calcola le fasi mancanti della risposta: dati GSC, analisi AI e grafico"""
+        if not self.session_state.get('gsc_config'):
+            st.error("🤖💬 Per favore, completa la configurazione GSC nella sidebar.")
+            return
+        
+        config = self.session_state.gsc_config
+        question = answer.question
+        
+        # Dati: un follow-up sugli stessi sito e periodi riusa quelli già in sessione
+        if not answer.has('data'):
+            history = self._followup_history(answer, config)
+            plan = self._plan_followup(answer, history) if history else None
+            dimensions = list(config['dimensions'])
+            gsc_data = None
+            with timed(answer, 'data'):
+                if plan is not None and plan.action == 'transform':
+                    try:
+                        gsc_data = apply_plan(history[-1].data, plan)
+                        # I dati riusati hanno le dimensioni della risposta da cui derivano
+                        dimensions = list(history[-1].data_info.get('dimensions', dimensions))
+                    except ValueError as e:
+                        st.info(f"🤖💬 I dati già recuperati non bastano ({e}): interrogo Search Console.")
+                        plan.action = 'fetch'
+                        plan.dimensions += [
+                            c for c in plan.columns
+                            if c in GSC_DIMENSIONS and c not in history[-1].data.columns
+                        ]
+                if gsc_data is None:
+                    if plan is not None:
+                        dimensions += [d for d in plan.dimensions if d not in dimensions]
+                    gsc_data = self._fetch_question_data(question, config, dimensions)
+                    self.session_state.gsc_data = gsc_data
+                    if gsc_data is not None and plan is not None and not plan.is_identity:
+                        try:
+                            gsc_data = apply_plan(gsc_data, plan)
+                        except ValueError:
+                            pass
+            if gsc_data is None:
+                answer.fail('data', "🤖💬 Errore nel recupero dei dati da Google Search Console.")
                 return
-            
-            config = self.session_state.gsc_config
-            
-            # Fetch dati da GSC
-            with st.spinner(f"🤖💬 Recuperando dati da Google Search Console per: \"{user_question_input}\""):
-                if config.get('compare_mode'):
-                    gsc_data = self.fetch_comparison_data(
-                        config['site_url'],
-                        config['start_date'],
-                        config['end_date'],
-                        config['compare_start'],
-                        config['compare_end'],
-                        config['dimensions'],
-                        config['row_limit']
-                    )
-                else:
-                    gsc_data = self.fetch_gsc_data(
-                        config['site_url'],
-                        config['start_date'],
-                        config['end_date'],
-                        config['dimensions'],
-                        config['row_limit']
-                    )
-                self.session_state.gsc_data = gsc_data
-
-            if gsc_data is not None and not gsc_data.empty:
-                with st.expander("🔍 Dati GSC Recuperati", expanded=False):
-                    st.subheader("Dataset GSC:")
-                    st.write(f"**Sito:** {config['site_url']}")
-                    if config.get('compare_mode'):
-                        st.write(
-                            f"**Periodo attuale:** {config['start_date']} - {config['end_date']}"
-                        )
-                        st.write(
-                            f"**Periodo confronto:** {config['compare_start']} - {config['compare_end']}"
-                        )
+            answer.data = gsc_data
+            answer.data_info = {
+                'site_url': config['site_url'],
+                'compare_mode': bool(config.get('compare_mode')),
+                'start_date': config['start_date'],
+                'end_date': config['end_date'],
+                'compare_start': config.get('compare_start'),
+                'compare_end': config.get('compare_end'),
+                'row_limit': config['row_limit'],
+                'config_dimensions': list(config['dimensions']),
+                'dimensions': dimensions,
+            }
+            if plan is not None:
+                answer.data_info.update({
+                    'followup_of': history[-1].question,
+                    'followup': plan.describe(),
+                    'reused': plan.action == 'transform',
+                })
+            if gsc_data.empty:
+                return
+
+        question = contextual_question(question, answer.data_info.get('followup_of'))
+        analysis_project = self.session_state.get('selected_project_id', None)
+
+        # Genera analisi AI
+        if not answer.has('summary'):
+            with timed(answer, 'summary'), st.spinner("🤖💬 Sto analizzando i dati con l'AI..."):
+                answer.summary = self.generate_dataframe_analysis(question, answer.data, analysis_project)
+            if not answer.summary:
+                answer.fail('summary', "")
+
+        # Grafico (anche attivato dopo la risposta)
+        if self.session_state.get('enable_chart_generation', False) and not answer.has('chart'):
+            with timed(answer, 'chart'), st.spinner("🤖💬 Sto generando il codice per il grafico..."):
+                answer.chart_code = self.generate_chart_code_with_llm(question, answer.data, analysis_project)
+                if not answer.chart_code:
+                    answer.fail('chart', "🤖💬 Non è stato possibile generare il codice per il grafico.")
+                    return
+                try:
+                    fig_generated = execute_chart_code(answer.chart_code, answer.data)
+                    if fig_generated is not None:
+                        answer.chart_png = figure_to_png(fig_generated)
                     else:
-                        st.write(f"**Periodo:** {config['start_date']} - {config['end_date']}")
-                    st.write(f"**Dimensioni:** {', '.join(config['dimensions'])}")
-                    st.write(f"**Righe:** {len(gsc_data)}")
-                    st.dataframe(gsc_data.head(200))
-                
-                # Genera analisi AI
-                with st.spinner("🤖💬 Sto analizzando i dati con l'AI..."):
-                    analysis_project = self.session_state.get('selected_project_id', None)
-                    analysis_summary = self.generate_dataframe_analysis(
-                        user_question_input,
-                        gsc_data,
-                        analysis_project
-                    )
-                
-                if analysis_summary:
-                    with st.chat_message("ai", avatar="🤖"):
-                        st.markdown(analysis_summary)
-
-                # Sezione grafico
-                if self.session_state.get('enable_chart_generation', False):
-                    st.markdown("---")
-                    st.subheader("📊 Visualizzazione Grafica (Beta)")
-                    with st.spinner("🤖💬 Sto generando il codice per il grafico..."):
-                        analysis_project = self.session_state.get('selected_project_id', None)
-                        chart_code = self.generate_chart_code_with_llm(
-                            user_question_input, 
-                            gsc_data,
-                            analysis_project
-                        )
-                        
-                        if chart_code:
-                            try:
-                                exec_scope = {
-                                    "plt": plt, 
-                                    "pd": pd, 
-                                    "df": gsc_data.copy(),
-                                    "fig": None
-                                }
-                                exec(chart_code, exec_scope)
-                                fig_generated = exec_scope.get("fig")
-
-                                if fig_generated is not None:
-                                    st.pyplot(fig_generated)
-                                else:
-                                    st.warning("🤖💬 L'AI ha generato codice, ma non è stato possibile creare un grafico.")
-                            except Exception as e:
-                                st.error(f"🤖💬 Errore durante l'esecuzione del codice del grafico: {e}")
-                        else:
-                            st.warning("🤖💬 Non è stato possibile generare il codice per il grafico.")
-            elif gsc_data is not None:
-                st.info("🤖💬 Nessun dato trovato per i parametri specificati.")
+                        answer.fail('chart', "🤖💬 L'AI ha generato codice, ma non è stato possibile creare un grafico.")
+                except Exception as e:
+                    answer.fail('chart', f"🤖💬 Errore durante l'esecuzione del codice del grafico: {e}")
+
+    def _followup_history(self, answer: Answer, config: dict) -> list[Answer]:
+        """Risposte GSC precedenti con dati dello stesso sito, periodi, dimensioni e limite di righe"""
+        def same_source(previous: Answer) -> bool:
+            info = previous.data_info
+            return (
+                info.get('compare_mode') == bool(config.get('compare_mode'))
+                and all(info.get(k) == config.get(k) for k in ('site_url', 'start_date', 'end_date', 'compare_start', 'compare_end', 'row_limit'))
+                and info.get('config_dimensions') == list(config['dimensions'])
+            )
+
+        return [
+            previous for previous in ConversationStore(self.session_state).history('gsc')
+            if previous is not answer and previous.data is not None and not previous.data.empty
+            and same_source(previous)
+        ]
+
+    def _plan_followup(self, answer: Answer, history: list[Answer]) -> FollowUpPlan | None:
+        """Piano per rispondere dai dati precedenti o tornare a Search Console.
+
+        Senza piano (nessuna API key, chiamata o JSON non validi) la domanda è
+        trattata come nuova: i dati precedenti si riusano solo su indicazione del modello.
+        """
+        if not self.openai_api_key:
+            return None
+        with st.spinner("🤖💬 Verifico se posso rispondere con i dati già recuperati..."):
+            return plan_followup(
+                self._create_chat_completion, self.OPENAI_MODEL,
+                answer.question, history, ['transform', 'fetch']
+            )
+
+    def _fetch_question_data(self, question: str, config: dict, dimensions: list[str]) -> pd.DataFrame | None:
+        with st.spinner(f"🤖💬 Recuperando dati da Google Search Console per: \"{question}\""):
+            if config.get('compare_mode'):
+                return self.fetch_comparison_data(
+                    config['site_url'],
+                    config['start_date'],
+                    config['end_date'],
+                    config['compare_start'],
+                    config['compare_end'],
+                    dimensions,
+                    config['row_limit']
+                )
+            return self.fetch_gsc_data(
+                config['site_url'],
+                config['start_date'],
+                config['end_date'],
+                dimensions,
+                config['row_limit']
+            )
+
+    def _render_answer(self, answer: Answer):
+        """Disegna la risposta dal record, senza chiamate a GSC o all'LLM"""
+        if 'data' in answer.errors:
+            st.error(answer.errors['data'])
+            return
+        gsc_data = answer.data
+        if gsc_data is None:
+            return
+        if gsc_data.empty:
+            st.info("🤖💬 Nessun dato trovato per i parametri specificati.")
+            return
+
+        info = answer.data_info
+        if info.get('followup_of'):
+            origin = "dai dati già recuperati" if info.get('reused') else "con un nuovo recupero da Search Console"
+            st.caption(f"↪️ Follow-up di \"{info['followup_of']}\", risposto {origin} ({info['followup']})")
+        with st.expander("🔍 Dati GSC Recuperati", expanded=False):
+            st.subheader("Dataset GSC:")
+            st.write(f"**Domanda:** {answer.question}")
+            st.write(f"**Sito:** {info['site_url']}")
+            if info.get('compare_mode'):
+                st.write(
+                    f"**Periodo attuale:** {info['start_date']} - {info['end_date']}"
+                )
+                st.write(
+                    f"**Periodo confronto:** {info['compare_start']} - {info['compare_end']}"
+                )
             else:
-                st.error("🤖💬 Errore nel recupero dei dati da Google Search Console.")
+                st.write(f"**Periodo:** {info['start_date']} - {info['end_date']}")
+            st.write(f"**Dimensioni:** {', '.join(info['dimensions'])}")
+            st.write(f"**Righe:** {len(gsc_data)}")
+            with tracing.span('render.dataframe'):
+                st.dataframe(gsc_data.head(200))
+
+        if answer.summary:
+            with st.chat_message("ai", avatar="🤖"):
+                st.markdown(answer.summary)
+
+        # Sezione grafico
+        if answer.chart_png is not None or (
+            self.session_state.get('enable_chart_generation', False) and answer.errors.get('chart')
+        ):
+            st.markdown("---")
+            st.subheader("📊 Visualizzazione Grafica (Beta)")
+            if answer.chart_png is not None:
+                with tracing.span('chart.render'):
+                    st.image(answer.chart_png)
+            else:
+                st.warning(answer.errors['chart'])
+
+        if answer.timings:
+            st.caption("⏱️ " + " · ".join(f"{stage} {seconds:.1f}s" for stage, seconds in answer.timings.items()))
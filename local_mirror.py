@@ -0,0 +1,299 @@
+"""Copia locale (Parquet + DuckDB) delle tabelle dell'export bulk di Search Console.
+
+Le partizioni `data_date` nuove delle tabelle configurate sono scaricate in
+modo incrementale, un file Parquet per tabella e giorno, con `list_rows` sul
+decoratore di partizione (nessun byte di query fatturato). La SQL per BigQuery
+è tradotta nel dialetto DuckDB con sqlglot ed eseguita sui soli file dei giorni
+letti; se la traduzione fallisce o mancano giorni in locale si torna a BigQuery.
+
+Funzionalità opzionale: attiva con `local_mirror_path` nei secrets e con i
+pacchetti duckdb e pyarrow installati.
+"""
+import contextvars
+import datetime
+import importlib.util
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from rate_limiter import call_with_retry
+import tracing
+from schema_cache import DatasetSchema, TableSchema
+from sql_analysis import enforce_partition_filters, parse
+
+LOCAL_DIALECT = 'duckdb'
+# Giorni copiati in locale; le query su periodi più lunghi vanno su BigQuery
+DEFAULT_MIRROR_DAYS = 120
+# Oltre questa età la copia non risponde (potrebbe mancare l'ultimo giorno esportato)
+DEFAULT_MAX_AGE_HOURS = 24
+SYNC_WORKERS = 4
+# Durata dell'esito del controllo di accesso ai dati per utente e tabella
+ACCESS_TTL_SECONDS = 15 * 60
+METADATA_FILE = '_mirror.json'
+
+
+def is_available() -> bool:
+    return all(importlib.util.find_spec(name) is not None for name in ('duckdb', 'pyarrow'))
+
+
+@dataclass
+class SyncReport:
+    downloaded: dict[str, int] = field(default_factory=dict)  # tabella -> giorni scaricati
+    local_days: dict[str, int] = field(default_factory=dict)  # tabella -> giorni in locale
+    rows: int = 0
+    removed: int = 0
+    skipped: list[str] = field(default_factory=list)  # tabelle non partizionate per giorno
+    errors: dict[str, str] = field(default_factory=dict)
+
+    def describe(self) -> str:
+        days = sum(self.downloaded.values())
+        parts = [f"{days} giorni scaricati ({self.rows} righe)"]
+        if self.removed:
+            parts.append(f"{self.removed} giorni rimossi")
+        if self.skipped:
+            parts.append(f"non copiate: {', '.join(self.skipped)}")
+        return "; ".join(parts)
+
+
+@dataclass
+class LocalQuery:
+    sql: str  # dialetto DuckDB
+    files: dict[str, list[str]]  # vista (table_id) -> file Parquet dei giorni letti
+
+
+class LocalMirror:
+    """File Parquet per tabella e giorno, interrogati con DuckDB"""
+
+    def __init__(self, root: str, days: int = DEFAULT_MIRROR_DAYS, max_age_hours: float = DEFAULT_MAX_AGE_HOURS):
+        self.root = root
+        self.days = days
+        self.max_age = max_age_hours * 3600
+        self.lock = threading.Lock()
+        self.stats = {'local': 0, 'fallback': 0, 'synced_days': 0, 'denied': 0}
+        self.access = {}  # (utente, tabella) -> (può leggere i dati, controllato alle)
+        self.access_lock = threading.Lock()
+
+    def can_read(self, user: str, table_id: str, check) -> bool:
+        """Se l'utente può leggere i dati della tabella su BigQuery.
+
+        La copia è condivisa dal processo: chi ha solo accesso ai metadati non deve
+        leggerne le righe. check() interroga BigQuery (True/False); l'esito resta
+        in cache per ACCESS_TTL_SECONDS, un errore di rete non viene memorizzato.
+        """
+        key = (user, table_id)
+        with self.access_lock:
+            entry = self.access.get(key)
+        if entry is not None and time.time() - entry[1] < ACCESS_TTL_SECONDS:
+            return entry[0]
+        try:
+            allowed = bool(check())
+        except Exception:
+            return False
+        with self.access_lock:
+            self.access[key] = (allowed, time.time())
+        if not allowed:
+            self.stats['denied'] += 1
+        return allowed
+
+    def table_dir(self, table: TableSchema) -> str:
+        return os.path.join(self.root, table.project_id, table.dataset_id, table.table_id)
+
+    def _day_path(self, table: TableSchema, day: datetime.date) -> str:
+        return os.path.join(self.table_dir(table), f"{day:%Y%m%d}.parquet")
+
+    def metadata(self, table: TableSchema) -> dict:
+        try:
+            with open(os.path.join(self.table_dir(table), METADATA_FILE), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return {}
+
+    def _write_metadata(self, table: TableSchema, metadata: dict):
+        path = os.path.join(self.table_dir(table), METADATA_FILE)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(metadata, f)
+        os.replace(tmp_path, path)
+
+    def local_days(self, table: TableSchema) -> set[datetime.date]:
+        directory = self.table_dir(table)
+        if not os.path.isdir(directory):
+            return set()
+        days = set()
+        for name in os.listdir(directory):
+            if not name.endswith('.parquet'):
+                continue
+            try:
+                days.add(datetime.datetime.strptime(name[:8], '%Y%m%d').date())
+            except ValueError:
+                continue
+        return days
+
+    def _download_day(self, client, table: TableSchema, day: datetime.date, bqstorage_client, user: str | None) -> int:
+        import pyarrow.parquet as pq
+
+        with tracing.span('mirror.download', table=table.table_id, day=day.isoformat()) as sp:
+            rows = call_with_retry(
+                lambda: client.list_rows(f"{table.full_id}${day:%Y%m%d}").to_arrow(bqstorage_client=bqstorage_client),
+                'bigquery', user=user
+            )
+            path = self._day_path(table, day)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            pq.write_table(rows, tmp_path, compression='zstd')
+            os.replace(tmp_path, path)
+            sp.set(rows=rows.num_rows)
+        return rows.num_rows
+
+    def sync(self, client, schema: DatasetSchema, user: str | None = None, bqstorage_client=None,
+             today: datetime.date | None = None, on_progress=None) -> SyncReport:
+        """Scarica i giorni nuovi delle tabelle e rimuove quelli fuori finestra.
+
+        on_progress(tabella, giorni_fatti, giorni_da_fare) è chiamata dopo ogni giorno.
+        """
+        today = today or datetime.date.today()
+        # Stessa finestra del filtro di default: gli ultimi N giorni, oggi compreso
+        oldest = today - datetime.timedelta(days=self.days - 1)
+        report = SyncReport()
+        tables = [schema.tables[t] for t in schema.requested if t in schema.tables]
+        with self.lock, tracing.span('mirror.sync', tables=len(tables)):
+            for table in tables:
+                if not table.partition_field or (table.partition_type or 'DAY') != 'DAY':
+                    report.skipped.append(table.table_id)
+                    continue
+                try:
+                    partitions = call_with_retry(lambda: client.list_partitions(table.full_id), 'bigquery', user=user)
+                except Exception as e:
+                    report.errors[table.table_id] = str(e)
+                    continue
+                remote = {
+                    datetime.datetime.strptime(p, '%Y%m%d').date()
+                    for p in partitions if len(p) == 8 and p.isdigit()
+                }
+                wanted = {day for day in remote if day >= oldest}
+                local = self.local_days(table)
+                missing = sorted(wanted - local, reverse=True)  # prima i giorni recenti
+                os.makedirs(self.table_dir(table), exist_ok=True)
+
+                done = 0
+                with ThreadPoolExecutor(max_workers=SYNC_WORKERS, thread_name_prefix="chatgsc-mirror") as pool:
+                    futures = {
+                        day: pool.submit(
+                            contextvars.copy_context().run,
+                            self._download_day, client, table, day, bqstorage_client, user
+                        )
+                        for day in missing
+                    }
+                    for day, future in futures.items():
+                        try:
+                            report.rows += future.result()
+                            done += 1
+                        except Exception as e:
+                            report.errors[f"{table.table_id}${day:%Y%m%d}"] = str(e)
+                        if on_progress:
+                            on_progress(table.table_id, done, len(missing))
+
+                for day in local:
+                    if day < oldest:
+                        os.remove(self._day_path(table, day))
+                        report.removed += 1
+
+                report.downloaded[table.table_id] = done
+                report.local_days[table.table_id] = len(self.local_days(table))
+                self.stats['synced_days'] += done
+                self._write_metadata(table, {
+                    'earliest_remote': min(remote).isoformat() if remote else None,
+                    'latest_remote': max(remote).isoformat() if remote else None,
+                    'synced_at': time.time(),
+                })
+        return report
+
+    def prepare(self, sql: str, schema: DatasetSchema | None,
+                today: datetime.date | None = None) -> tuple[LocalQuery | None, str]:
+        """Query DuckDB equivalente e file da leggere, oppure None con il motivo per BigQuery"""
+        from sqlglot import exp
+
+        today = today or datetime.date.today()
+        if schema is None:
+            return None, "schema non disponibile"
+        try:
+            tree = parse(sql)
+        except Exception as e:
+            return None, f"SQL non analizzabile: {e}"
+        report = enforce_partition_filters(sql, schema, self.days, today)
+        if not report.parsed or report.rewritten:
+            return None, "query senza filtro su data_date"
+
+        # Giorni letti per tabella, dai filtri di partizione
+        needed: dict[str, set] = {}
+        for scan in report.scans:
+            table = schema.table(scan.table)
+            metadata = self.metadata(table)
+            if time.time() - metadata.get('synced_at', 0) > self.max_age:
+                return None, f"copia locale di {table.table_id} non aggiornata"
+            if scan.start is None:
+                return None, "periodo della query non determinabile"
+            if not metadata.get('latest_remote'):
+                return None, f"nessun dato esportato per {table.table_id}"
+            start = max(scan.start, datetime.date.fromisoformat(metadata['earliest_remote']))
+            end = min(scan.end or today, datetime.date.fromisoformat(metadata['latest_remote']))
+            days = {start + datetime.timedelta(days=i) for i in range((end - start).days + 1)}
+            missing = days - self.local_days(table)
+            if missing:
+                return None, f"{len(missing)} giorni di {table.table_id} non presenti in locale"
+            needed.setdefault(table.table_id, set()).update(days)
+
+        # Tabelle BigQuery -> viste DuckDB sui file Parquet
+        ctes = {cte.alias_or_name for cte in tree.find_all(exp.CTE)}
+        files = {}
+        for node in list(tree.find_all(exp.Table)):
+            name = ".".join(p for p in (node.catalog, node.db, node.name) if p)
+            if not node.db and node.name in ctes:
+                continue
+            table = schema.table(name)
+            if table is None:
+                return None, f"tabella non copiata in locale: {name}"
+            if table.table_id not in needed:
+                return None, f"periodo non determinabile per {table.table_id}"
+            files[table.table_id] = [self._day_path(table, day) for day in sorted(needed[table.table_id])]
+            node.set('catalog', None)
+            node.set('db', None)
+            node.set('this', exp.to_identifier(table.table_id))
+        if not files:
+            return None, "nessuna tabella dell'export nella query"
+        try:
+            local_sql = tree.sql(dialect=LOCAL_DIALECT)
+        except Exception as e:
+            return None, f"traduzione per DuckDB non riuscita: {e}"
+        return LocalQuery(local_sql, files), ""
+
+    def run(self, query: LocalQuery):
+        """Esegue la query in DuckDB (connessione in memoria) e ritorna un DataFrame"""
+        import duckdb
+
+        with tracing.span('mirror.query', tables=len(query.files)) as sp:
+            con = duckdb.connect()
+            try:
+                for view, paths in query.files.items():
+                    con.read_parquet(paths).create_view(view)
+                df = con.execute(query.sql).df()
+            finally:
+                con.close()
+            sp.set(rows=len(df), files=sum(len(p) for p in query.files.values()))
+        return df
+
+
+_mirrors: dict[str, LocalMirror] = {}
+_mirrors_lock = threading.Lock()
+
+
+def get_local_mirror(root: str, days: int = DEFAULT_MIRROR_DAYS,
+                     max_age_hours: float = DEFAULT_MAX_AGE_HOURS) -> LocalMirror:
+    """Copia locale condivisa dal processo per la cartella indicata"""
+    with _mirrors_lock:
+        mirror = _mirrors.get(root)
+        if mirror is None or (mirror.days, mirror.max_age) != (days, max_age_hours * 3600):
+            mirror = _mirrors[root] = LocalMirror(root, days, max_age_hours)
+        return mirror
@@ -0,0 +1,156 @@
+"""Scelta automatica tra GSC Diretta e BigQuery per ogni domanda.
+
+Ogni modalità stima da sé tempo e completezza della risposta: l'API di Search
+Console ha limiti di righe, di storico e di quota, BigQuery ha il dry-run, la
+cache dei risultati e la copia locale. I tempi sono le mediane delle ultime
+risposte della sessione, con valori iniziali prudenti. Una risposta GSC
+incompleta passa a BigQuery; altrimenti vince la più veloce, a pari tempi GSC
+(nessun byte fatturato).
+"""
+import re
+import statistics
+from dataclasses import dataclass, field
+
+from example_store import tokenize
+from query_budget import format_bytes
+from schema_pruning import APPEARANCE_WORDS, SYNONYMS
+
+MODE_LABELS = {'gsc': "🔍 Google Search Console", 'bigquery': "📊 BigQuery"}
+# Storico disponibile nell'API Search Analytics (16 mesi)
+GSC_MAX_DAYS = 486
+# Oltre due dimensioni le righe superano facilmente il limite per richiesta
+GSC_MAX_DIMENSIONS = 2
+# Secondi per fase prima di avere misure nella sessione
+DEFAULT_SECONDS = {
+    ('gsc', 'data'): 2.0,
+    ('bigquery', 'sql'): 5.0,
+    ('bigquery', 'data'): 4.0,
+}
+# Risultato già in cache o dalla copia locale
+INSTANT_SECONDS = 0.3
+TIMING_SAMPLES = 5
+# Provenienze dei dati che non misurano il tempo della fonte
+REUSED_SOURCES = ('cache', 'local', 'followup')
+
+# Dimensioni GSC richiamate dalle parole della domanda
+DIMENSION_WORDS = {
+    'query': ('query', 'queri', 'parol', 'keyword', 'chiav'),
+    'page': SYNONYMS['url'],
+    'device': SYNONYMS['device'],
+    'country': SYNONYMS['country'],
+    'searchAppearance': APPEARANCE_WORDS,
+}
+# Domande su elenchi completi: l'API restituisce solo le righe principali e omette
+# le query anonimizzate
+COMPLETE_WORDS = ('tutt', 'intero', 'complet', 'lunga', 'long', 'tail', 'anonim', 'distint')
+# Conteggi di query o pagine distinte
+COUNT_WORDS = ('quante', 'quanti', 'numero', 'conteggi', 'count', 'divers')
+# Tipi di ricerca non richiesti dalla modalità GSC Diretta (solo web)
+SEARCH_TYPE_WORDS = ('immagin', 'image', 'video', 'news', 'notizi', 'discover')
+PERIOD_UNITS = {'giorn': 1, 'day': 1, 'settiman': 7, 'week': 7, 'mes': 30, 'month': 30, 'ann': 365, 'year': 365}
+PERIOD_PATTERN = re.compile(r"(\d+)\s*(giorn|gg|day|settiman|week|mes|month|ann|year)")
+
+
+def _matches(tokens: list[str], words) -> bool:
+    """Parole brevi esatte (es. "rich", "usa"), le altre come prefisso"""
+    return any(t == w or (len(w) > 4 and t.startswith(w)) for t in tokens for w in words)
+
+
+@dataclass
+class QuestionProfile:
+    dimensions: list[str]  # dimensioni GSC necessarie
+    period_days: int | None  # periodo esplicito nella domanda
+    needs_all_rows: bool
+    search_type: bool  # immagini, video, news, Discover
+
+
+def profile_question(question: str) -> QuestionProfile:
+    """Cosa chiede la domanda: dimensioni, periodo e completezza dei dati"""
+    tokens = tokenize(question)
+    text = question.lower()
+    days = None
+    for amount, unit in PERIOD_PATTERN.findall(text):
+        factor = 1 if unit == 'gg' else next(v for k, v in PERIOD_UNITS.items() if unit.startswith(k))
+        days = max(days or 0, int(amount) * factor)
+    if days is None and ('anno scorso' in text or 'yoy' in tokens or 'anno precedente' in text):
+        days = 2 * 365
+    elif days is None and ('ultimo anno' in text or 'ultimi 12 mesi' in text):
+        days = 365
+    dimensions = [d for d, words in DIMENSION_WORDS.items() if _matches(tokens, words)]
+    # "quante"/"quanti" sono parole vuote per tokenize: qui servono
+    words = re.findall(r"\w+", text)
+    counts_items = _matches(words, COUNT_WORDS) and bool({'query', 'page'} & set(dimensions))
+    return QuestionProfile(
+        dimensions=dimensions,
+        period_days=days,
+        needs_all_rows=counts_items or _matches(tokens, COMPLETE_WORDS),
+        search_type=_matches(tokens, SEARCH_TYPE_WORDS),
+    )
+
+
+def typical_seconds(answers: list, mode: str, stage: str) -> float:
+    """Mediana della fase nelle ultime risposte misurate, o il valore iniziale"""
+    samples = [
+        a.timings[stage] for a in answers
+        if stage in a.timings and stage not in a.errors
+        and a.data_info.get('source') not in REUSED_SOURCES and not a.data_info.get('reused')
+    ][-TIMING_SAMPLES:]
+    return statistics.median(samples) if samples else DEFAULT_SECONDS[(mode, stage)]
+
+
+@dataclass
+class RouteEstimate:
+    mode: str  # 'gsc' | 'bigquery'
+    available: bool = True
+    complete: bool = True
+    seconds: float | None = None
+    bytes_processed: int | None = None
+    bytes_upper_bound: bool = False  # stima dai metadati, senza dry-run
+    notes: list[str] = field(default_factory=list)
+
+    def describe(self) -> str:
+        parts = [MODE_LABELS[self.mode]]
+        if not self.available:
+            parts.append("non disponibile")
+        else:
+            parts.append(f"~{self.seconds:.1f} s" if self.seconds is not None else "tempo n/d")
+            if self.bytes_processed is not None:
+                prefix = "≤ " if self.bytes_upper_bound else ""
+                parts.append(f"{prefix}{format_bytes(self.bytes_processed)} elaborati")
+            parts.append("dati completi" if self.complete else "dati incompleti")
+        text = " · ".join(parts)
+        return f"{text} ({'; '.join(self.notes)})" if self.notes else text
+
+
+@dataclass
+class RouteDecision:
+    mode: str | None  # None: nessuna modalità può rispondere
+    reason: str
+    estimates: dict[str, RouteEstimate]
+
+    def describe(self) -> str:
+        if self.mode is None:
+            return f"Nessuna modalità può rispondere: {self.reason}"
+        return f"Modalità scelta: {MODE_LABELS[self.mode]}, {self.reason}"
+
+
+def choose_mode(gsc: RouteEstimate, bigquery: RouteEstimate) -> RouteDecision:
+    """Completezza prima di tutto, poi il tempo stimato; a pari tempi GSC"""
+    estimates = {'gsc': gsc, 'bigquery': bigquery}
+    if not gsc.available and not bigquery.available:
+        reasons = [f"{MODE_LABELS[e.mode]}: {'; '.join(e.notes) or 'non disponibile'}" for e in (gsc, bigquery)]
+        return RouteDecision(None, " · ".join(reasons), estimates)
+    if not bigquery.available:
+        return RouteDecision('gsc', "BigQuery non disponibile", estimates)
+    if not gsc.available:
+        return RouteDecision('bigquery', "Search Console non può rispondere", estimates)
+    if not gsc.complete:
+        return RouteDecision('bigquery', "con l'API di Search Console i dati sarebbero incompleti", estimates)
+    if bigquery.seconds < gsc.seconds:
+        return RouteDecision(
+            'bigquery', f"più veloce (~{bigquery.seconds:.1f} s contro ~{gsc.seconds:.1f} s)", estimates
+        )
+    return RouteDecision(
+        'gsc', f"più veloce o equivalente (~{gsc.seconds:.1f} s contro ~{bigquery.seconds:.1f} s) e senza costi di query",
+        estimates
+    )
@@ -0,0 +1,135 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+
+PROFILE_DIR = os.getenv("CHATGSC_PROFILE_DIR", "profiles")
+
+
+class StackSampler:
+    """Campionatore di stack di un thread (per flame graph), basato su sys._current_frames"""
+
+    def __init__(self, thread_id: int, interval: float = 0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = {}
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="chatgsc-profiler", daemon=True)
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+                frame = frame.f_back
+            stack = tuple(reversed(stack))
+            self.samples[stack] = self.samples.get(stack, 0) + 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+
+class RenderProfile:
+    """Profilo di un singolo render(): cProfile deterministico più campioni di stack"""
+
+    def __init__(self, name: str, sample_interval: float = 0.005):
+        self.name = name
+        self.sample_interval = sample_interval
+        self.profiler = cProfile.Profile()
+        self.sampler = None
+        self.duration = 0.0
+
+    def run(self, func, *args, **kwargs):
+        """Esegue func sotto profilazione e ne ritorna il risultato"""
+        self.sampler = StackSampler(threading.get_ident(), self.sample_interval)
+        self.sampler.start()
+        start = time.perf_counter()
+        self.profiler.enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.profiler.disable()
+            self.duration = time.perf_counter() - start
+            self.sampler.stop()
+
+    def top_functions(self, limit: int = 20, sort: str = 'cumulative') -> list[dict]:
+        """Funzioni più costose secondo cProfile"""
+        stats = pstats.Stats(self.profiler, stream=io.StringIO())
+        stats.sort_stats(sort)
+        rows = []
+        for func in stats.fcn_list[:limit]:
+            cc, nc, tottime, cumtime, _ = stats.stats[func]
+            filename, line, name = func
+            rows.append({
+                'funzione': name,
+                'file': f"{os.path.basename(filename)}:{line}",
+                'chiamate': nc,
+                'tottime_ms': round(tottime * 1000, 2),
+                'cumtime_ms': round(cumtime * 1000, 2),
+            })
+        return rows
+
+    def collapsed_stacks(self) -> str:
+        """Formato 'collapsed' (flamegraph.pl / inferno): una riga per stack con conteggio"""
+        lines = []
+        for stack, count in sorted(self.sampler.samples.items()):
+            lines.append(";".join(f"{name} ({os.path.basename(f)}:{line})" for name, f, line in stack) + f" {count}")
+        return "\n".join(lines) + "\n"
+
+    def speedscope(self) -> dict:
+        """Profilo 'sampled' nel formato di https://www.speedscope.app"""
+        frames, frame_index, samples, weights = [], {}, [], []
+        for stack, count in self.sampler.samples.items():
+            indices = []
+            for name, filename, line in stack:
+                key = (name, filename, line)
+                if key not in frame_index:
+                    frame_index[key] = len(frames)
+                    frames.append({'name': name, 'file': filename, 'line': line})
+                indices.append(frame_index[key])
+            samples.append(indices)
+            weights.append(count * self.sample_interval)
+        return {
+            '$schema': "https://www.speedscope.app/file-format-schema.json",
+            'shared': {'frames': frames},
+            'profiles': [{
+                'type': 'sampled',
+                'name': self.name,
+                'unit': 'seconds',
+                'startValue': 0,
+                'endValue': sum(weights),
+                'samples': samples,
+                'weights': weights,
+            }],
+            'name': self.name,
+            'exporter': 'chatgsc',
+        }
+
+    def save(self, profile_dir: str = None) -> dict:
+        """Salva .prof (pstats), .speedscope.json e .collapsed.txt; ritorna i percorsi"""
+        profile_dir = profile_dir or PROFILE_DIR
+        os.makedirs(profile_dir, exist_ok=True)
+        base = os.path.join(profile_dir, f"{time.strftime('%Y%m%d-%H%M%S')}_{self.name}")
+        paths = {
+            'pstats': base + ".prof",
+            'speedscope': base + ".speedscope.json",
+            'collapsed': base + ".collapsed.txt",
+        }
+        self.profiler.dump_stats(paths['pstats'])
+        with open(paths['speedscope'], "w", encoding="utf-8") as f:
+            json.dump(self.speedscope(), f)
+        with open(paths['collapsed'], "w", encoding="utf-8") as f:
+            f.write(self.collapsed_stacks())
+        return paths
@@ -0,0 +1,91 @@
+"""Stima dei costi (dry-run) e limiti di byte fatturati per le query BigQuery.
+
+I limiti sono configurabili da secrets (`bq_max_gb_per_query`,
+`bq_max_gb_per_session`, `bq_price_per_tib_usd`) e dalla sidebar; il consumo
+della sessione è tenuto in session_state.
+"""
+from dataclasses import dataclass
+
+GB = 1000 ** 3
+TIB = 1024 ** 4
+
+# Prezzo on-demand di BigQuery (USD per TiB elaborato)
+PRICE_PER_TIB_USD = 6.25
+DEFAULT_MAX_GB_PER_QUERY = 10.0
+DEFAULT_MAX_GB_PER_SESSION = 100.0
+# Tentativi di restringimento della query chiesti al modello prima di bloccarla
+MAX_NARROWING_ATTEMPTS = 2
+
+
+def format_bytes(num_bytes: int | None) -> str:
+    if num_bytes is None:
+        return "n/d"
+    value = float(num_bytes)
+    for unit in ("B", "KB", "MB", "GB", "TB"):
+        if value < 1000 or unit == "TB":
+            return f"{value:.0f} {unit}" if unit == "B" else f"{value:.2f} {unit}"
+        value /= 1000
+
+
+@dataclass
+class CostEstimate:
+    """Esito del dry-run confrontato con i limiti per query e per sessione"""
+    bytes_processed: int
+    price_per_tib: float
+    max_bytes_per_query: int
+    session_remaining_bytes: int
+
+    @property
+    def cost_usd(self) -> float:
+        return self.bytes_processed / TIB * self.price_per_tib
+
+    @property
+    def allowed_bytes(self) -> int:
+        return max(0, min(self.max_bytes_per_query, self.session_remaining_bytes))
+
+    @property
+    def over_budget(self) -> bool:
+        return self.bytes_processed > self.allowed_bytes
+
+    def reason(self) -> str:
+        """Motivo del blocco, da restituire anche al modello per restringere la query"""
+        if self.bytes_processed > self.max_bytes_per_query:
+            return (f"la query elaborerebbe {format_bytes(self.bytes_processed)}, oltre il limite "
+                    f"per query di {format_bytes(self.max_bytes_per_query)}")
+        return (f"la query elaborerebbe {format_bytes(self.bytes_processed)}, ma restano solo "
+                f"{format_bytes(self.session_remaining_bytes)} del budget di sessione")
+
+    def describe(self) -> str:
+        return (f"📏 Stima dry-run: {format_bytes(self.bytes_processed)} elaborati "
+                f"(~${self.cost_usd:.4f}) · limite {format_bytes(self.allowed_bytes)}")
+
+
+def _setting(session_state, secrets, key: str, default: float) -> float:
+    value = session_state.get(key)
+    if value is None:
+        value = secrets.get(key, default)
+    return float(value)
+
+
+def limits(session_state, secrets) -> tuple[int, int, float]:
+    """(byte massimi per query, byte rimanenti nella sessione, prezzo per TiB)"""
+    per_query = int(_setting(session_state, secrets, 'bq_max_gb_per_query', DEFAULT_MAX_GB_PER_QUERY) * GB)
+    per_session = int(_setting(session_state, secrets, 'bq_max_gb_per_session', DEFAULT_MAX_GB_PER_SESSION) * GB)
+    price = float(secrets.get('bq_price_per_tib_usd', PRICE_PER_TIB_USD))
+    used = session_state.get('bq_session_bytes_billed', 0) or 0
+    return per_query, max(0, per_session - used), price
+
+
+def estimate(bytes_processed: int, session_state, secrets) -> CostEstimate:
+    per_query, remaining, price = limits(session_state, secrets)
+    return CostEstimate(
+        bytes_processed=int(bytes_processed or 0),
+        price_per_tib=price,
+        max_bytes_per_query=per_query,
+        session_remaining_bytes=remaining,
+    )
+
+
+def record_billed(session_state, bytes_billed: int | None):
+    """Somma i byte fatturati al consumo della sessione"""
+    session_state.bq_session_bytes_billed = (session_state.get('bq_session_bytes_billed', 0) or 0) + int(bytes_billed or 0)
@@ -0,0 +1,195 @@
+import hashlib
+import random
+import threading
+import time
+
+# Limiti documentati delle API (richieste al secondo).
+# Search Analytics: 1.200 QPM per sito e per utente, 40.000 QPM per progetto.
+# BigQuery API: 100 richieste al secondo per utente.
+API_LIMITS = {
+    'gsc': {
+        'project': (40000 / 60, 200),
+        'user': (1200 / 60, 20),
+        'site': (1200 / 60, 20),
+    },
+    'bigquery': {
+        'project': (300, 300),
+        'user': (100, 100),
+    },
+}
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+QUOTA_REASONS = ('quotaExceeded', 'rateLimitExceeded', 'userRateLimitExceeded')
+
+
+class TokenBucket:
+    """Token bucket thread-safe con ricarica continua"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float):
+        elapsed = now - self.updated_at
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated_at = now
+
+    def acquire(self) -> float:
+        """Preleva un token attendendo se necessario. Ritorna i secondi di attesa."""
+        waited = 0.0
+        while True:
+            with self.lock:
+                self._refill(time.monotonic())
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def wait_time(self) -> float:
+        """Secondi di attesa per il prossimo token, senza prelevarlo"""
+        with self.lock:
+            self._refill(time.monotonic())
+            return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """Limiter process-wide con bucket per progetto, utente e sito"""
+
+    def __init__(self, limits: dict = None):
+        self.limits = limits or API_LIMITS
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def _bucket(self, api: str, scope: str, key: str) -> TokenBucket | None:
+        limit = self.limits.get(api, {}).get(scope)
+        if not limit:
+            return None
+        bucket_key = (api, scope, key)
+        with self.lock:
+            bucket = self.buckets.get(bucket_key)
+            if bucket is None:
+                bucket = TokenBucket(*limit)
+                self.buckets[bucket_key] = bucket
+            return bucket
+
+    def acquire(self, api: str, user: str = None, site: str = None) -> float:
+        """Attende un token da tutti i bucket pertinenti e registra l'attesa"""
+        waited = 0.0
+        for scope, key in (('project', 'default'), ('user', user), ('site', site)):
+            if key is None:
+                continue
+            bucket = self._bucket(api, scope, key)
+            if bucket is not None:
+                waited += bucket.acquire()
+        self._record(api, wait_seconds=waited)
+        return waited
+
+    def expected_wait(self, api: str, user: str = None, site: str = None) -> float:
+        """Attesa stimata per la prossima richiesta (il bucket più scarico), senza consumare token"""
+        waits = [0.0]
+        for scope, key in (('project', 'default'), ('user', user), ('site', site)):
+            if key is None:
+                continue
+            bucket = self._bucket(api, scope, key)
+            if bucket is not None:
+                waits.append(bucket.wait_time())
+        return max(waits)
+
+    def _record(self, api: str, wait_seconds: float | None = None, retries: int = 0, failures: int = 0):
+        with self.lock:
+            m = self.metrics.setdefault(api, {
+                'requests': 0, 'wait_seconds_total': 0.0, 'wait_seconds_max': 0.0,
+                'retries': 0, 'failures': 0,
+            })
+            if wait_seconds is not None:
+                m['requests'] += 1
+                m['wait_seconds_total'] += wait_seconds
+                m['wait_seconds_max'] = max(m['wait_seconds_max'], wait_seconds)
+            m['retries'] += retries
+            m['failures'] += failures
+
+    def metrics_snapshot(self) -> dict:
+        """Copia delle metriche del limiter per API"""
+        with self.lock:
+            return {api: dict(values) for api, values in self.metrics.items()}
+
+
+def _status_code(exc: Exception) -> int | None:
+    """Estrae lo status HTTP da eccezioni googleapiclient / google-api-core"""
+    resp = getattr(exc, 'resp', None)
+    if resp is not None and getattr(resp, 'status', None) is not None:
+        return int(resp.status)
+    code = getattr(exc, 'code', None)
+    if isinstance(code, int):
+        return code
+    status = getattr(exc, 'status_code', None)
+    return status if isinstance(status, int) else None
+
+
+def _retry_after(exc: Exception) -> float | None:
+    """Legge l'header Retry-After (in secondi) se presente"""
+    headers = getattr(exc, 'resp', None)
+    if headers is None:
+        response = getattr(exc, 'response', None)
+        headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    try:
+        value = headers.get('retry-after') or headers.get('Retry-After')
+        return float(value) if value is not None else None
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+
+def is_retryable(exc: Exception) -> bool:
+    """True per errori 429/5xx o 403 dovuti a quota"""
+    status = _status_code(exc)
+    if status in RETRYABLE_STATUS:
+        return True
+    if status == 403 and any(reason in str(exc) for reason in QUOTA_REASONS):
+        return True
+    return False
+
+
+def backoff_delay(attempt: int, base: float = 0.5, cap: float = 32.0) -> float:
+    """Backoff esponenziale con full jitter"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def call_with_retry(func, api: str, user: str = None, site: str = None, max_retries: int = 5):
+    """Esegue func passando dal limiter, con retry su 429/5xx e rispetto di Retry-After"""
+    attempt = 0
+    while True:
+        limiter.acquire(api, user=user, site=site)
+        try:
+            return func()
+        except Exception as e:
+            if attempt >= max_retries or not is_retryable(e):
+                limiter._record(api, failures=1)
+                raise
+            delay = _retry_after(e)
+            if delay is None:
+                delay = backoff_delay(attempt)
+            limiter._record(api, retries=1)
+            time.sleep(delay)
+            attempt += 1
+
+
+def user_key(session_state) -> str:
+    """Identificativo stabile e non sensibile dell'utente della sessione"""
+    email = session_state.get('user_email')
+    if email:
+        return email
+    token = session_state.get('refresh_token') or session_state.get('access_token') or ''
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()[:16]
+
+
+# Istanza condivisa da tutte le sessioni del processo
+limiter = RateLimiter()
@@ -0,0 +1,85 @@
+"""Cache process-wide dei risultati delle query BigQuery.
+
+La chiave (calcolata da BigQueryMode) combina SQL normalizzata e data di
+modifica delle tabelle lette, quindi una nuova partizione dell'export
+invalida le voci da sola. I risultati sono conservati come file Arrow IPC
+compressi (zstd), con un limite complessivo in byte e rimozione LRU.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+MAX_CACHE_BYTES = 256 * 1024 * 1024
+COMPRESSION = 'zstd'
+
+
+def _to_arrow_bytes(df) -> bytes:
+    import pyarrow as pa
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    options = pa.ipc.IpcWriteOptions(compression=COMPRESSION)
+    with pa.ipc.new_file(sink, table.schema, options=options) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def _from_arrow_bytes(payload: bytes):
+    import pyarrow as pa
+
+    return pa.ipc.open_file(pa.BufferReader(payload)).read_all().to_pandas()
+
+
+class ResultCache:
+    """LRU di risultati compressi, per utente, con limite complessivo in byte"""
+
+    def __init__(self, max_bytes: int = MAX_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # (utente, chiave) -> (payload, attrs, salvato_il)
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'stored': 0, 'evicted': 0}
+
+    def get(self, user: str, key: str):
+        """DataFrame in cache (nuova copia ad ogni lettura) o None"""
+        with self.lock:
+            entry = self.entries.get((user, key))
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self.entries.move_to_end((user, key))
+            self.stats['hits'] += 1
+        payload, attrs, stored_at = entry
+        df = _from_arrow_bytes(payload)
+        df.attrs.update(attrs)
+        df.attrs['cached_at'] = stored_at
+        return df
+
+    def contains(self, user: str, key: str) -> bool:
+        with self.lock:
+            return (user, key) in self.entries
+
+    def put(self, user: str, key: str, df):
+        payload = _to_arrow_bytes(df)
+        if len(payload) > self.max_bytes:
+            return
+        attrs = {k: v for k, v in df.attrs.items() if isinstance(v, (str, int, float, bool, type(None)))}
+        with self.lock:
+            previous = self.entries.pop((user, key), None)
+            if previous is not None:
+                self.total_bytes -= len(previous[0])
+            self.entries[(user, key)] = (payload, attrs, time.time())
+            self.total_bytes += len(payload)
+            self.stats['stored'] += 1
+            while self.total_bytes > self.max_bytes:
+                evicted = self.entries.popitem(last=False)[1]
+                self.total_bytes -= len(evicted[0])
+                self.stats['evicted'] += 1
+
+    def invalidate(self, user: str | None = None):
+        with self.lock:
+            for entry_key in [k for k in self.entries if user is None or k[0] == user]:
+                self.total_bytes -= len(self.entries.pop(entry_key)[0])
+
+
+result_cache = ResultCache()
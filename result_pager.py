@@ -0,0 +1,80 @@
+"""Navigazione a pagine dei risultati BigQuery grandi.
+
+Il risultato resta nella tabella di destinazione del job (tabella temporanea
+valida 24 ore) e viene letto una pagina alla volta con `list_rows`; la pagina
+successiva è precaricata in background e le ultime pagine restano in una
+piccola cache LRU.
+"""
+import math
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from rate_limiter import call_with_retry
+
+PAGE_SIZE = 200
+CACHE_PAGES = 8
+# Oltre questa soglia il risultato non viene scaricato per intero
+PAGED_RESULT_ROWS = 5_000
+# Righe scaricate come campione per riassunto e grafico
+SAMPLE_ROWS = 1_000
+
+
+class ResultPager:
+    """Pagine di una tabella di destinazione, con prefetch e cache LRU"""
+
+    def __init__(self, client, table, schema, total_rows: int, user: str = None,
+                 page_size: int = PAGE_SIZE, cache_pages: int = CACHE_PAGES):
+        self.client = client
+        self.table = table
+        self.schema = schema
+        self.total_rows = total_rows
+        self.user = user
+        self.page_size = page_size
+        self.cache_pages = cache_pages
+        self.pages = OrderedDict()  # indice -> Future del DataFrame
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="chatgsc-pager")
+
+    @property
+    def page_count(self) -> int:
+        return max(1, math.ceil(self.total_rows / self.page_size))
+
+    def _fetch(self, index: int):
+        return call_with_retry(
+            lambda: self.client.list_rows(
+                self.table,
+                selected_fields=self.schema,
+                start_index=index * self.page_size,
+                max_results=self.page_size,
+            ).to_dataframe(),
+            'bigquery', user=self.user
+        )
+
+    def _future(self, index: int):
+        with self.lock:
+            future = self.pages.get(index)
+            if future is not None and not (future.done() and future.exception() is not None):
+                self.pages.move_to_end(index)
+                return future
+            future = self.executor.submit(self._fetch, index)
+            self.pages[index] = future
+            self.pages.move_to_end(index)
+            while len(self.pages) > self.cache_pages:
+                self.pages.popitem(last=False)
+            return future
+
+    def page(self, index: int):
+        """DataFrame della pagina index (0-based); precarica la successiva"""
+        index = min(max(0, index), self.page_count - 1)
+        future = self._future(index)
+        if index + 1 < self.page_count:
+            self._future(index + 1)
+        return future.result()
+
+    def cached_pages(self) -> int:
+        with self.lock:
+            return sum(1 for future in self.pages.values() if future.done())
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
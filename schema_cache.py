@@ -0,0 +1,209 @@
+"""Schema delle tabelle BigQuery: caricamento concorrente e cache per tabella.
+
+Lo schema è conservato come oggetto strutturato (DatasetSchema/TableSchema) così
+le fasi successive (validazione SQL, pruning del prompt) lo riusano senza
+chiamate di rete. La cache è process-wide, per utente e project.dataset.table.
+"""
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from rate_limiter import call_with_retry
+import tracing
+
+# Entro questo intervallo lo schema in cache è usato senza chiamate di rete;
+# oltre, viene rivalidato confrontando etag e data di ultima modifica
+REVALIDATE_AFTER_SECONDS = 10 * 60
+MAX_FETCH_WORKERS = 8
+
+
+@dataclass(frozen=True)
+class ColumnSchema:
+    name: str
+    field_type: str
+    mode: str = 'NULLABLE'
+    description: str | None = None
+    fields: tuple = ()  # sottocampi dei RECORD
+
+    @classmethod
+    def from_field(cls, schema_field) -> "ColumnSchema":
+        return cls(
+            name=schema_field.name,
+            field_type=schema_field.field_type,
+            mode=getattr(schema_field, 'mode', None) or 'NULLABLE',
+            description=schema_field.description or None,
+            fields=tuple(cls.from_field(f) for f in (getattr(schema_field, 'fields', None) or ())),
+        )
+
+
+@dataclass(frozen=True)
+class TableSchema:
+    project_id: str
+    dataset_id: str
+    table_id: str
+    columns: tuple[ColumnSchema, ...]
+    etag: str | None = None
+    modified: object = None  # datetime dell'ultima modifica
+    num_rows: int | None = None
+    num_bytes: int | None = None
+    partition_field: str | None = None
+    partition_type: str | None = None
+
+    @classmethod
+    def from_table(cls, table) -> "TableSchema":
+        partitioning = getattr(table, 'time_partitioning', None)
+        return cls(
+            project_id=table.project,
+            dataset_id=table.dataset_id,
+            table_id=table.table_id,
+            columns=tuple(ColumnSchema.from_field(f) for f in table.schema),
+            etag=getattr(table, 'etag', None),
+            modified=getattr(table, 'modified', None),
+            num_rows=getattr(table, 'num_rows', None),
+            num_bytes=getattr(table, 'num_bytes', None),
+            partition_field=getattr(partitioning, 'field', None) if partitioning else None,
+            partition_type=getattr(partitioning, 'type_', None) if partitioning else None,
+        )
+
+    @property
+    def full_id(self) -> str:
+        return f"{self.project_id}.{self.dataset_id}.{self.table_id}"
+
+    @property
+    def column_names(self) -> list[str]:
+        return [c.name for c in self.columns]
+
+    def column(self, name: str) -> ColumnSchema | None:
+        lowered = name.lower()
+        for c in self.columns:
+            if c.name.lower() == lowered:
+                return c
+        return None
+
+    def same_version(self, table) -> bool:
+        """True se la tabella remota ha lo stesso etag/data di modifica"""
+        if self.etag and getattr(table, 'etag', None):
+            return self.etag == table.etag
+        return self.modified is not None and self.modified == getattr(table, 'modified', None)
+
+    def to_prompt(self, columns: list[str] | None = None) -> str:
+        """Descrizione per il prompt; columns limita le colonne incluse"""
+        selected = self.columns if columns is None else [c for c in self.columns if c.name in columns]
+        columns_desc = []
+        for c in selected:
+            description = f" (Descrizione: {c.description})" if c.description else ""
+            columns_desc.append(f"  - {c.name} ({c.field_type}){description}")
+        return f"Tabella: `{self.full_id}`\nColonne:\n" + "\n".join(columns_desc)
+
+
+@dataclass
+class DatasetSchema:
+    project_id: str
+    dataset_id: str
+    requested: tuple[str, ...]
+    tables: dict[str, TableSchema] = field(default_factory=dict)
+    errors: dict[str, str] = field(default_factory=dict)
+
+    def table(self, name: str) -> TableSchema | None:
+        """Cerca per table_id, dataset.table o project.dataset.table"""
+        name = name.strip('`')
+        table_id = name.split('.')[-1]
+        schema = self.tables.get(table_id)
+        if schema is None:
+            return None
+        if name.count('.') == 2 and name.lower() != schema.full_id.lower():
+            return None
+        if name.count('.') == 1 and name.split('.')[0].lower() != schema.dataset_id.lower():
+            return None
+        return schema
+
+    def to_prompt(self, columns_by_table: dict[str, list[str]] | None = None) -> str:
+        parts = []
+        for table_id in self.requested:
+            if table_id in self.tables:
+                columns = (columns_by_table or {}).get(table_id)
+                parts.append(self.tables[table_id].to_prompt(columns))
+            else:
+                parts.append(f"# Errore nel recupero schema per tabella: {self.project_id}.{self.dataset_id}.{table_id}")
+        return "\n\n".join(parts)
+
+
+class SchemaCache:
+    """Cache process-wide degli schemi, per utente e tabella, con rivalidazione"""
+
+    def __init__(self, revalidate_after: float = REVALIDATE_AFTER_SECONDS):
+        self.revalidate_after = revalidate_after
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'revalidated': 0, 'changed': 0, 'misses': 0}
+
+    def _count(self, stat: str):
+        with self.lock:
+            self.stats[stat] += 1
+
+    def _load(self, client, user: str, project_id: str, dataset_id: str, table_id: str,
+              max_age: float | None = None) -> TableSchema:
+        key = (user, f"{project_id}.{dataset_id}.{table_id}")
+        max_age = self.revalidate_after if max_age is None else max_age
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None and time.monotonic() - entry[1] < max_age:
+            self._count('hits')
+            return entry[0]
+
+        table_ref = client.dataset(dataset_id, project=project_id).table(table_id)
+        with tracing.span('bq.get_table', table=table_id, cached=entry is not None):
+            table = call_with_retry(lambda: client.get_table(table_ref), 'bigquery', user=user)
+
+        if entry is not None and entry[0].same_version(table):
+            # Tabella invariata: si conserva l'oggetto già costruito
+            schema = entry[0]
+            self._count('revalidated')
+        else:
+            schema = TableSchema.from_table(table)
+            self._count('changed' if entry is not None else 'misses')
+        with self.lock:
+            self.entries[key] = (schema, time.monotonic())
+        return schema
+
+    def get(self, client, user: str, project_id: str, dataset_id: str, table_ids: list[str],
+            max_age: float | None = None) -> DatasetSchema:
+        """Schema delle tabelle richieste; le tabelle mancanti sono caricate in parallelo.
+
+        max_age (secondi) sostituisce l'intervallo di rivalidazione, es. per leggere
+        la data di modifica aggiornata delle tabelle.
+        """
+        result = DatasetSchema(project_id, dataset_id, tuple(table_ids))
+        if not table_ids:
+            return result
+
+        def load(table_id):
+            return self._load(client, user, project_id, dataset_id, table_id, max_age)
+
+        with tracing.span('bq.schema', tables=len(table_ids)):
+            workers = min(MAX_FETCH_WORKERS, len(table_ids))
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="chatgsc-schema") as pool:
+                # Ogni task eredita lo span corrente per il tracing
+                futures = {
+                    table_id: pool.submit(contextvars.copy_context().run, load, table_id)
+                    for table_id in table_ids
+                }
+            for table_id, future in futures.items():
+                try:
+                    result.tables[table_id] = future.result()
+                except Exception as e:
+                    result.errors[table_id] = str(e)
+        return result
+
+    def invalidate(self, user: str | None = None):
+        with self.lock:
+            if user is None:
+                self.entries.clear()
+            else:
+                for key in [k for k in self.entries if k[0] == user]:
+                    del self.entries[key]
+
+
+schema_cache = SchemaCache()
@@ -0,0 +1,153 @@
+"""Schema ridotto alle tabelle e colonne pertinenti alla domanda.
+
+Lo schema completo (in particolare `searchdata_url_impression`, con decine di
+colonne booleane sull'aspetto nei risultati) domina i token del prompt SQL.
+Le colonne sono scelte confrontando le parole della domanda con nomi,
+descrizioni e sinonimi; un nucleo di colonne è sempre incluso. Tra le tabelle
+si tengono le più strette che coprono le colonne richieste.
+"""
+from dataclasses import dataclass
+
+import tracing
+from example_store import tokenize
+from schema_cache import DatasetSchema, TableSchema
+
+# Sempre incluse, se presenti nella tabella
+CORE_COLUMNS = ('data_date', 'query', 'url', 'clicks', 'impressions')
+# Prefisso minimo per confrontare parole e radici (es. "dispositiv")
+MIN_STEM = 4
+# Stima grossolana dei token del prompt
+CHARS_PER_TOKEN = 4
+
+# Parole della domanda che richiamano una colonna (prefissi, minuscolo, senza accenti)
+SYNONYMS = {
+    'url': ('pagin', 'page', 'url', 'landing', 'articol', 'percors'),
+    'device': ('dispositiv', 'device', 'mobile', 'desktop', 'tablet', 'smartphone', 'cellular'),
+    'country': ('paes', 'nazion', 'country', 'countr', 'estero', 'geograf', 'itali', 'usa'),
+    'search_type': ('immagin', 'image', 'video', 'news', 'notizi', 'discover', 'tipo', 'type'),
+    'sum_top_position': ('posizion', 'position', 'ranking', 'rank', 'classific'),
+    'sum_position': ('posizion', 'position', 'ranking', 'rank', 'classific'),
+    'site_url': ('sito', 'siti', 'propriet', 'site', 'domini'),
+    'is_anonymized_query': ('anonim', 'anonym'),
+    'is_anonymized_discover': ('anonim', 'anonym'),
+}
+# Le colonne is_* descrivono l'aspetto nei risultati (rich result, AMP, FAQ...)
+APPEARANCE_WORDS = ('aspett', 'appearance', 'rich', 'snippet', 'funzionalit', 'feature')
+# Parole delle descrizioni troppo generiche per indicare una colonna
+NAME_FILLERS = frozenset(('sum', 'top', 'and', 'rich', 'result'))
+GENERIC_WORDS = frozenset(('risultato', 'risultati', 'dettaglio', 'elenco', 'dato', 'dati', 'giorno', 'ricerca', 'somma'))
+
+
+def estimate_tokens(text: str) -> int:
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def _stems(text: str) -> set[str]:
+    return {token[:MIN_STEM] if len(token) > MIN_STEM else token for token in tokenize(text)}
+
+
+def _matches(words: set[str], stems: set[str], candidates) -> bool:
+    for candidate in candidates:
+        stem = candidate[:MIN_STEM] if len(candidate) > MIN_STEM else candidate
+        if stem in stems or candidate in words:
+            return True
+    return False
+
+
+def relevant_columns(table: TableSchema, question: str) -> set[str]:
+    """Colonne della tabella richiamate dalla domanda (senza il nucleo)"""
+    words = set(tokenize(question))
+    stems = _stems(question)
+    selected = set()
+    for column in table.columns:
+        # Le parti del nome uguali a colonne del nucleo (es. is_anonymized_query) non bastano
+        name_parts = [
+            p for p in column.name.lower().split('_')
+            if len(p) >= 3 and p not in NAME_FILLERS and (p not in CORE_COLUMNS or p == column.name)
+        ]
+        candidates = list(SYNONYMS.get(column.name, ())) + name_parts
+        if column.description and column.name not in SYNONYMS:
+            candidates += [
+                t for t in tokenize(column.description)
+                if len(t) > MIN_STEM and t not in GENERIC_WORDS
+            ]
+        if _matches(words, stems, candidates):
+            selected.add(column.name)
+    # Domanda generica sull'aspetto nei risultati: tutte le colonne is_* dell'aspetto
+    if not any(c.startswith('is_') and c not in SYNONYMS for c in selected) and _matches(words, stems, APPEARANCE_WORDS):
+        selected |= {c for c in table.column_names if c.startswith('is_') and c not in SYNONYMS}
+    return selected
+
+
+def _concept(column: str):
+    """Colonne con gli stessi sinonimi (es. sum_position e sum_top_position) sono equivalenti"""
+    return SYNONYMS.get(column, column)
+
+
+@dataclass
+class PrunedSchema:
+    prompt: str
+    full_tokens: int
+    pruned_tokens: int
+    columns_by_table: dict[str, list[str]]
+    total_columns: int
+
+    @property
+    def pruned(self) -> bool:
+        return self.pruned_tokens < self.full_tokens
+
+    @property
+    def saved_tokens(self) -> int:
+        return self.full_tokens - self.pruned_tokens
+
+    def describe(self) -> str:
+        kept = sum(len(columns) for columns in self.columns_by_table.values())
+        percent = 100 * self.saved_tokens / self.full_tokens if self.full_tokens else 0
+        return (
+            f"Schema ridotto a {', '.join(self.columns_by_table)}: {kept}/{self.total_columns} colonne, "
+            f"~{self.pruned_tokens} token invece di ~{self.full_tokens} (-{percent:.0f}%)"
+        )
+
+
+def prune_schema(schema: DatasetSchema, question: str, full_prompt: str | None = None) -> PrunedSchema:
+    """Schema per il prompt limitato alle tabelle e colonne pertinenti alla domanda"""
+    full_prompt = full_prompt if full_prompt is not None else schema.to_prompt()
+    tables = [schema.tables[t] for t in schema.requested if t in schema.tables]
+    total_columns = sum(len(t.columns) for t in tables)
+    with tracing.span('schema.prune', tables=len(tables)) as sp:
+        matched = {t.table_id: relevant_columns(t, question) for t in tables}
+        concepts = {table_id: {_concept(c) for c in columns} for table_id, columns in matched.items()}
+        uncovered = set().union(*concepts.values()) if concepts else set()
+
+        # Copertura greedy delle colonne richieste: prima la tabella che ne copre di più,
+        # a parità la più stretta; senza colonne richieste basta la tabella più stretta
+        kept = []
+        candidates = sorted(tables, key=lambda t: len(t.columns))
+        while candidates and (uncovered or not kept):
+            best = max(candidates, key=lambda t: len(concepts[t.table_id] & uncovered))
+            kept.append(best)
+            candidates.remove(best)
+            uncovered -= concepts[best.table_id]
+
+        columns_by_table = {}
+        for table in kept:
+            keep = set(CORE_COLUMNS) | matched[table.table_id]
+            if table.partition_field:
+                keep.add(table.partition_field)
+            columns_by_table[table.table_id] = [c for c in table.column_names if c in keep]
+        parts = [
+            schema.tables[t].to_prompt(columns_by_table[t])
+            for t in schema.requested if t in columns_by_table
+        ]
+        prompt = "\n\n".join(parts)
+        result = PrunedSchema(
+            prompt=prompt,
+            full_tokens=estimate_tokens(full_prompt),
+            pruned_tokens=estimate_tokens(prompt),
+            columns_by_table=columns_by_table,
+            total_columns=total_columns,
+        )
+        if not result.pruned:
+            result.prompt, result.pruned_tokens = full_prompt, result.full_tokens
+        sp.set(full_tokens=result.full_tokens, pruned_tokens=result.pruned_tokens)
+    return result
@@ -0,0 +1,73 @@
+import hashlib
+import json
+import threading
+
+
+def fingerprint(*parts) -> str:
+    """Fingerprint normalizzato di una richiesta (ordine delle chiavi irrilevante)"""
+    payload = json.dumps(parts, sort_keys=True, default=str, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        # Leader interrotto senza risultato (rerun/stop di Streamlit, KeyboardInterrupt)
+        self.aborted = False
+
+
+class SingleFlight:
+    """Coalizza richieste identiche in volo: una sola chiamata upstream, risultato condiviso"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.stats = {'leaders': 0, 'shared': 0}
+
+    def do(self, key: str, func):
+        """Esegue func una sola volta per key tra i chiamanti concorrenti.
+
+        Ritorna (risultato, shared) dove shared è True se il risultato
+        è stato prodotto dalla chiamata di un altro thread. Se il leader viene
+        interrotto senza risultato, chi attende riprova diventando leader.
+        """
+        while True:
+            with self.lock:
+                call = self.calls.get(key)
+                if call is not None:
+                    self.stats['shared'] += 1
+                    leader = False
+                else:
+                    call = _Call()
+                    self.calls[key] = call
+                    self.stats['leaders'] += 1
+                    leader = True
+
+            if leader:
+                break
+            call.done.wait()
+            if call.aborted:
+                continue
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = func()
+        except Exception as e:
+            call.error = e
+            raise
+        except BaseException:
+            call.aborted = True
+            raise
+        finally:
+            with self.lock:
+                self.calls.pop(key, None)
+            call.done.set()
+        return call.result, False
+
+
+# Gruppo condiviso da tutte le sessioni del processo
+single_flight = SingleFlight()
@@ -0,0 +1,547 @@
+"""Analisi statica della SQL generata (sqlglot, dialetto BigQuery).
+
+Le tabelle dell'export GSC (searchdata_*) sono partizionate per `data_date`:
+`enforce_partition_filters` verifica che ogni scansione di una tabella
+partizionata abbia un predicato sargable sulla colonna di partizione (anche
+nella query che legge una CTE o una subquery), ne aggiunge uno di default
+quando manca e riporta le partizioni lette.
+`validate_sql` controlla sintassi, tabelle, colonne e GROUP BY contro lo
+schema in cache prima di qualsiasi chiamata a BigQuery. `normalize_sql` e
+`referenced_tables` forniscono la chiave della cache dei risultati.
+"""
+import calendar
+import datetime
+from dataclasses import dataclass, field
+
+from schema_cache import DatasetSchema
+
+DIALECT = "bigquery"
+# Finestra aggiunta alle scansioni senza filtro sulla partizione
+DEFAULT_PARTITION_DAYS = 28
+# Tentativi di correzione chiesti al modello per SQL non valida
+MAX_REPAIR_ATTEMPTS = 2
+GSC_PARTITION_FIELD = 'data_date'
+# Livelli di CTE e subquery risaliti per trovare un filtro sulla partizione
+MAX_NESTING = 8
+
+
+@dataclass
+class PartitionScan:
+    """Scansione di una tabella partizionata in una SELECT"""
+    table: str
+    partition_field: str
+    start: datetime.date | None = None
+    end: datetime.date | None = None
+    injected: bool = False
+    # La query usa la colonna di partizione senza un predicato sargable per ogni
+    # lettura (es. EXTRACT, FORMAT_DATE): la scansione non è potata
+    unpruned: bool = False
+
+    @property
+    def days(self) -> int | None:
+        if self.start is None or self.end is None:
+            return None
+        return max(0, (self.end - self.start).days + 1)
+
+    def describe(self) -> str:
+        table = self.table.split('.')[-1]
+        if self.start is None:
+            window = "limite inferiore non determinabile"
+        else:
+            end = self.end.isoformat() if self.end else "oggi"
+            window = f"dal {self.start.isoformat()} al {end}"
+            if self.days is not None:
+                window += f" ({self.days} {'partizione' if self.days == 1 else 'partizioni'})"
+        note = " · filtro predefinito aggiunto" if self.injected else ""
+        if self.unpruned:
+            note = " · filtro sulla data non sargable, nessuna partizione esclusa"
+        return f"`{table}`: {self.partition_field} {window}{note}"
+
+
+@dataclass
+class PartitionReport:
+    sql: str
+    scans: list[PartitionScan] = field(default_factory=list)
+    parsed: bool = True
+    error: str | None = None
+
+    @property
+    def rewritten(self) -> bool:
+        return any(scan.injected for scan in self.scans)
+
+    @property
+    def unpruned(self) -> list[PartitionScan]:
+        return [scan for scan in self.scans if scan.unpruned]
+
+    def describe(self) -> str:
+        if not self.parsed:
+            return f"🗂️ Analisi partizioni non disponibile: {self.error}"
+        if not self.scans:
+            return "🗂️ Nessuna tabella partizionata nella query."
+        return "🗂️ Partizioni lette:\n" + "\n".join(f"- {scan.describe()}" for scan in self.scans)
+
+
+def parse(sql: str):
+    import sqlglot
+
+    return sqlglot.parse_one(sql, read=DIALECT)
+
+
+# Funzioni il cui risultato dipende dal giorno di esecuzione
+_VOLATILE_FUNCTIONS = ('CurrentDate', 'CurrentDatetime', 'CurrentTimestamp', 'CurrentTime')
+
+
+def normalize_sql(sql: str) -> str:
+    """Forma canonica della SQL: spazi, maiuscole delle keyword, letterali e commenti"""
+    try:
+        return parse(sql).sql(dialect=DIALECT, comments=False)
+    except Exception:
+        return " ".join(sql.split())
+
+
+def referenced_tables(sql: str) -> list[str] | None:
+    """Tabelle lette dalla query (escluse le CTE), None se la SQL non è analizzabile"""
+    try:
+        from sqlglot import exp
+
+        tree = parse(sql)
+    except Exception:
+        return None
+    cte_names = {cte.alias_or_name.lower() for cte in tree.find_all(exp.CTE)}
+    tables = []
+    for table in tree.find_all(exp.Table):
+        if not table.name or (not table.db and table.name.lower() in cte_names):
+            continue
+        name = ".".join(p for p in (table.catalog, table.db, table.name) if p)
+        if name not in tables:
+            tables.append(name)
+    return tables
+
+
+def is_volatile(sql: str) -> bool:
+    """True se la query usa CURRENT_DATE() & co. (risultato diverso ogni giorno)"""
+    try:
+        tree = parse(sql)
+    except Exception:
+        return True
+    return any(type(node).__name__ in _VOLATILE_FUNCTIONS for node in tree.walk())
+
+
+def partition_field_for(table_schema) -> str | None:
+    """Colonna di partizione; per le tabelle searchdata_* si assume data_date"""
+    if table_schema.partition_field:
+        return table_schema.partition_field
+    if table_schema.table_id.startswith('searchdata_') and table_schema.column(GSC_PARTITION_FIELD):
+        return GSC_PARTITION_FIELD
+    return None
+
+
+def _sources(select) -> list:
+    """(sorgente, join) del FROM e delle JOIN di una SELECT; join è None per il FROM"""
+    sources = []
+    from_clause = select.args.get("from") or select.args.get("from_")
+    if from_clause is not None:
+        sources.append((from_clause.this, None))
+    for join in select.args.get("joins") or []:
+        sources.append((join.this, join))
+    return sources
+
+
+def _source_tables(select) -> list:
+    """(tabella, join) lette direttamente da una SELECT; join è None per il FROM"""
+    from sqlglot import exp
+
+    return [(table, join) for table, join in _sources(select) if isinstance(table, exp.Table)]
+
+
+def _source_predicates(select, join) -> list:
+    """Predicati del WHERE e dell'eventuale ON che filtrano una sorgente"""
+    where = select.args.get("where")
+    predicates = list(_conjuncts(where.this)) if where is not None else []
+    on = join.args.get("on") if join is not None else None
+    if on is not None:
+        predicates.extend(_conjuncts(on))
+    return predicates
+
+
+def _conjuncts(node):
+    from sqlglot import exp
+
+    if isinstance(node, exp.And):
+        yield from _conjuncts(node.this)
+        yield from _conjuncts(node.expression)
+    elif isinstance(node, exp.Paren):
+        yield from _conjuncts(node.this)
+    else:
+        yield node
+
+
+def _is_partition_column(node, column: str, qualifier: str, single_source: bool) -> bool:
+    from sqlglot import exp
+
+    if not isinstance(node, exp.Column) or node.name.lower() != column.lower():
+        return False
+    if not node.table:
+        return single_source
+    return node.table.lower() == qualifier.lower()
+
+
+def _references_column(predicates: list, column: str, qualifier: str, single_source: bool) -> bool:
+    """La colonna di partizione compare in almeno un predicato, anche dentro funzioni"""
+    from sqlglot import exp
+
+    return any(
+        _is_partition_column(node, column, qualifier, single_source)
+        for predicate in predicates for node in predicate.find_all(exp.Column)
+    )
+
+
+def _projected_name(select, column: str) -> str | None:
+    """Nome con cui la SELECT espone la colonna di partizione, o None"""
+    from sqlglot import exp
+
+    for projection in select.expressions:
+        if isinstance(projection, exp.Star) or (
+            isinstance(projection, exp.Column) and isinstance(projection.this, exp.Star)
+        ):
+            return column
+        source = projection.unalias()
+        if isinstance(source, exp.Column) and source.name.lower() == column.lower():
+            return projection.alias_or_name
+    return None
+
+
+def _consumers(select) -> list:
+    """(SELECT che legge il risultato, sorgente) per una CTE o una subquery in FROM/JOIN"""
+    from sqlglot import exp
+
+    node = select
+    while isinstance(node.parent, exp.Union):
+        node = node.parent
+    parent = node.parent
+    if isinstance(parent, exp.Subquery) and isinstance(parent.parent, (exp.From, exp.Join)):
+        consumer = parent.parent.parent
+        return [(consumer, parent)] if isinstance(consumer, exp.Select) else []
+    if isinstance(parent, exp.CTE):
+        name = parent.alias_or_name.lower()
+        return [
+            (consumer, source)
+            for consumer in select.root().find_all(exp.Select)
+            for source, _ in _sources(consumer)
+            if isinstance(source, exp.Table) and not source.db and source.name.lower() == name
+        ]
+    return []
+
+
+def _outer_bounds(select, column: str, today: datetime.date, depth: int = 0):
+    """Filtri sulla colonna di partizione applicati da chi legge una CTE o una subquery.
+
+    BigQuery li spinge fino alla scansione, quindi potano come un filtro interno.
+    Ritorna (stato, inizio, fine): stato è 'bounded' se ogni lettore ha un predicato
+    sargable, 'referenced' se almeno uno usa la colonna in altro modo, altrimenti None.
+    """
+    name = _projected_name(select, column)
+    consumers = _consumers(select) if name and depth < MAX_NESTING else []
+    results = []
+    for consumer, source in consumers:
+        join = next((j for s, j in _sources(consumer) if s is source), None)
+        predicates = _source_predicates(consumer, join)
+        single_source = len(_sources(consumer)) == 1
+        qualifier = source.alias_or_name
+        found, start, end = _partition_bounds(predicates, name, qualifier, single_source, today)
+        if found:
+            results.append(('bounded', start, end))
+        elif _references_column(predicates, name, qualifier, single_source):
+            results.append(('referenced', None, None))
+        else:
+            results.append(_outer_bounds(consumer, name, today, depth + 1))
+
+    states = {state for state, _, _ in results}
+    if states == {'bounded'}:
+        starts = [start for _, start, _ in results]
+        ends = [end for _, _, end in results]
+        return 'bounded', None if None in starts else min(starts), None if None in ends else max(ends)
+    if states - {None}:
+        return 'referenced', None, None
+    return None, None, None
+
+
+def _shift(day: datetime.date, amount: int, unit: str) -> datetime.date:
+    unit = unit.upper()
+    if unit == 'DAY':
+        return day + datetime.timedelta(days=amount)
+    if unit == 'WEEK':
+        return day + datetime.timedelta(weeks=amount)
+    months = {'MONTH': 1, 'QUARTER': 3, 'YEAR': 12}.get(unit)
+    if months is None:
+        raise ValueError(unit)
+    total = day.year * 12 + day.month - 1 + amount * months
+    year, month = divmod(total, 12)
+    month += 1
+    return day.replace(year=year, month=month, day=min(day.day, calendar.monthrange(year, month)[1]))
+
+
+def evaluate_date(node, today: datetime.date) -> datetime.date | None:
+    """Valuta espressioni di data semplici (letterali, CURRENT_DATE, DATE_SUB/DATE_ADD, DATE_TRUNC)"""
+    from sqlglot import exp
+
+    if node is None:
+        return None
+    if isinstance(node, exp.Literal) and node.is_string:
+        try:
+            return datetime.date.fromisoformat(node.this[:10])
+        except ValueError:
+            return None
+    if isinstance(node, exp.CurrentDate):
+        return today
+    if isinstance(node, (exp.DateSub, exp.DateAdd)):
+        base = evaluate_date(node.this, today)
+        amount_node = node.expression
+        unit_node = node.args.get("unit")
+        if isinstance(amount_node, exp.Interval):
+            unit_node = amount_node.args.get("unit") or unit_node
+            amount_node = amount_node.this
+        if base is None or not isinstance(amount_node, exp.Literal):
+            return None
+        try:
+            amount = int(amount_node.name)
+            unit = unit_node.name if unit_node is not None else 'DAY'
+            sign = -1 if isinstance(node, exp.DateSub) else 1
+            return _shift(base, sign * amount, unit)
+        except ValueError:
+            return None
+    if isinstance(node, exp.DateTrunc):
+        base = evaluate_date(node.this, today)
+        unit = node.text('unit').upper()
+        if base is None:
+            return None
+        if unit == 'DAY':
+            return base
+        if unit == 'WEEK':
+            # Le settimane di BigQuery iniziano la domenica
+            return base - datetime.timedelta(days=(base.weekday() + 1) % 7)
+        if unit == 'MONTH':
+            return base.replace(day=1)
+        if unit == 'QUARTER':
+            return base.replace(month=3 * ((base.month - 1) // 3) + 1, day=1)
+        if unit == 'YEAR':
+            return base.replace(month=1, day=1)
+        return None
+    if isinstance(node, (exp.Cast, exp.Paren)) or type(node).__name__ in ('Date', 'TsOrDsToDate', 'StrToDate'):
+        return evaluate_date(node.this, today)
+    return None
+
+
+# Operatore visto con la colonna a destra (es. '2025-01-01' <= data_date)
+_FLIPPED = {'GT': 'LT', 'GTE': 'LTE', 'LT': 'GT', 'LTE': 'GTE', 'EQ': 'EQ'}
+
+
+def _partition_bounds(predicates: list, column: str, qualifier: str, single_source: bool, today: datetime.date):
+    """(trovato, inizio, fine) dai predicati sargable sulla colonna di partizione"""
+    from sqlglot import exp
+
+    found = False
+    start = end = None
+
+    def tighten(lower=None, upper=None):
+        nonlocal start, end
+        if lower is not None:
+            start = lower if start is None else max(start, lower)
+        if upper is not None:
+            end = upper if end is None else min(end, upper)
+
+    for predicate in predicates:
+        if isinstance(predicate, exp.Between) and _is_partition_column(predicate.this, column, qualifier, single_source):
+            found = True
+            tighten(evaluate_date(predicate.args.get("low"), today), evaluate_date(predicate.args.get("high"), today))
+        elif isinstance(predicate, exp.In) and _is_partition_column(predicate.this, column, qualifier, single_source):
+            found = True
+            values = [evaluate_date(v, today) for v in predicate.expressions]
+            if values and all(values):
+                tighten(min(values), max(values))
+        elif isinstance(predicate, (exp.GT, exp.GTE, exp.LT, exp.LTE, exp.EQ)):
+            op = type(predicate).__name__
+            if _is_partition_column(predicate.this, column, qualifier, single_source):
+                value = evaluate_date(predicate.expression, today)
+            elif _is_partition_column(predicate.expression, column, qualifier, single_source):
+                op = _FLIPPED[op]
+                value = evaluate_date(predicate.this, today)
+            else:
+                continue
+            found = True
+            if value is None:
+                continue
+            if op == 'GT':
+                tighten(lower=value + datetime.timedelta(days=1))
+            elif op == 'GTE':
+                tighten(lower=value)
+            elif op == 'LT':
+                tighten(upper=value - datetime.timedelta(days=1))
+            elif op == 'LTE':
+                tighten(upper=value)
+            else:
+                tighten(value, value)
+    return found, start, end
+
+
+def enforce_partition_filters(
+    sql: str,
+    schema: DatasetSchema | None,
+    default_days: int = DEFAULT_PARTITION_DAYS,
+    today: datetime.date | None = None,
+) -> PartitionReport:
+    """Aggiunge un filtro di default sulle scansioni non potate e riporta le partizioni lette"""
+    today = today or datetime.date.today()
+    if schema is None:
+        return PartitionReport(sql, parsed=False, error="schema non disponibile")
+    try:
+        from sqlglot import exp
+
+        tree = parse(sql)
+    except Exception as e:
+        return PartitionReport(sql, parsed=False, error=str(e))
+
+    report = PartitionReport(sql)
+    for select in list(tree.find_all(exp.Select)):
+        tables = _source_tables(select)
+        for table, join in tables:
+            table_name = ".".join(p for p in (table.catalog, table.db, table.name) if p)
+            table_schema = schema.table(table_name)
+            column = partition_field_for(table_schema) if table_schema else None
+            if column is None:
+                continue
+
+            qualifier = table.alias_or_name
+            predicates = _source_predicates(select, join)
+            found, start, end = _partition_bounds(predicates, column, qualifier, len(tables) == 1, today)
+            referenced = not found and _references_column(predicates, column, qualifier, len(tables) == 1)
+            if not found and not referenced and join is None:
+                # Filtro nella query che legge la CTE o la subquery
+                state, start, end = _outer_bounds(select, column, today)
+                found, referenced = state == 'bounded', state == 'referenced'
+            scan = PartitionScan(table_schema.full_id, column, start, end)
+            if referenced:
+                # Filtro dell'utente non sargable: aggiungere la finestra di default
+                # restringerebbe il risultato, non solo la scansione
+                scan.unpruned = True
+            elif not found:
+                # Nessun predicato sargable: si limita la scansione agli ultimi N giorni, oggi compreso
+                window = f"DATE_SUB(CURRENT_DATE(), INTERVAL {int(default_days)} DAY)"
+                if join is None:
+                    column_ref = f"{qualifier}.{column}" if len(tables) > 1 else column
+                    select.where(f"{column_ref} > {window}", dialect=DIALECT, copy=False)
+                else:
+                    # Sulle tabelle in JOIN si filtra in una subquery, per non alterare
+                    # la semantica delle outer join
+                    bare = table.copy()
+                    bare.set("alias", None)
+                    table.replace(
+                        exp.select("*").from_(bare).where(f"{column} > {window}", dialect=DIALECT).subquery(qualifier)
+                    )
+                scan.start = today - datetime.timedelta(days=int(default_days) - 1)
+                scan.end = None
+                scan.injected = True
+            if scan.start is not None and scan.end is None:
+                scan.end = today
+            report.scans.append(scan)
+
+    if report.rewritten:
+        report.sql = tree.sql(dialect=DIALECT, pretty=True)
+    return report
+
+
+def schema_mapping(schema: DatasetSchema) -> dict:
+    """Schema nel formato di sqlglot: {progetto: {dataset: {tabella: {colonna: tipo}}}}"""
+    tables = {
+        t.table_id: {c.name: c.field_type for c in t.columns}
+        for t in schema.tables.values()
+    }
+    return {schema.project_id: {schema.dataset_id: tables}}
+
+
+def _group_by_errors(select) -> list[str]:
+    """Colonne selezionate né aggregate né presenti nel GROUP BY"""
+    from sqlglot import exp
+
+    group = select.args.get("group")
+    projections = select.expressions
+    has_aggregate = any(p.find(exp.AggFunc) for p in projections)
+    if group is None and not has_aggregate:
+        return []
+
+    group_keys = set()
+    group_columns = set()
+    for key in (group.expressions if group is not None else []):
+        if isinstance(key, exp.Literal) and key.is_int and 0 < int(key.name) <= len(projections):
+            # GROUP BY ordinale
+            key = projections[int(key.name) - 1]
+        group_keys.add(key.unalias().sql(dialect=DIALECT).lower())
+        if key.alias:
+            group_keys.add(key.alias.lower())
+        if isinstance(key, exp.Column):
+            group_keys.add(key.name.lower())
+        group_columns.update(c.name.lower() for c in key.find_all(exp.Column))
+
+    errors = []
+    for projection in projections:
+        expression = projection.unalias()
+        if isinstance(expression, exp.Star) or expression.find(exp.AggFunc) or expression.find(exp.Window):
+            continue
+        if expression.sql(dialect=DIALECT).lower() in group_keys or projection.alias_or_name.lower() in group_keys:
+            continue
+        missing = [c.name for c in expression.find_all(exp.Column) if c.name.lower() not in group_columns]
+        if missing:
+            errors.append(
+                f"la colonna `{missing[0]}` è selezionata ma non è aggregata né presente nel GROUP BY"
+            )
+    return errors
+
+
+def validate_sql(sql: str, schema: DatasetSchema | None) -> list[str]:
+    """Valida la SQL contro lo schema in cache, senza chiamate a BigQuery.
+
+    Controlla sintassi (dialetto BigQuery), tabelle, colonne e GROUP BY. Ritorna
+    la lista degli errori (vuota se la query è valida o non verificabile).
+    """
+    if schema is None:
+        return []
+    try:
+        import sqlglot
+        from sqlglot import exp
+        from sqlglot.errors import OptimizeError, ParseError
+        from sqlglot.optimizer.qualify import qualify
+    except ImportError:
+        return []
+
+    try:
+        statements = [s for s in sqlglot.parse(sql, read=DIALECT) if s is not None]
+    except ParseError as e:
+        return [f"errore di sintassi: {str(e).splitlines()[0]}"]
+    if len(statements) != 1:
+        return ["la risposta deve contenere una sola istruzione SQL"]
+    tree = statements[0]
+    if not isinstance(tree, exp.Query):
+        return ["l'istruzione non è una SELECT"]
+
+    errors = []
+    cte_names = {cte.alias_or_name.lower() for cte in tree.find_all(exp.CTE)}
+    for table in tree.find_all(exp.Table):
+        if not table.name or (not table.db and table.name.lower() in cte_names):
+            continue
+        name = ".".join(p for p in (table.catalog, table.db, table.name) if p)
+        if schema.table(name) is None:
+            errors.append(f"la tabella `{name}` non esiste tra quelle configurate ({', '.join(schema.tables)})")
+    if errors:
+        return errors
+
+    try:
+        qualify(tree.copy(), schema=schema_mapping(schema), dialect=DIALECT, validate_qualify_columns=True)
+    except OptimizeError as e:
+        errors.append("colonna non valida: " + str(e).split(". Line:")[0])
+    except Exception:
+        # Costrutti non gestiti dall'ottimizzatore: la verifica delle colonne è saltata
+        pass
+
+    for select in tree.find_all(exp.Select):
+        errors.extend(_group_by_errors(select))
+    return errors
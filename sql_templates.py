@@ -0,0 +1,195 @@
+"""SQL predefinite per le domande rapide della modalità BigQuery.
+
+Le domande preimpostate sono fisse: invece di generare ogni volta la SQL con
+l'LLM si usano modelli scritti a mano, già filtrati sulla partizione
+`data_date`, completati con progetto, dataset e tabelle configurati. La SQL
+prodotta passa comunque per dry-run e budget come quella generata.
+
+Le finestre terminano all'ultimo giorno esportato (oggi meno il ritardo
+dell'export) e sono semiaperte, `> fine - N AND <= fine`: N giorni esatti, e i
+periodi confrontati hanno la stessa lunghezza.
+"""
+from dataclasses import dataclass, field
+
+from schema_cache import DatasetSchema, TableSchema
+
+# Ruoli delle tabelle dell'export bulk, riconosciuti dalle colonne
+TABLE_ROLES = {
+    'site': {'data_date', 'query', 'clicks', 'impressions', 'sum_top_position'},
+    'url': {'data_date', 'url', 'query', 'clicks', 'impressions', 'sum_position'},
+}
+PREFERRED_TABLES = {'site': 'searchdata_site_impression', 'url': 'searchdata_url_impression'}
+# Giorni di ritardo dell'export bulk: le partizioni più recenti non sono ancora complete
+EXPORT_LAG_DAYS = 2
+
+
+@dataclass(frozen=True)
+class SqlTemplate:
+    label: str
+    question: str
+    table_role: str  # 'site' | 'url'
+    sql: str  # con segnaposto {table} e parametri
+    params: dict = field(default_factory=dict)
+
+    def render(self, schema: DatasetSchema | None) -> str | None:
+        """SQL per le tabelle configurate, o None se manca una tabella adatta"""
+        table = table_for_role(schema, self.table_role) if schema is not None else None
+        if table is None:
+            return None
+        # Offset da oggi: fine del periodo corrente, suo inizio e inizio del precedente
+        offsets = {'end': EXPORT_LAG_DAYS}
+        if 'days' in self.params:
+            offsets['start'] = EXPORT_LAG_DAYS + self.params['days']
+            offsets['previous_start'] = EXPORT_LAG_DAYS + 2 * self.params['days']
+        return self.sql.format(table=table.full_id, **offsets, **self.params).strip()
+
+
+def table_for_role(schema: DatasetSchema, role: str) -> TableSchema | None:
+    """Tabella configurata con le colonne del ruolo (preferendo il nome standard dell'export)"""
+    required = TABLE_ROLES[role]
+    candidates = [
+        schema.tables[t] for t in schema.requested
+        if t in schema.tables and required <= set(schema.tables[t].column_names)
+    ]
+    for table in candidates:
+        if table.table_id == PREFERRED_TABLES[role]:
+            return table
+    return candidates[0] if candidates else None
+
+
+_PERFORMANCE = """
+SELECT
+  SUM(clicks) AS clicks,
+  SUM(impressions) AS impressions,
+  SAFE_DIVIDE(SUM(clicks), SUM(impressions)) AS ctr,
+  SAFE_DIVIDE(SUM(sum_top_position), SUM(impressions)) + 1 AS avg_position
+FROM `{table}`
+WHERE data_date > DATE_SUB(CURRENT_DATE(), INTERVAL {start} DAY)
+  AND data_date <= DATE_SUB(CURRENT_DATE(), INTERVAL {end} DAY)
+"""
+
+_TOP_QUERIES = """
+SELECT
+  query,
+  SUM(clicks) AS clicks,
+  SUM(impressions) AS impressions,
+  SAFE_DIVIDE(SUM(clicks), SUM(impressions)) AS ctr,
+  SAFE_DIVIDE(SUM(sum_top_position), SUM(impressions)) + 1 AS avg_position
+FROM `{table}`
+WHERE data_date > DATE_SUB(CURRENT_DATE(), INTERVAL {start} DAY)
+  AND data_date <= DATE_SUB(CURRENT_DATE(), INTERVAL {end} DAY)
+  AND query IS NOT NULL
+GROUP BY query
+ORDER BY clicks DESC
+LIMIT {limit}
+"""
+
+_TOP_PAGES = """
+SELECT
+  url,
+  SUM(impressions) AS impressions,
+  SUM(clicks) AS clicks,
+  SAFE_DIVIDE(SUM(clicks), SUM(impressions)) AS ctr,
+  SAFE_DIVIDE(SUM(sum_position), SUM(impressions)) + 1 AS avg_position
+FROM `{table}`
+WHERE data_date > DATE_SUB(CURRENT_DATE(), INTERVAL {start} DAY)
+  AND data_date <= DATE_SUB(CURRENT_DATE(), INTERVAL {end} DAY)
+GROUP BY url
+ORDER BY impressions DESC
+LIMIT {limit}
+"""
+
+_CLICKS_MOM = """
+SELECT
+  FORMAT_DATE('%Y-%m', DATE_TRUNC(data_date, MONTH)) AS month,
+  SUM(clicks) AS clicks,
+  SUM(impressions) AS impressions
+FROM `{table}`
+WHERE data_date >= DATE_SUB(DATE_TRUNC(DATE_SUB(CURRENT_DATE(), INTERVAL {end} DAY), MONTH), INTERVAL 2 MONTH)
+  AND data_date < DATE_TRUNC(DATE_SUB(CURRENT_DATE(), INTERVAL {end} DAY), MONTH)
+GROUP BY month
+ORDER BY month
+"""
+
+_DECLINING_QUERIES = """
+SELECT
+  query,
+  SUM(IF(data_date > DATE_SUB(CURRENT_DATE(), INTERVAL {start} DAY), clicks, 0)) AS clicks_current,
+  SUM(IF(data_date <= DATE_SUB(CURRENT_DATE(), INTERVAL {start} DAY), clicks, 0)) AS clicks_previous,
+  SUM(IF(data_date > DATE_SUB(CURRENT_DATE(), INTERVAL {start} DAY), clicks, -clicks)) AS clicks_change
+FROM `{table}`
+WHERE data_date > DATE_SUB(CURRENT_DATE(), INTERVAL {previous_start} DAY)
+  AND data_date <= DATE_SUB(CURRENT_DATE(), INTERVAL {end} DAY)
+  AND query IS NOT NULL
+GROUP BY query
+HAVING SUM(IF(data_date > DATE_SUB(CURRENT_DATE(), INTERVAL {start} DAY), clicks, -clicks)) < 0
+ORDER BY clicks_change
+LIMIT {limit}
+"""
+
+_NEW_PAGES = """
+WITH current_period AS (
+  SELECT url, SUM(impressions) AS impressions, SUM(clicks) AS clicks
+  FROM `{table}`
+  WHERE data_date > DATE_SUB(CURRENT_DATE(), INTERVAL {start} DAY)
+    AND data_date <= DATE_SUB(CURRENT_DATE(), INTERVAL {end} DAY)
+  GROUP BY url
+  HAVING SUM(impressions) > 0
+),
+previous_period AS (
+  SELECT DISTINCT url
+  FROM `{table}`
+  WHERE data_date > DATE_SUB(CURRENT_DATE(), INTERVAL {previous_start} DAY)
+    AND data_date <= DATE_SUB(CURRENT_DATE(), INTERVAL {start} DAY)
+    AND impressions > 0
+)
+SELECT c.url, c.impressions, c.clicks
+FROM current_period AS c
+LEFT JOIN previous_period AS p ON c.url = p.url
+WHERE p.url IS NULL
+ORDER BY c.impressions DESC
+LIMIT {limit}
+"""
+
+_BEST_CTR = """
+SELECT
+  query,
+  SUM(clicks) AS clicks,
+  SUM(impressions) AS impressions,
+  SAFE_DIVIDE(SUM(clicks), SUM(impressions)) AS ctr,
+  SAFE_DIVIDE(SUM(sum_top_position), SUM(impressions)) + 1 AS avg_position
+FROM `{table}`
+WHERE data_date > DATE_SUB(CURRENT_DATE(), INTERVAL {start} DAY)
+  AND data_date <= DATE_SUB(CURRENT_DATE(), INTERVAL {end} DAY)
+  AND query IS NOT NULL
+GROUP BY query
+HAVING SUM(impressions) >= {min_impressions}
+ORDER BY ctr DESC
+LIMIT {limit}
+"""
+
+# Nell'ordine dei pulsanti della modalità BigQuery
+PRESET_TEMPLATES = [
+    SqlTemplate("Perf. Totale (7gg)", "Qual è stata la mia performance totale (clic, impressioni, CTR medio, posizione media) negli ultimi 7 giorni?",
+                'site', _PERFORMANCE, {'days': 7}),
+    SqlTemplate("Perf. Totale (28gg)", "Qual è stata la mia performance totale (clic, impressioni, CTR medio, posizione media) negli ultimi 28 giorni?",
+                'site', _PERFORMANCE, {'days': 28}),
+    SqlTemplate("Query Top (7gg)", "Quali sono le top 10 query per clic negli ultimi 7 giorni?",
+                'site', _TOP_QUERIES, {'days': 7, 'limit': 10}),
+    SqlTemplate("Pagine Top (7gg)", "Quali sono le top 10 pagine per impressioni negli ultimi 7 giorni?",
+                'url', _TOP_PAGES, {'days': 7, 'limit': 10}),
+    SqlTemplate("Clic MoM", "Confronta i clic totali del mese scorso con quelli di due mesi fa.",
+                'site', _CLICKS_MOM),
+    SqlTemplate("Query in Calo", "Quali query hanno avuto il maggior calo di clic negli ultimi 28 giorni?",
+                'site', _DECLINING_QUERIES, {'days': 28, 'limit': 50}),
+    SqlTemplate("Pagine Nuove", "Quali pagine hanno ricevuto impressioni negli ultimi 7 giorni ma non nei 7 precedenti?",
+                'url', _NEW_PAGES, {'days': 7, 'limit': 100}),
+    SqlTemplate("CTR Migliore", "Quali query hanno il CTR più alto negli ultimi 30 giorni (min 100 impressioni)?",
+                'site', _BEST_CTR, {'days': 30, 'min_impressions': 100, 'limit': 20}),
+]
+
+TEMPLATES_BY_QUESTION = {t.question: t for t in PRESET_TEMPLATES}
+
+
+def template_for_question(question: str) -> SqlTemplate | None:
+    return TEMPLATES_BY_QUESTION.get(question.strip())
@@ -0,0 +1,170 @@
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+
+TRACE_DIR = os.getenv("CHATGSC_TRACE_DIR", "traces")
+
+_current_span = contextvars.ContextVar("chatgsc_current_span", default=None)
+
+# Aggregati process-wide per l'export OpenMetrics: nome span -> [count, somma secondi]
+_span_totals = {}
+_totals_lock = threading.Lock()
+
+
+class _NoopSpan:
+    """Span nullo usato quando il tracing è disattivato"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+_NOOP = _NoopSpan()
+
+
+class Span:
+    """Intervallo temporale con attributi e figli annidati"""
+
+    def __init__(self, name: str, attrs: dict = None):
+        self.name = name
+        self.attrs = dict(attrs or {})
+        self.children = []
+        self.start = None
+        self.end = None
+        self._token = None
+
+    def __enter__(self):
+        parent = _current_span.get()
+        if parent is not None:
+            parent.children.append(self)
+        self._token = _current_span.set(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end = time.perf_counter()
+        if exc_type is not None:
+            self.attrs['error'] = exc_type.__name__
+        _current_span.reset(self._token)
+        with _totals_lock:
+            totals = _span_totals.setdefault(self.name, [0, 0.0])
+            totals[0] += 1
+            totals[1] += self.duration
+        return False
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    @property
+    def duration(self) -> float:
+        if self.start is None:
+            return 0.0
+        return (self.end or time.perf_counter()) - self.start
+
+    def find(self, name: str) -> bool:
+        """True se questo span o un discendente si chiama name"""
+        return self.name == name or any(child.find(name) for child in self.children)
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'duration_ms': round(self.duration * 1000, 3),
+            'attrs': self.attrs,
+            'children': [child.to_dict() for child in self.children],
+        }
+
+    def flatten(self, depth: int = 0) -> list[dict]:
+        """Righe (profondità, nome, ms, attributi) per la visualizzazione tabellare"""
+        rows = [{
+            'span': "  " * depth + self.name,
+            'ms': round(self.duration * 1000, 1),
+            **self.attrs,
+        }]
+        for child in self.children:
+            rows.extend(child.flatten(depth + 1))
+        return rows
+
+
+def span(name: str, **attrs):
+    """Apre uno span figlio dello span corrente; no-op se non c'è una trace attiva"""
+    if _current_span.get() is None:
+        return _NOOP
+    return Span(name, attrs)
+
+
+def set_attrs(**attrs):
+    """Aggiunge attributi (righe, byte, token...) allo span corrente"""
+    current = _current_span.get()
+    if current is not None:
+        current.set(**attrs)
+
+
+def start_trace(name: str, enabled: bool, **attrs):
+    """Span radice di una trace, oppure no-op se il tracing è disattivato"""
+    if not enabled:
+        return _NOOP
+    return Span(name, attrs)
+
+
+def is_enabled_by_env() -> bool:
+    return os.getenv("CHATGSC_TRACING", "").lower() in ("1", "true", "yes")
+
+
+def write_trace(root: Span, trace_dir: str = None):
+    """Appende la trace in JSONL e riscrive il file OpenMetrics aggregato"""
+    trace_dir = trace_dir or TRACE_DIR
+    os.makedirs(trace_dir, exist_ok=True)
+    record = {
+        'trace_id': uuid.uuid4().hex,
+        'timestamp': time.time(),
+        'root': root.to_dict(),
+    }
+    with open(os.path.join(trace_dir, "traces.jsonl"), "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, default=str) + "\n")
+    write_openmetrics(os.path.join(trace_dir, "metrics.prom"))
+
+
+def openmetrics_text() -> str:
+    """Metriche aggregate in formato OpenMetrics (span, rate limiter, single-flight)"""
+    from rate_limiter import limiter
+    from single_flight import single_flight
+
+    lines = [
+        "# TYPE chatgsc_span_duration_seconds summary",
+        "# HELP chatgsc_span_duration_seconds Durata delle fasi tracciate.",
+    ]
+    with _totals_lock:
+        totals = {name: list(values) for name, values in _span_totals.items()}
+    for name, (count, total) in sorted(totals.items()):
+        lines.append(f'chatgsc_span_duration_seconds_count{{span="{name}"}} {count}')
+        lines.append(f'chatgsc_span_duration_seconds_sum{{span="{name}"}} {total:.6f}')
+
+    lines.append("# TYPE chatgsc_ratelimiter_wait_seconds counter")
+    lines.append("# HELP chatgsc_ratelimiter_wait_seconds Attesa cumulata nel rate limiter.")
+    limiter_metrics = limiter.metrics_snapshot()
+    for api, values in sorted(limiter_metrics.items()):
+        lines.append(f'chatgsc_ratelimiter_wait_seconds_total{{api="{api}"}} {values["wait_seconds_total"]:.6f}')
+    lines.append("# TYPE chatgsc_ratelimiter_retries counter")
+    for api, values in sorted(limiter_metrics.items()):
+        lines.append(f'chatgsc_ratelimiter_retries_total{{api="{api}"}} {values["retries"]}')
+
+    lines.append("# TYPE chatgsc_singleflight_shared counter")
+    lines.append(f'chatgsc_singleflight_shared_total {single_flight.stats["shared"]}')
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
+def write_openmetrics(path: str):
+    # Un file temporaneo per scrittore: le sessioni concorrenti non si sovrascrivono
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(openmetrics_text())
+    os.replace(tmp_path, path)
@@ -0,0 +1,94 @@
+"""Accesso a Streamlit sostituibile da un'implementazione headless.
+
+Le modalità usano `from ui import st` al posto di `import streamlit as st`.
+Nell'app il proxy delega a Streamlit (importato al primo uso); con
+`use_headless()` messaggi e segreti passano invece da logging e da un
+dizionario, così la logica di fetch, analisi e grafici gira senza Streamlit.
+"""
+import contextlib
+import logging
+
+logger = logging.getLogger("chatgsc")
+
+
+class HeadlessRerun(RuntimeError):
+    """Sollevata da st.rerun() in modalità headless (es. credenziali scadute)"""
+
+
+class HeadlessSessionState(dict):
+    """Session state con accesso per chiave e per attributo, come st.session_state"""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError as e:
+            raise AttributeError(name) from e
+
+    def __setattr__(self, name, value):
+        self[name] = value
+
+    def __delattr__(self, name):
+        del self[name]
+
+
+class HeadlessStreamlit:
+    """Sottoinsieme di API Streamlit usato dalla logica delle modalità, senza UI"""
+
+    def __init__(self, secrets: dict = None):
+        self.secrets = dict(secrets or {})
+        self.session_state = HeadlessSessionState()
+        self.messages = []
+
+    def _log(self, level: int, kind: str, body):
+        self.messages.append((kind, str(body)))
+        logger.log(level, "%s", body)
+
+    def error(self, body, **kwargs):
+        self._log(logging.ERROR, 'error', body)
+
+    def warning(self, body, **kwargs):
+        self._log(logging.WARNING, 'warning', body)
+
+    def info(self, body, **kwargs):
+        self._log(logging.INFO, 'info', body)
+
+    def success(self, body, **kwargs):
+        self._log(logging.INFO, 'success', body)
+
+    def caption(self, body, **kwargs):
+        self._log(logging.INFO, 'caption', body)
+
+    def spinner(self, text: str = "", **kwargs):
+        return contextlib.nullcontext()
+
+    def expander(self, label: str = "", **kwargs):
+        return contextlib.nullcontext()
+
+    def code(self, body, **kwargs):
+        logger.debug("%s", body)
+
+    def button(self, *args, **kwargs) -> bool:
+        return False
+
+    def rerun(self):
+        raise HeadlessRerun("Rerun richiesto: in modalità headless le credenziali vanno rinnovate")
+
+
+class _StreamlitProxy:
+    def __init__(self):
+        self._headless = None
+
+    def __getattr__(self, name):
+        if self._headless is not None:
+            return getattr(self._headless, name)
+        import streamlit
+        return getattr(streamlit, name)
+
+
+st = _StreamlitProxy()
+
+
+def use_headless(secrets: dict = None) -> HeadlessStreamlit:
+    """Attiva l'implementazione headless per tutto il processo"""
+    st._headless = HeadlessStreamlit(secrets)
+    return st._headless
@@ -0,0 +1,66 @@
+import importlib
+import threading
+import time
+
+# Moduli pesanti usati solo dopo il login, in ordine di probabilità d'uso
+WARMUP_MODULES = [
+    'googleapiclient.discovery',
+    'pandas',
+    'gsc_direct',
+    'openai',
+    'google.cloud.bigquery',
+    'bigquery_mode',
+    'matplotlib.pyplot',
+]
+
+_started = False
+_lock = threading.Lock()
+timings = {}
+
+
+def _prime_discovery_document():
+    """Carica il discovery document statico di Search Console"""
+    from googleapiclient.discovery_cache import get_static_doc
+
+    get_static_doc('searchconsole', 'v1')
+
+
+def _prime_matplotlib():
+    """Costruisce/legge la cache dei font e inizializza il rendering Agg"""
+    import matplotlib
+
+    matplotlib.use("Agg")
+    from matplotlib import font_manager
+    import matplotlib.pyplot as plt
+
+    font_manager.findfont(font_manager.FontProperties(family='sans-serif'))
+    fig, ax = plt.subplots(figsize=(1, 1))
+    ax.set_title("warmup")
+    fig.canvas.draw()
+    plt.close(fig)
+
+
+def _run():
+    for name in WARMUP_MODULES:
+        start = time.perf_counter()
+        try:
+            if name == 'matplotlib.pyplot':
+                _prime_matplotlib()
+            else:
+                importlib.import_module(name)
+            if name == 'googleapiclient.discovery':
+                _prime_discovery_document()
+        except Exception:
+            # Il warmup è solo un'ottimizzazione: gli errori emergeranno all'uso reale
+            pass
+        timings[name] = time.perf_counter() - start
+
+
+def start():
+    """Avvia (una sola volta per processo) il pre-import in background"""
+    global _started
+    with _lock:
+        if _started:
+            return
+        _started = True
+    threading.Thread(target=_run, name="chatgsc-warmup", daemon=True).start()